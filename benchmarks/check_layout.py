@@ -0,0 +1,104 @@
+"""
+Check that paraprobe results files have the layout the job collectors read.
+
+The stand-ins write the layout of paraprobe_results, so they cannot show
+whether it matches the installed paraprobe tools. Run this on the results
+files of a real run, e.g. the working directories of a ParaprobeJob:
+
+Usage: python check_layout.py PARAPROBE.Nanochem.Results.SimID.636502001.h5 ... --tasks 1 --isovalues 21
+
+For nanochem every task and isosurface needs its group, the object
+datasets are only checked where an objects group exists, and the file is
+read with read_nanochem_objects as ParaprobeNanochem collects it, printing
+the object count of every task and isovalue. Missing paths are printed with
+the groups the file does have. Exits with 1 if a path is missing.
+"""
+import argparse
+import os
+import re
+import sys
+
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paraprobe_jobs"))
+from paraprobe_results import (RANGER_LAYOUT, SURFACER_VERTICES, SURFACER_FACES,
+                               DISTANCER_DISTANCES, NANOCHEM_DELOCALIZATION, NANOCHEM_ISOSURFACE,
+                               NANOCHEM_OBJECTS, NANOCHEM_OBJECT_VOLUME, NANOCHEM_OBJECT_EDGE_CONTACT,
+                               NANOCHEM_OBJECT_ION_COUNT, missing_paths, read_nanochem_objects)
+
+_RESULTS_FILE = re.compile(r"PARAPROBE\.(?P<tool>\w+)\.Results\.SimID\.(?P<simid>\d+)\.h5$")
+
+
+def _tessellator_paths(simid):
+    import paraprobe_autoreporter.metadata.h5tessellator as nx
+    grpnm = nx.MYTESS + str(simid) + nx.MYTESS_DATA_VORO_TSKS + '/0'
+    return [grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_CVOL, grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_WALLCONTACT]
+
+
+def _nanochem_paths(filename, n_tasks, n_isovalues):
+    groups = [path.format(task=task, isosurface=isosurface)
+              for task in range(n_tasks) for isosurface in range(n_isovalues)
+              for path in [NANOCHEM_DELOCALIZATION, NANOCHEM_ISOSURFACE]]
+    with h5py.File(filename, "r") as h5r:
+        with_objects = [(task, isosurface) for task in range(n_tasks) for isosurface in range(n_isovalues)
+                        if NANOCHEM_OBJECTS.format(task=task, isosurface=isosurface) in h5r]
+    objects = [path.format(task=task, isosurface=isosurface) for task, isosurface in with_objects
+               for path in [NANOCHEM_OBJECT_VOLUME, NANOCHEM_OBJECT_EDGE_CONTACT, NANOCHEM_OBJECT_ION_COUNT]]
+    return list(dict.fromkeys(groups + objects)), len(with_objects)
+
+
+def expected_paths(filename, n_tasks=1, n_isovalues=1):
+    match = _RESULTS_FILE.search(os.path.basename(filename))
+    if match is None:
+        raise ValueError(f"{filename} is not a PARAPROBE.<Tool>.Results.SimID.<id>.h5 file")
+    tool = match.group("tool")
+    if tool == "Ranger":
+        return list(RANGER_LAYOUT), None
+    if tool == "Surfacer":
+        return [SURFACER_VERTICES, SURFACER_FACES], None
+    if tool == "Distancer":
+        return [DISTANCER_DISTANCES], None
+    if tool == "Tessellator":
+        return _tessellator_paths(match.group("simid")), None
+    if tool == "Nanochem":
+        return _nanochem_paths(filename, n_tasks, n_isovalues)
+    raise ValueError(f"No layout for {tool} results")
+
+
+def _groups(filename, depth=4):
+    names = []
+    with h5py.File(filename, "r") as h5r:
+        h5r.visit(lambda name: names.append(name) if name.count("/") < depth else None)
+    return names
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--tasks", type=int, default=1, help="delocalization tasks of a nanochem run")
+    parser.add_argument("--isovalues", type=int, default=1, help="isovalues of a nanochem run")
+    args = parser.parse_args(argv)
+
+    failed = False
+    for filename in args.files:
+        paths, with_objects = expected_paths(filename, n_tasks=args.tasks, n_isovalues=args.isovalues)
+        missing = missing_paths(filename, paths)
+        note = "" if with_objects is None else f", {with_objects} isosurfaces with objects"
+        print(f"{os.path.basename(filename)}: {len(paths) - len(missing)} of {len(paths)} paths{note}")
+        if len(missing) > 0:
+            failed = True
+            for path in missing:
+                print(f"  missing {path}")
+            print("  the file has:")
+            for name in _groups(filename):
+                print(f"    /{name}")
+        elif with_objects is not None:
+            summary = read_nanochem_objects(filename, args.tasks, args.isovalues, max_objects=0)
+            for task, counts in enumerate(summary["object_count"]):
+                print(f"  task {task} objects per isovalue: {counts.tolist()}")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Check the timing and progress patterns of paraprobe_logs against a log.
+
+The patterns were written without a log.out of the installed paraprobe
+tools. Run this on one, e.g. the log.out or log.out.gz of a stage job, to
+see which lines are read as timings and progress:
+
+Usage: python check_logs.py log.out.gz ...
+
+Without files the patterns are checked against lines they have to accept
+and lines they have to reject, exits with 1 if one is read wrong.
+"""
+import gzip
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paraprobe_jobs"))
+from paraprobe_logs import parse_progress, parse_timing
+
+TIMINGS = {
+    "Reading the reconstruction took 1.234 s": ("Reading the reconstruction", 1.234),
+    "ComputeDistances: 12.5 seconds": ("ComputeDistances", 12.5),
+    "Rank 0: Tessellation took 3 s\n": ("Tessellation", 3.),
+    "Rank 0: 3 s": None,
+    "Rank 0 of 4 started": None,
+    "Set tolerance to 0.5 s for 3 iterations": None,
+}
+PROGRESS = {
+    "Processed 1000000 of 5000000 ions": (1000000., 5000000.),
+    "3 / 12 tasks": (3., 12.),
+    "[Rank 1] 7 of 8 isosurfaces done\n": (7., 8.),
+    "Delocalization 42.0 % done": (42., 100.),
+    "Rank 0 of 4 started": None,
+    "Rank 0: 3 s": None,
+    "Volume fraction 12 % of the dataset is at the edge": None,
+    "Using 3 of 4 threads": None,
+}
+
+
+def _open(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt", errors="replace")
+    return open(filename, "r", errors="replace")
+
+
+def check_examples():
+    failed = False
+    for parse, examples in [(parse_timing, TIMINGS), (parse_progress, PROGRESS)]:
+        for line, expected in examples.items():
+            found = parse(line)
+            if found != expected:
+                failed = True
+                print(f"{parse.__name__}({line.strip()!r}) = {found}, expected {expected}")
+    return failed
+
+
+def main(argv=None):
+    files = sys.argv[1:] if argv is None else argv
+    if len(files) == 0:
+        failed = check_examples()
+        print("failed" if failed else "ok")
+        if failed:
+            sys.exit(1)
+        return
+    for filename in files:
+        timings = progress = 0
+        with _open(filename) as fin:
+            for number, line in enumerate(fin, start=1):
+                timing = parse_timing(line)
+                if timing is not None:
+                    timings += 1
+                    print(f"{filename}:{number}: timing {timing} <- {line.strip()}")
+                line_progress = parse_progress(line)
+                if line_progress is not None:
+                    progress += 1
+                    print(f"{filename}:{number}: progress {line_progress} <- {line.strip()}")
+        print(f"{filename}: {timings} timing and {progress} progress lines")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Check the import time of the paraprobe job modules against a budget.
+
+Every module is imported in a fresh interpreter, the fastest of --repeat
+runs counts. pyiron_base is needed by every job module and is timed on its
+own as the baseline, the budget applies to the time on top of it. Importing
+a job module must not load any of the heavy or UI-only dependencies beyond
+those pyiron_base loads itself, e.g. h5py, they are imported on first use.
+Exits with 1 if a module exceeds the budget or loads one of them.
+
+Usage: python import_time.py --budget 0.3 --output import_time.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+JOBS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paraprobe_jobs")
+MODULES = [
+    "paraprobe_job",
+    "paraprobe_batch",
+    "paraprobe_ranger_job",
+    "paraprobe_surfacer_job",
+    "paraprobe_distancer_job",
+    "paraprobe_tessellator_job",
+    "paraprobe_nanochem_job",
+]
+LAZY = ["jupyterlab_h5web", "matplotlib", "h5py", "paraprobe_parmsetup", "paraprobe_autoreporter"]
+
+_PROBE = """
+import json, sys, time
+sys.path.insert(0, {directory!r})
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+loaded = sorted({{name.split(".")[0] for name in sys.modules}} & set({lazy!r}))
+print(json.dumps({{"seconds": seconds, "loaded": loaded}}))
+"""
+
+
+def time_import(module, repeat=5):
+    """
+    Fastest import time of a module in a fresh interpreter and the lazy
+    dependencies it loaded
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", _PROBE.format(directory=JOBS_DIRECTORY, module=module, lazy=LAZY)],
+            check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return min(run["seconds"] for run in runs), runs[0]["loaded"]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=0.3, help="seconds on top of pyiron_base")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--output", default="import_time.json")
+    args = parser.parse_args(argv)
+
+    baseline, baseline_loaded = time_import("pyiron_base", repeat=args.repeat)
+    results = []
+    for module in MODULES:
+        seconds, loaded = time_import(module, repeat=args.repeat)
+        loaded = [name for name in loaded if name not in baseline_loaded]
+        results.append({
+            "module": module,
+            "seconds": seconds,
+            "overhead": seconds - baseline,
+            "loaded": loaded,
+            "passed": seconds - baseline <= args.budget and len(loaded) == 0,
+        })
+    report = {"baseline": baseline, "baseline_loaded": baseline_loaded, "budget": args.budget, "results": results}
+    with open(args.output, "w") as fout:
+        json.dump(report, fout, indent=2)
+    print(f"{'pyiron_base':<28s} {baseline:8.3f} s  loads {' '.join(baseline_loaded)}")
+    for result in results:
+        print(f"{result['module']:<28s} {result['seconds']:8.3f} s  overhead {result['overhead']:8.3f} s  "
+              f"{'ok' if result['passed'] else 'FAILED'}  {' '.join(result['loaded'])}")
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+    return report
+
+
+if __name__ == "__main__":
+    main()
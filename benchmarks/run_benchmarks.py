@@ -0,0 +1,180 @@
+"""
+Time the paraprobe jobs on synthetic datasets with stand-in executables.
+
+Every stage job, ParaprobeJob and a ParaprobeBatch of one specimen are run
+end to end for each dataset size, all of them have to end as finished.
+The configuration steps use the installed paraprobe_parmsetup. From the
+performance measurements of the jobs (output["perf/..."]) the wall time is
+split into compute (the executable and the in-process transcoder) and
+orchestration: staging, configuration, log capture and result collection.
+Results are written as json.
+
+Usage: python run_benchmarks.py --ions 1e5 1e6 --output bench.json
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paraprobe_jobs"))
+from synthetic import generate_dataset
+from standins import install_standins
+
+STAGES = ["ranger", "surfacer", "distancer", "tessellator", "nanochem"]
+UPSTREAM = {
+    "ranger": [],
+    "surfacer": ["ranger"],
+    "distancer": ["ranger", "surfacer"],
+    "tessellator": ["ranger", "distancer"],
+    "nanochem": ["ranger", "surfacer", "distancer"],
+}
+
+
+def _iterate_phases(perf, prefix=""):
+    for key, value in perf.items():
+        if not hasattr(value, "items"):
+            continue
+        if "wall_time" in value:
+            yield prefix + key, value["wall_time"]
+        else:
+            yield from _iterate_phases(value, prefix=f"{prefix}{key}/")
+
+
+def summarize(phases, wall_time):
+    """
+    Split the (phase, seconds) timings of a job into compute and orchestration
+    """
+    totals = {}
+    for phase, seconds in phases:
+        kind = phase.split("/")[0]
+        totals[kind] = totals.get(kind, 0.) + seconds
+    compute = totals.get("execute", 0.)
+    return {
+        "wall_time": wall_time,
+        "compute": compute,
+        "staging": totals.get("staging", 0.),
+        "configure": totals.get("configure", 0.),
+        # log capture is part of the collect phase
+        "log_capture": totals.get("logs", 0.),
+        "collect": totals.get("collect", 0.),
+        "orchestration": wall_time - compute,
+        "phases": [{"phase": phase, "seconds": seconds} for phase, seconds in phases],
+    }
+
+
+def require_finished(job):
+    """
+    Jobs have to end as finished, a job left in collect is retried by a batch
+    """
+    if not job.status.finished:
+        raise RuntimeError(f"{job.job_name} ended with status {job.status.string}")
+
+
+def run_stage_jobs(project, pos_file, rrng_file, n_ions):
+    import paraprobe_ranger_job, paraprobe_surfacer_job, paraprobe_distancer_job
+    import paraprobe_tessellator_job, paraprobe_nanochem_job
+    job_types = {
+        "ranger": paraprobe_ranger_job.ParaprobeRanger,
+        "surfacer": paraprobe_surfacer_job.ParaprobeSurfacer,
+        "distancer": paraprobe_distancer_job.ParaprobeDistancer,
+        "tessellator": paraprobe_tessellator_job.ParaprobeTessellator,
+        "nanochem": paraprobe_nanochem_job.ParaprobeNanochem,
+    }
+    jobs = {}
+    results = []
+    for stage in STAGES:
+        job = project.create_job(job_type=job_types[stage], job_name=f"bench_{n_ions}_{stage}",
+                                 delete_existing_job=True)
+        job.version = "standin"
+        job.pos_file = pos_file
+        job.rrng_file = rrng_file
+        for dependency in UPSTREAM[stage]:
+            setattr(job, f"{dependency}_job", jobs[dependency])
+        start = time.perf_counter()
+        job.run()
+        wall_time = time.perf_counter() - start
+        require_finished(job)
+        jobs[stage] = job
+        phases = list(_iterate_phases(job.output.get("perf", {})))
+        results.append({"ions": n_ions, "job": type(job).__name__, **summarize(phases, wall_time)})
+    return results
+
+
+def run_pipeline(project, pos_file, rrng_file, n_ions):
+    from paraprobe_job import ParaprobeJob
+    job = project.create_job(job_type=ParaprobeJob, job_name=f"bench_{n_ions}_pipeline",
+                             delete_existing_job=True)
+    job.input.reuse = False
+    job.pos_file = pos_file
+    job.rrng_file = rrng_file
+    job.analyse_tessellator()
+    job.analyse_nanochem()
+    start = time.perf_counter()
+    job.run()
+    wall_time = time.perf_counter() - start
+    require_finished(job)
+    table = job.output["perf/table"]
+    phases = [(phase, seconds) for phase, seconds in zip(table["phase"], table["wall_time"])]
+    return {"ions": n_ions, "job": "ParaprobeJob", **summarize(phases, wall_time)}
+
+
+def run_batch(project, pos_file, rrng_file, n_ions):
+    """
+    A batch of one specimen, its member has to finish in the first attempt
+    """
+    from paraprobe_batch import ParaprobeBatch
+    job = project.create_job(job_type=ParaprobeBatch, job_name=f"bench_{n_ions}_batch",
+                             delete_existing_job=True)
+    job.add_specimen(pos_file, rrng_file, stages=["ranger", "surfacer"],
+                     parameters={"pipeline": {"reuse": False}})
+    job.run()
+    require_finished(job)
+    require_finished(job.load_member(job.specimens[0]))
+    if list(job.output["table/attempts"]) != [1]:
+        raise RuntimeError(f"{job.job_name} needed {list(job.output['table/attempts'])} attempts")
+    return {"ions": n_ions, "job": "ParaprobeBatch", "wall_time": job.output["throughput/wall_time"],
+            "specimens_per_hour": job.output["throughput/specimens_per_hour"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--ions", type=float, nargs="+", default=[1e5, 1e6])
+    parser.add_argument("--rate", type=float, default=1e7, help="stand-in throughput in ions/s")
+    parser.add_argument("--directory", default=None, help="working directory, temporary if not given")
+    parser.add_argument("--output", default="bench_output.json")
+    args = parser.parse_args(argv)
+
+    from pyiron_base import Project, state
+    directory = args.directory or tempfile.mkdtemp(prefix="paraprobe_bench_")
+    resources = install_standins(os.path.join(directory, "resources"))
+    state.settings.configuration["resource_paths"] = [resources]
+    os.environ["PARAPROBE_STANDIN_RATE"] = str(args.rate)
+    project = Project(os.path.join(directory, "project"))
+
+    results, batches = [], []
+    for n_ions in [int(n) for n in args.ions]:
+        pos_file, rrng_file = generate_dataset(os.path.join(directory, "data", str(n_ions)), n_ions)
+        results += run_stage_jobs(project, pos_file, rrng_file, n_ions)
+        results.append(run_pipeline(project, pos_file, rrng_file, n_ions))
+        batches.append(run_batch(project, pos_file, rrng_file, n_ions))
+
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "standin_rate": args.rate,
+        "results": results,
+        "batches": batches,
+    }
+    with open(args.output, "w") as fout:
+        json.dump(report, fout, indent=2, default=float)
+    for result in results:
+        print(f"{result['ions']:>12d} {result['job']:<22s} wall {result['wall_time']:8.3f} s  "
+              f"compute {result['compute']:8.3f} s  orchestration {result['orchestration']:8.3f} s")
+    return report
+
+
+if __name__ == "__main__":
+    main()
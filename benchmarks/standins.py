@@ -0,0 +1,190 @@
+"""
+Stand-ins for the paraprobe executables.
+
+Each stand-in reads the .pos/.rrng pair from the working directory, writes
+a results file with the datasets the job collectors read, and sleeps so
+that the run takes n_ions / PARAPROBE_STANDIN_RATE seconds, mimicking the
+throughput of the real tool. The results follow the layout constants of
+paraprobe_results and say nothing about whether those match the real tools,
+see check_layout.py for that. install_standins registers them as a pyiron
+resource, version "standin".
+
+Usage: python standins.py <tool> [simid]
+"""
+import glob
+import json
+import os
+import stat
+import sys
+import time
+
+import numpy as np
+import h5py
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "paraprobe_jobs"))
+from paraprobe_reader import read_pos, read_rrng, iterate_pos
+from paraprobe_results import (RANGER_IONTYPES, RANGER_ION_LABELS, RANGER_ISOTOPE_VECTOR,
+                               SURFACER_VERTICES, SURFACER_FACES, DISTANCER_DISTANCES, ELEMENT_SYMBOLS,
+                               NANOCHEM_ISOVALUE, NANOCHEM_OBJECT_VOLUME, NANOCHEM_OBJECT_EDGE_CONTACT,
+                               NANOCHEM_OBJECT_ION_COUNT)
+
+TOOLS = ["ranger", "surfacer", "distancer", "tessellator", "nanochem"]
+# ions per second of every stand-in
+DEFAULT_RATE = 1e7
+
+
+def _bounding_box(positions):
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for _, block in iterate_pos(positions):
+        lower = np.minimum(lower, block[:, :3].min(axis=0))
+        upper = np.maximum(upper, block[:, :3].max(axis=0))
+    return lower, upper
+
+
+def _distance_to_box(xyz, lower, upper):
+    return np.minimum(xyz - lower, upper - xyz).min(axis=1)
+
+
+def ranger(positions, rrng_file, simid):
+    table = read_rrng(rrng_file)
+    names = sorted(set(table.names))
+    # iontype 0 collects the unranged ions
+    range_to_iontype = np.array([0] + [names.index(name) + 1 for name in table.names])
+    with h5py.File(f"PARAPROBE.Ranger.Results.SimID.{simid}.h5", "w") as h5w:
+        group = h5w.create_group(RANGER_IONTYPES)
+        group.create_dataset(f"ion0/{RANGER_ISOTOPE_VECTOR}", data=np.zeros(8, dtype=np.uint16))
+        for i, name in enumerate(names):
+            composition = table.compositions[table.names.index(name)]
+            vector = [ELEMENT_SYMBOLS.index(element) for element, count in composition.items()
+                      for _ in range(count)]
+            group.create_dataset(f"ion{i + 1}/{RANGER_ISOTOPE_VECTOR}",
+                                 data=np.array(vector + [0] * (8 - len(vector)), dtype=np.uint16))
+        labels = h5w.create_dataset(RANGER_ION_LABELS, shape=(len(positions),), dtype=np.uint8,
+                                    chunks=(min(2**20, max(len(positions), 1)),))
+        for start, block in iterate_pos(positions):
+            labels[start:start + len(block)] = range_to_iontype[table.label(block[:, 3]) + 1]
+
+
+def surfacer(positions, rrng_file, simid):
+    lower, upper = _bounding_box(positions)
+    corners = np.array([[x, y, z] for x in (lower[0], upper[0])
+                        for y in (lower[1], upper[1]) for z in (lower[2], upper[2])], dtype=np.float32)
+    faces = np.array([[0, 1, 3], [0, 3, 2], [4, 6, 7], [4, 7, 5], [0, 4, 5], [0, 5, 1],
+                      [2, 3, 7], [2, 7, 6], [0, 2, 6], [0, 6, 4], [1, 5, 7], [1, 7, 3]], dtype=np.uint32)
+    with h5py.File(f"PARAPROBE.Surfacer.Results.SimID.{simid}.h5", "w") as h5w:
+        h5w.create_dataset(SURFACER_VERTICES, data=corners)
+        h5w.create_dataset(SURFACER_FACES, data=faces)
+
+
+def distancer(positions, rrng_file, simid):
+    lower, upper = _bounding_box(positions)
+    with h5py.File(f"PARAPROBE.Distancer.Results.SimID.{simid}.h5", "w") as h5w:
+        distances = h5w.create_dataset(DISTANCER_DISTANCES, shape=(len(positions),), dtype=np.float32,
+                                       chunks=(min(2**20, max(len(positions), 1)),))
+        for start, block in iterate_pos(positions):
+            distances[start:start + len(block)] = _distance_to_box(block[:, :3], lower, upper)
+
+
+def tessellator(positions, rrng_file, simid):
+    import paraprobe_autoreporter.metadata.h5tessellator as nx
+    lower, upper = _bounding_box(positions)
+    mean_volume = np.prod(upper - lower) / max(len(positions), 1)
+    rng = np.random.default_rng(0)
+    grpnm = nx.MYTESS + str(simid) + nx.MYTESS_DATA_VORO_TSKS + '/0'
+    chunks = (min(2**20, max(len(positions), 1)), 1)
+    with h5py.File(f"PARAPROBE.Tessellator.Results.SimID.{simid}.h5", "w") as h5w:
+        volume = h5w.create_dataset(grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_CVOL,
+                                    shape=(len(positions), 1), dtype=np.float32, chunks=chunks)
+        wall = h5w.create_dataset(grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_WALLCONTACT,
+                                  shape=(len(positions), 1), dtype=np.uint8, chunks=chunks)
+        for start, block in iterate_pos(positions):
+            volume[start:start + len(block), 0] = rng.gamma(4., mean_volume / 4., len(block))
+            wall[start:start + len(block), 0] = _distance_to_box(block[:, :3], lower, upper) < 1.
+
+
+def _voxel_fraction(positions, table, elements, lower, shape, grid):
+    """
+    Ions and atomic fraction of the elements per voxel, without smoothing
+    """
+    n_voxels = int(np.prod(shape))
+    # atoms per range, index 0 is unranged
+    range_atoms = np.array([0] + [sum(c.values()) for c in table.compositions], dtype=np.float64)
+    range_selected = np.array([0] + [sum(n for element, n in c.items() if element in elements)
+                                     for c in table.compositions], dtype=np.float64)
+    ions = np.zeros(n_voxels)
+    atoms = np.zeros(n_voxels)
+    selected = np.zeros(n_voxels)
+    for _, block in iterate_pos(positions):
+        voxel = np.minimum(((block[:, :3] - lower) / grid).astype(np.int64), shape - 1)
+        flat = np.ravel_multi_index(voxel.T, shape)
+        ranges = table.label(block[:, 3]) + 1
+        ions += np.bincount(flat, minlength=n_voxels)
+        atoms += np.bincount(flat, weights=range_atoms[ranges], minlength=n_voxels)
+        selected += np.bincount(flat, weights=range_selected[ranges], minlength=n_voxels)
+    fraction = np.divide(selected, atoms, out=np.zeros(n_voxels), where=atoms > 0)
+    return ions.reshape(shape), fraction.reshape(shape)
+
+
+def nanochem(positions, rrng_file, simid):
+    from scipy import ndimage
+    # written by ParaprobeNanochem next to the configuration
+    settings = {"tasks": [{"elements": ["Y", "Ti", "O"], "grid_resolution": 1., "kernel_sigma": 1.}],
+                "isovalues": np.linspace(0.01, 0.21, 21).tolist()}
+    if os.path.exists("nanochem_tasks.json"):
+        with open("nanochem_tasks.json", "r") as fin:
+            settings = json.load(fin)
+    table = read_rrng(rrng_file)
+    lower, upper = _bounding_box(positions)
+    with h5py.File(f"PARAPROBE.Nanochem.Results.SimID.{simid}.h5", "w") as h5w:
+        h5w.create_group("/entry")
+        for task, parameters in enumerate(settings["tasks"]):
+            grid = parameters["grid_resolution"]
+            shape = np.maximum(np.ceil((upper - lower) / grid).astype(np.int64), 1)
+            ions, fraction = _voxel_fraction(positions, table, parameters["elements"], lower, shape, grid)
+            for isosurface, isovalue in enumerate(settings["isovalues"]):
+                names = {"task": task, "isosurface": isosurface}
+                h5w.create_dataset(NANOCHEM_ISOVALUE.format(**names), data=isovalue)
+                labels, n_objects = ndimage.label(fraction > isovalue)
+                if n_objects == 0:
+                    continue
+                voxels = np.bincount(labels.ravel(), minlength=n_objects + 1)[1:]
+                object_ions = np.bincount(labels.ravel(), weights=ions.ravel(), minlength=n_objects + 1)[1:]
+                border = np.concatenate([labels[[0, -1]].ravel(), labels[:, [0, -1]].ravel(),
+                                         labels[:, :, [0, -1]].ravel()])
+                h5w.create_dataset(NANOCHEM_OBJECT_VOLUME.format(**names), data=voxels * grid**3)
+                h5w.create_dataset(NANOCHEM_OBJECT_EDGE_CONTACT.format(**names),
+                                   data=np.isin(np.arange(1, n_objects + 1), border).astype(np.uint8))
+                h5w.create_dataset(NANOCHEM_OBJECT_ION_COUNT.format(**names), data=object_ions.astype(np.int64))
+
+
+def main(argv):
+    tool = argv[1]
+    simid = argv[2] if len(argv) > 2 else "636502001"
+    rate = float(os.environ.get("PARAPROBE_STANDIN_RATE", DEFAULT_RATE))
+    start = time.time()
+    positions = read_pos(sorted(glob.glob("*.pos"))[0])
+    rrng_file = sorted(glob.glob("*.rrng"))[0]
+    print(f"paraprobe-{tool} stand-in, {len(positions)} ions")
+    globals()[tool](positions, rrng_file, simid)
+    time.sleep(max(len(positions) / rate - (time.time() - start), 0.))
+    print(f"paraprobe-{tool} stand-in done after {time.time() - start:.3f} s")
+
+
+def install_standins(resource_directory):
+    """
+    Write pyiron run scripts paraprobe-<tool>/bin/run_paraprobe-<tool>_standin.sh
+    """
+    for tool in TOOLS:
+        bin_directory = os.path.join(resource_directory, f"paraprobe-{tool}", "bin")
+        os.makedirs(bin_directory, exist_ok=True)
+        script = os.path.join(bin_directory, f"run_paraprobe-{tool}_standin.sh")
+        with open(script, "w") as fout:
+            fout.write("#!/bin/bash\n")
+            fout.write(f"{sys.executable} {os.path.abspath(__file__)} {tool} > log.out 2>&1\n")
+        os.chmod(script, os.stat(script).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return resource_directory
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,100 @@
+"""
+Synthetic atom probe datasets for benchmarking the paraprobe jobs.
+
+The specimen is a cylinder of height 4 r filled with ions of a matrix
+composition. Spherical precipitates of a second composition sit in the
+centres of randomly chosen cells of a cubic grid, so that nanochem finds
+objects. A small fraction of the ions is uniform background noise in the
+mass-to-charge spectrum.
+"""
+import os
+import numpy as np
+
+# mass-to-charge peak of every molecular ion, in Da
+PEAKS = {
+    "Fe": 28.0,
+    "Cr": 26.0,
+    "Ti": 24.0,
+    "Y": 29.6,
+    "O": 16.0,
+    "YO": 52.5,
+}
+# element multiplicities of the molecular ions
+IONS = {
+    "Fe": {"Fe": 1},
+    "Cr": {"Cr": 1},
+    "Ti": {"Ti": 1},
+    "Y": {"Y": 1},
+    "O": {"O": 1},
+    "YO": {"Y": 1, "O": 1},
+}
+MATRIX = {"Fe": 0.88, "Cr": 0.1, "Ti": 0.005, "Y": 0.005, "O": 0.01}
+PRECIPITATE = {"Fe": 0.3, "Cr": 0.05, "Ti": 0.2, "Y": 0.15, "O": 0.2, "YO": 0.1}
+
+
+def write_rrng(filename, half_width=0.2):
+    with open(filename, "w") as fout:
+        fout.write("[Ions]\n")
+        fout.write(f"Number={len(PEAKS)}\n")
+        for i, name in enumerate(PEAKS):
+            fout.write(f"Ion{i + 1}={name}\n")
+        fout.write("[Ranges]\n")
+        fout.write(f"Number={len(PEAKS)}\n")
+        for i, (name, peak) in enumerate(PEAKS.items()):
+            composition = " ".join(f"{element}:{count}" for element, count in IONS[name].items())
+            fout.write(f"Range{i + 1}={peak - half_width:.4f} {peak + half_width:.4f} "
+                       f"Vol:0.01000 {composition} Color:FF0000\n")
+
+
+def _sample_mass_to_charge(rng, composition, n, peak_width=0.05):
+    names = list(composition)
+    fractions = np.array([composition[name] for name in names], dtype=np.float64)
+    choice = rng.choice(len(names), size=n, p=fractions / fractions.sum())
+    peaks = np.array([PEAKS[name] for name in names])
+    return peaks[choice] + rng.normal(0., peak_width, size=n)
+
+
+def generate_dataset(directory, n_ions, name="synthetic", density=25., precipitate_radius=1.5,
+                     precipitate_spacing=10., precipitate_probability=0.3, noise_fraction=0.01,
+                     matrix=None, precipitate=None, chunk_size=2**22, seed=0):
+    """
+    Write <name>.pos and <name>.rrng with n_ions ions (density in ions/nm^3)
+    into directory, chunk by chunk so that memory stays bounded for 1e8 ions
+
+    Returns the paths of the .pos and .rrng files.
+    """
+    matrix = MATRIX if matrix is None else matrix
+    precipitate = PRECIPITATE if precipitate is None else precipitate
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    pos_file = os.path.join(directory, f"{name}.pos")
+    rrng_file = os.path.join(directory, f"{name}.rrng")
+    write_rrng(rrng_file)
+
+    radius = (n_ions / (density * 4 * np.pi))**(1. / 3.)
+    height = 4 * radius
+    cells = np.ceil(np.array([2 * radius, 2 * radius, height]) / precipitate_spacing).astype(np.int64)
+    occupied = rng.random(cells) < precipitate_probability
+
+    with open(pos_file, "wb") as fout:
+        for start in range(0, n_ions, chunk_size):
+            n = min(chunk_size, n_ions - start)
+            r = radius * np.sqrt(rng.random(n))
+            phi = 2 * np.pi * rng.random(n)
+            xyz = np.column_stack([r * np.cos(phi), r * np.sin(phi), height * rng.random(n)])
+
+            # grid cell relative to the lower corner of the specimen's bounding box
+            shifted = xyz + np.array([radius, radius, 0.])
+            cell = np.minimum((shifted // precipitate_spacing).astype(np.int64), cells - 1)
+            centre = (cell + 0.5) * precipitate_spacing
+            inside = occupied[cell[:, 0], cell[:, 1], cell[:, 2]] \
+                & (np.linalg.norm(shifted - centre, axis=1) < precipitate_radius)
+
+            mass_to_charge = _sample_mass_to_charge(rng, matrix, n)
+            mass_to_charge[inside] = _sample_mass_to_charge(rng, precipitate, np.count_nonzero(inside))
+            noise = rng.random(n) < noise_fraction
+            mass_to_charge[noise] = rng.uniform(1., 100., np.count_nonzero(noise))
+
+            block = np.column_stack([xyz, mass_to_charge]).astype(">f4")
+            fout.write(block.tobytes())
+    return pos_file, rrng_file
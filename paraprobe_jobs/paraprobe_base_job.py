@@ -1,44 +1,69 @@
+import contextlib
 import os
 import numpy as np
 import shutil
 import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
+from paraprobe_staging import stage_file
+from paraprobe_context import ExecutionContext
+from paraprobe_cache import hash_file, hash_configuration, paraprobe_version
+from paraprobe_logs import ingest_log
+from paraprobe_memory import PeakRssSampler
 
-def _pipe_output_to_file(filename):
-    def _wrapper(method):
-        """
-        This is a temporary fix until paraprobe input outputs etc can be fixed
-        """
-        def change_stdout(self):
-            orig_stdout = sys.stdout
-            outfile = os.path.join(self.working_directory, filename)
-            f = open(outfile, 'w')
-            sys.stdout = f
-            method(self)
-            sys.stdout = orig_stdout
-            f.close()
-        return change_stdout
-    return _wrapper
+def _h5web(filename):
+    """
+    H5Web view of a file, the notebook widget is only imported when shown
+    """
+    from jupyterlab_h5web import H5Web
+    return H5Web(filename)
 
-def _change_directory(method):
+def _record_performance(phase):
     """
-    Temporarily switch directory
+    Record wall time, peak RSS and I/O of a method in output["perf/<phase>"]
     """
-    def change_dir(self):
-        os.chdir(self.working_directory)
-        method(self)
-        os.chdir(self._current_dir)            
-    return change_dir
+    def _wrapper(method):
+        def measured(self, *args, **kwargs):
+            with self._measure(phase):
+                return method(self, *args, **kwargs)
+        return measured
+    return _wrapper
+
+def _resource_usage():
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
 
     
 class ParaprobeBase(GenericJob):
+    # attributes which are restored when the job is loaded again, subclasses
+    # add the names of their config and result files
+    _stored_attributes = ("_pos_file", "_rrng_file")
+    # input entries which do not change the results
+    _unhashed_input = ("staging", "cache", "cache_max_bytes", "preflight", "isolation",
+                       "log_head_lines", "log_tail_lines")
+    # result file attribute: groups or datasets a complete result file contains
+    _result_groups = {}
+
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self.input = DataContainer(table_name="input")
         self.output = DataContainer(table_name="output")
         self.input.input_path = None
+        self.input.staging = "auto"
+        # process: run the paraprobe setup steps in a worker process,
+        # thread: in this process, one job at a time
+        self.input.isolation = "process"
+        # lines of every log kept in output["log"], the full logs are
+        # compressed next to the results
+        self.input.log_head_lines = 50
+        self.input.log_tail_lines = 200
         #self.executable = f"mpiexec -n $1 paraprobe_ranger 636502001 {self.working_directory}/PARAPROBE.Ranger.Config.SimID.636502001.nxs;"
         self._executable = None
         self._executable_activate()
@@ -46,15 +71,90 @@ class ParaprobeBase(GenericJob):
         self.jobid = 636502001
         self._pos_file = None
         self._rrng_file = None
-        self._current_dir = os.getcwd()
+        self._skip_execution = False
 
     def _copy_file(self, filename):
         if os.path.exists(filename):
-            shutil.copy(filename, self.working_directory)
-            return os.path.basename(filename)
+            # too short to sample, the peak RSS is the one of getrusage
+            with self._measure("staging", sample_memory=False):
+                method, nbytes = stage_file(filename, self.working_directory, mode=self.input.staging)
+            self.output["perf/staging/bytes_staged"] = self.output.get("perf/staging/bytes_staged", 0) + nbytes
+            basename = os.path.basename(filename)
+            key = "bytes_copied" if method == "copy" else "bytes_avoided"
+            self.output[f"staging/{key}"] = self.output.get(f"staging/{key}", 0) + nbytes
+            self.output[f"staging/files/{basename}"] = method
+            return basename
         else:
             raise FileNotFoundError(f"file {filename} not found")
             
+    @property
+    def execution_context(self):
+        return ExecutionContext(self.working_directory, isolate=self.input.isolation == "process",
+                                workers=self.server.cores)
+
+    @property
+    def stage_name(self):
+        return self.__class__.__name__[len("Paraprobe"):].lower()
+
+    @contextlib.contextmanager
+    def _measure(self, phase, sample_memory=True):
+        """
+        Add the wall time, the peak RSS and the block I/O of the enclosed
+        code to output["perf/<phase>"], repeated measurements of a phase
+        accumulate.
+
+        The peak RSS is the one of the largest process running in the
+        working directory of this job during the phase, e.g. the paraprobe
+        executable, see PeakRssSampler. Without sample_memory, or without
+        /proc, it is the largest ru_maxrss of this process and its children.
+        Block I/O is process wide, stages running concurrently in the same
+        interpreter are not separated.
+        """
+        before = _resource_usage()
+        sampler = PeakRssSampler(self.working_directory) if sample_memory and PeakRssSampler.available else None
+        start = time.perf_counter()
+        try:
+            if sampler is None:
+                yield
+            else:
+                with sampler:
+                    yield
+        finally:
+            key = f"perf/{phase}"
+            self.output[f"{key}/wall_time"] = self.output.get(f"{key}/wall_time", 0.) + time.perf_counter() - start
+            after = _resource_usage()
+            if sampler is not None:
+                peak_rss = sampler.peak_rss
+            elif after is not None:
+                # ru_maxrss is given in kB on Linux, the lifetime maximum of
+                # this process or of any child process
+                peak_rss = max(after[0].ru_maxrss, after[1].ru_maxrss) * 1024
+            else:
+                peak_rss = None
+            if peak_rss is not None:
+                self.output[f"{key}/peak_rss"] = max(self.output.get(f"{key}/peak_rss", 0), peak_rss)
+            if after is not None:
+                (self_before, children_before), (self_after, children_after) = before, after
+                # block I/O is counted in units of 512 bytes
+                for name, attribute in [("bytes_read", "ru_inblock"), ("bytes_written", "ru_oublock")]:
+                    nbytes = 512 * (getattr(self_after, attribute) - getattr(self_before, attribute)
+                                    + getattr(children_after, attribute) - getattr(children_before, attribute))
+                    self.output[f"{key}/{name}"] = self.output.get(f"{key}/{name}", 0) + nbytes
+
+    def run_static(self):
+        if self._skip_execution:
+            self.status.collect = True
+            self.run()
+        else:
+            with self._measure(f"execute/{self.stage_name}"):
+                super().run_static()
+            # the executable run ends with collect_output, which is
+            # recorded on its own
+            collect_time = self.output.get(f"perf/collect/{self.stage_name}/wall_time", 0.)
+            self.output[f"perf/execute/{self.stage_name}/wall_time"] -= collect_time
+        # output and file names are only known after collect_output
+        self.to_hdf()
+
     def _read_temporary_output_file(self, filename, clean=True):
         outfile = os.path.join(self.working_directory, filename)
         if clean:
@@ -68,6 +168,71 @@ class ParaprobeBase(GenericJob):
                 lines = fin.read()
         return lines
 
+    def monitor(self, interval=2., callback=None, timeout=None):
+        """
+        Watch the progress of the running stage jobs, see ProgressMonitor
+        """
+        from paraprobe_monitor import ProgressMonitor
+        return ProgressMonitor.for_job(self).watch(interval=interval, callback=callback, timeout=timeout)
+
+    def _ingest_logs(self, logs):
+        """
+        Compress the logs {output key: filename} and store their head and
+        tail in output["log/<key>"], the compressed file in
+        output["log/files/<key>"] and their timing lines in the table
+        output["log/phases"]
+        """
+        phases = {"log": [], "phase": [], "seconds": []}
+        for key, filename in logs.items():
+            summary = ingest_log(os.path.join(self.working_directory, filename),
+                                 head_lines=self.input.log_head_lines, tail_lines=self.input.log_tail_lines)
+            self.output[f"log/{key}"] = summary["text"]
+            self.output[f"log/files/{key}"] = summary["file"]
+            self.output[f"log/lines/{key}"] = summary["lines"]
+            for phase, seconds in summary["phases"]:
+                phases["log"].append(key)
+                phases["phase"].append(phase)
+                phases["seconds"].append(seconds)
+        self.output["log/phases/log"] = phases["log"]
+        self.output["log/phases/phase"] = phases["phase"]
+        self.output["log/phases/seconds"] = np.array(phases["seconds"])
+
+    def get_input_hash(self, upstream_hashes=()):
+        """
+        Hash of everything the results of this stage depend on: the input
+        files, the stage configuration and the hashes of the upstream stages
+        """
+        configuration = {key: value for key, value in self.input.to_builtin().items()
+                         if key not in self._unhashed_input}
+        return hash_configuration({
+            "stage": self.__class__.__name__,
+            "paraprobe": paraprobe_version(),
+            "jobid": self.jobid,
+            "input": configuration,
+            "pos": hash_file(self.pos_file),
+            "rrng": hash_file(self.rrng_file),
+            "upstream": list(upstream_hashes),
+        })
+
+    def validate_results(self):
+        """
+        Check that all result files are present, readable and contain the
+        expected groups
+        """
+        import h5py
+        for attribute, paths in self._result_groups.items():
+            filename = getattr(self, attribute, None)
+            if filename is None:
+                return False
+            filename = os.path.join(self.working_directory, filename)
+            try:
+                with h5py.File(filename, "r") as h5r:
+                    if not all(path in h5r for path in paths):
+                        return False
+            except OSError:
+                return False
+        return True
+
     @property
     def pos_file(self):
         return self._pos_file
@@ -91,6 +256,12 @@ class ParaprobeBase(GenericJob):
         )
         with self.project_hdf5.open("input") as h5in:
             self.input.to_hdf(h5in)
+        with self.project_hdf5.open("output") as h5out:
+            self.output.to_hdf(h5out)
+        self.project_hdf5["stored_attributes"] = {
+            name: getattr(self, name) for name in self._stored_attributes
+            if getattr(self, name, None) is not None
+        }
 
     def from_hdf(self, hdf=None, group_name=None): 
         super().from_hdf(
@@ -99,6 +270,12 @@ class ParaprobeBase(GenericJob):
         )
         with self.project_hdf5.open("input") as h5in:
             self.input.from_hdf(h5in)
+        if "output" in self.project_hdf5.list_groups():
+            with self.project_hdf5.open("output") as h5out:
+                self.output.from_hdf(h5out)
+        if "stored_attributes" in self.project_hdf5.list_nodes():
+            for name, value in self.project_hdf5["stored_attributes"].items():
+                setattr(self, name, value)
 
     @property
     def publication(self):
@@ -0,0 +1,314 @@
+import glob
+import json
+import multiprocessing
+import os
+import re
+import time
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from pyiron_base import Project
+from paraprobe_base_job import ParaprobeBase
+from paraprobe_job import ParaprobeJob, _STAGES
+
+# output of the stage jobs which does not go into the results table
+_EXCLUDED_OUTPUT = ("log", "perf", "staging", "input_hash")
+# status of a queued job which does not change any more
+_ENDED = ("finished", "aborted", "not_converged", "warning", "suspended")
+
+
+def _run_member(project_path, job_name, resume=False):
+    """
+    Run a job and return its wall time
+    """
+    job = Project(project_path).load(job_name)
+    start = time.perf_counter()
+    if resume:
+        job.resume()
+    else:
+        job.run()
+    return time.perf_counter() - start
+
+
+def _run_queued(project_path, job_names, concurrency, resume, poll_interval, max_wait):
+    """
+    Submit the jobs to their queue, at most concurrency at a time, and poll
+    their status. pyiron installs signal handlers around a run, which only
+    the main thread may do, so the jobs are submitted from here.
+    """
+    project = Project(project_path)
+    pending, running = list(job_names), {}
+    wall_times, errors = {}, {}
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < concurrency:
+            job_name = pending.pop(0)
+            job = project.load(job_name)
+            try:
+                if resume:
+                    job.resume()
+                else:
+                    job.run()
+            except Exception as error:
+                errors[job_name] = repr(error)
+                continue
+            running[job_name] = (job, time.perf_counter())
+        for job_name, (job, start) in list(running.items()):
+            job.refresh_job_status()
+            if job.status.string in _ENDED:
+                wall_times[job_name] = time.perf_counter() - start
+            elif time.perf_counter() - start > max_wait:
+                errors[job_name] = f"no result after {max_wait} s, status {job.status.string}"
+            else:
+                continue
+            del running[job_name]
+        if len(running) > 0:
+            time.sleep(poll_interval)
+    return wall_times, errors
+
+
+def run_jobs(project_path, job_names, mode="pool", concurrency=1, resume=False, poll_interval=30,
+             max_wait=7 * 24 * 3600):
+    """
+    Run saved jobs of a project, at most concurrency at a time, in a local
+    process pool (mode="pool") or submitted to their queue and waited for
+    (mode="queue"). Returns the wall time of every job which ran and the
+    error of every job which raised.
+    """
+    if mode == "queue":
+        return _run_queued(project_path, job_names, concurrency, resume, poll_interval, max_wait)
+    if mode != "pool":
+        raise ValueError(f"Unknown mode {mode}, choose pool or queue")
+    wall_times, errors = {}, {}
+    with ProcessPoolExecutor(max_workers=concurrency, mp_context=multiprocessing.get_context("spawn")) as executor:
+        futures = {executor.submit(_run_member, project_path, job_name, resume): job_name
+                   for job_name in job_names}
+        for future in as_completed(futures):
+            job_name = futures[future]
+            try:
+                wall_times[job_name] = future.result()
+            except Exception as error:
+                errors[job_name] = repr(error)
+    return wall_times, errors
+
+
+def _scalar_output(output, prefix=""):
+    for key, value in output.items():
+        if prefix == "" and key in _EXCLUDED_OUTPUT:
+            continue
+        if isinstance(value, Mapping):
+            yield from _scalar_output(value, prefix=f"{prefix}{key}/")
+        elif isinstance(value, (bool, int, float, np.number)):
+            yield prefix + key, float(value)
+
+
+def _stage_columns(stage, output):
+    """
+    Scalar output of a stage job as columns under the stage name, outputs
+    of several stages may share names, e.g. prefilter or crosscheck
+    """
+    for key, value in _scalar_output(output):
+        yield (key if key.split("/")[0] == stage else f"{stage}/{key}"), value
+
+
+def _iterate_columns(table, prefix=""):
+    for key, value in table.items():
+        if isinstance(value, Mapping):
+            yield from _iterate_columns(value, prefix=f"{prefix}{key}/")
+        else:
+            yield prefix + key, value
+
+
+class ParaprobeBatch(ParaprobeBase):
+    """
+    Run a campaign of specimens, one ParaprobeJob per manifest entry.
+
+    The pipeline jobs run in a local process pool (input.mode = "pool") or
+    are submitted to input.queue (input.mode = "queue"), at most
+    input.concurrency at a time with input.cores_per_job cores each. Failed
+    members are resumed up to input.retries times. Scalar results of all
+    stage jobs end up in one table, with columns <stage>/<output key>, see
+    results_table.
+
+    Stage jobs are found again by their input hash, rerunning a batch only
+    repeats the stages of members which failed or changed.
+    """
+    def __init__(self, project, job_name):
+        super().__init__(project, job_name)
+        self.input.manifest = {}
+        self.input.mode = "pool"
+        self.input.queue = None
+        self.input.concurrency = 1
+        self.input.cores_per_job = 1
+        self.input.retries = 1
+        # queue mode: seconds between status checks and until a member is
+        # given up
+        self.input.poll_interval = 30
+        self.input.max_wait = 7 * 24 * 3600
+        self._wall_times = {}
+
+    def add_specimen(self, pos_file, rrng_file, name=None, stages=None, parameters=None):
+        """
+        Add a specimen to the manifest
+
+        stages: stages to analyse, all by default
+        parameters: input of the pipeline job and its stage jobs, e.g.
+            {"pipeline": {"cache": True}, "tessellator": {"relative_accuracy": 0.02}}
+        """
+        if name is None:
+            name = os.path.splitext(os.path.basename(pos_file))[0]
+        name = re.sub(r"\W", "_", name)
+        if name in self.input.manifest:
+            raise ValueError(f"Specimen {name} is already in the manifest")
+        stages = list(_STAGES) if stages is None else list(stages)
+        unknown = [stage for stage in stages if stage not in _STAGES]
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown stages {unknown}, choose from {list(_STAGES)}")
+        self.input.manifest[name] = {
+            "pos": os.path.abspath(pos_file),
+            "rrng": os.path.abspath(rrng_file),
+            "stages": stages,
+            "parameters": {} if parameters is None else parameters,
+        }
+
+    def add_directory(self, directory, stages=None, parameters=None):
+        """
+        Add every .pos file of a directory, with the .rrng file of the same
+        name or else the only .rrng file of the directory
+        """
+        rrng_files = sorted(glob.glob(os.path.join(directory, "*.rrng")))
+        for pos_file in sorted(glob.glob(os.path.join(directory, "*.pos"))):
+            rrng_file = os.path.splitext(pos_file)[0] + ".rrng"
+            if not os.path.exists(rrng_file):
+                if len(rrng_files) != 1:
+                    raise ValueError(f"No unique .rrng file for {pos_file}")
+                rrng_file = rrng_files[0]
+            self.add_specimen(pos_file, rrng_file, stages=stages, parameters=parameters)
+
+    def read_manifest(self, filename):
+        """
+        Add the entries of a json manifest, a list of objects with the keys
+        pos, rrng and optionally name, stages and parameters
+        """
+        with open(filename, "r") as fin:
+            entries = json.load(fin)
+        directory = os.path.dirname(os.path.abspath(filename))
+        for entry in entries:
+            # paths are relative to the manifest
+            self.add_specimen(os.path.join(directory, entry["pos"]),
+                              os.path.join(directory, entry["rrng"]),
+                              name=entry.get("name"),
+                              stages=entry.get("stages"),
+                              parameters=entry.get("parameters"))
+
+    @property
+    def specimens(self):
+        return list(self.input.manifest.keys())
+
+    def _member_name(self, name):
+        return f"{self.job_name}_{name}"
+
+    def load_member(self, name):
+        return self.project.load(self._member_name(name))
+
+    def _create_member(self, name):
+        entry = self.input.manifest[name].to_builtin()
+        job = self.project.create_job(job_type=ParaprobeJob, job_name=self._member_name(name),
+                                      delete_existing_job=True)
+        job.pos_file = entry["pos"]
+        job.rrng_file = entry["rrng"]
+        for stage in entry["stages"]:
+            getattr(job, f"analyse_{stage}")()
+        job.input.staging = self.input.staging
+        for group, values in entry["parameters"].items():
+            for key, value in values.items():
+                if group == "pipeline":
+                    job.input[key] = value
+                else:
+                    job.input[f"parameters/{group}/{key}"] = value
+        job.server.cores = self.input.cores_per_job
+        if self.input.mode == "queue":
+            job.server.queue = self.input.queue
+        job.save()
+
+    def _run_members(self, names, resume):
+        """
+        Run the members and return the errors of those which did not finish
+        """
+        wall_times, errors = run_jobs(self.project.path, [self._member_name(name) for name in names],
+                                      mode=self.input.mode, concurrency=self.input.concurrency, resume=resume,
+                                      poll_interval=self.input.poll_interval, max_wait=self.input.max_wait)
+        errors = {name: errors[self._member_name(name)] for name in names if self._member_name(name) in errors}
+        for name in names:
+            if name in errors:
+                continue
+            self._wall_times[name] = self._wall_times.get(name, 0.) + wall_times[self._member_name(name)]
+            status = self.load_member(name).status
+            if not status.finished:
+                errors[name] = f"status {status.string}"
+        return errors
+
+    def run_static(self):
+        self.status.running = True
+        names = self.specimens
+        for name in names:
+            self._create_member(name)
+        attempts = {name: 0 for name in names}
+        errors = {}
+        pending = names
+        start = time.perf_counter()
+        for attempt in range(self.input.retries + 1):
+            if len(pending) == 0:
+                break
+            errors = self._run_members(pending, resume=attempt > 0)
+            for name in pending:
+                attempts[name] += 1
+            pending = [name for name in names if name in errors]
+        wall_time = time.perf_counter() - start
+
+        finished = len(names) - len(errors)
+        self.output["throughput/wall_time"] = wall_time
+        self.output["throughput/finished"] = finished
+        self.output["throughput/failed"] = len(errors)
+        self.output["throughput/specimens_per_hour"] = 3600. * finished / wall_time if wall_time > 0 else 0.
+        self.output["table/name"] = names
+        self.output["table/status"] = ["failed" if name in errors else "finished" for name in names]
+        self.output["table/error"] = [errors.get(name, "") for name in names]
+        self.output["table/attempts"] = np.array([attempts[name] for name in names])
+        self.output["table/wall_time"] = np.array([self._wall_times.get(name, np.nan) for name in names])
+        # run() collects the output and finishes the job
+        self.status.collect = True
+        self.run()
+        self.to_hdf()
+
+    def collect_output(self):
+        self._collect_table(list(self.output["table/name"]))
+
+    def _collect_table(self, names):
+        """
+        One row per specimen with the scalar output of its stage jobs,
+        missing values are NaN
+        """
+        rows = []
+        for name in names:
+            row = {}
+            member = self.load_member(name)
+            for stage in member._selected_stages():
+                job = member.get_stage_job(stage)
+                if job is not None:
+                    row.update(_stage_columns(stage, job.output))
+            rows.append(row)
+        columns = sorted(set().union(*rows))
+        for column in columns:
+            self.output[f"table/values/{column}"] = np.array([row.get(column, np.nan) for row in rows])
+
+    @property
+    def results_table(self):
+        import pandas
+        table = self.output["table"]
+        data = {column: list(table[column]) for column in ["name", "status", "error", "attempts", "wall_time"]}
+        if "values" in table:
+            for column, values in _iterate_columns(table["values"]):
+                data[column] = list(values)
+        return pandas.DataFrame(data)
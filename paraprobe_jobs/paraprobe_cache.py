@@ -0,0 +1,196 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from paraprobe_staging import stage_file
+
+
+# hashes of files which did not change since they were last hashed
+_file_hashes = {}
+
+
+def hash_file(filename, chunk_size=2**24):
+    """
+    Content hash of a file, read in chunks so that memory stays constant
+    """
+    info = os.stat(filename)
+    key = (os.path.abspath(filename), info.st_size, info.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.blake2b(digest_size=20)
+        with open(filename, "rb") as fin:
+            for block in iter(lambda: fin.read(chunk_size), b""):
+                digest.update(block)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def hash_configuration(configuration):
+    """
+    Hash of a json serialisable configuration, independent of key order
+    """
+    text = json.dumps(configuration, sort_keys=True, default=str)
+    return hashlib.blake2b(text.encode(), digest_size=20).hexdigest()
+
+
+def paraprobe_version():
+    from importlib import metadata
+    for distribution in ["paraprobe", "paraprobe-parmsetup", "paraprobe_parmsetup"]:
+        try:
+            return metadata.version(distribution)
+        except metadata.PackageNotFoundError:
+            continue
+    return "unknown"
+
+
+class ResultCache:
+    """
+    Content addressed store of paraprobe result files shared by all jobs of a
+    project. Every entry is a directory named by its key, the index keeps the
+    size and last access time of each entry and the hit/miss counters. Once
+    the total size exceeds `max_bytes` the least recently used entries are
+    evicted.
+    """
+    def __init__(self, directory, max_bytes=50 * 2**30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self._index_file = os.path.join(directory, "index.json")
+        self._lock_file = os.path.join(directory, "index.lock")
+
+    @contextlib.contextmanager
+    def _index(self):
+        """
+        The index, held under an exclusive lock of the cache directory and
+        written back when the block ends. Entry directories are only replaced
+        or removed under this lock.
+        """
+        with open(self._lock_file, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.exists(self._index_file):
+                with open(self._index_file, "r") as fin:
+                    index = json.load(fin)
+            else:
+                index = {"entries": {}, "hits": 0, "misses": 0}
+            yield index
+            tmpfile = self._index_file + ".tmp"
+            with open(tmpfile, "w") as fout:
+                json.dump(index, fout)
+            os.replace(tmpfile, self._index_file)
+
+    @property
+    def statistics(self):
+        with self._index() as index:
+            return {
+                "hits": index["hits"],
+                "misses": index["misses"],
+                "entries": len(index["entries"]),
+                "bytes": sum(entry["bytes"] for entry in index["entries"].values()),
+            }
+
+    def _lookup(self, index, key):
+        entry = index["entries"].get(key)
+        if entry is not None and not all(
+                os.path.exists(os.path.join(self.directory, key, f)) for f in entry["files"]):
+            del index["entries"][key]
+            entry = None
+        if entry is None:
+            index["misses"] += 1
+        else:
+            index["hits"] += 1
+            entry["last_used"] = time.time()
+        return entry
+
+    def lookup(self, key):
+        """
+        Return the cached entry for `key` or None, and count the hit or miss
+        """
+        with self._index() as index:
+            return self._lookup(index, key)
+
+    def fetch(self, key, directory, mode="auto"):
+        """
+        Look up `key` and stage the files of its entry into `directory` under
+        the cache lock, so that the entry cannot be replaced or evicted in
+        between. Returns the entry or None.
+        """
+        with self._index() as index:
+            entry = self._lookup(index, key)
+            if entry is not None:
+                self._stage_entry(key, entry, directory, mode)
+            return entry
+
+    def store(self, key, filenames, artifacts=None):
+        """
+        Add files to the cache, reusing their data through reflinks or
+        hardlinks where the filesystem allows it. The files are staged into
+        a temporary directory which replaces the entry under the cache lock.
+        """
+        staging_directory = tempfile.mkdtemp(prefix=".store-", dir=self.directory)
+        nbytes = 0
+        try:
+            for filename in filenames:
+                for mode in ["reflink", "hardlink", "copy"]:
+                    try:
+                        _, size = stage_file(filename, staging_directory, mode=mode)
+                        break
+                    except OSError:
+                        if mode == "copy":
+                            raise
+                nbytes += size
+        except BaseException:
+            shutil.rmtree(staging_directory, ignore_errors=True)
+            raise
+        entry_directory = os.path.join(self.directory, key)
+        replaced = None
+        with self._index() as index:
+            if os.path.exists(entry_directory):
+                replaced = tempfile.mkdtemp(prefix=".replaced-", dir=self.directory)
+                os.rename(entry_directory, os.path.join(replaced, key))
+            os.rename(staging_directory, entry_directory)
+            index["entries"][key] = {
+                "files": [os.path.basename(f) for f in filenames],
+                "artifacts": artifacts or {},
+                "bytes": nbytes,
+                "last_used": time.time(),
+            }
+            self._evict(index, keep=key)
+        if replaced is not None:
+            # no reader can see the old entry any more
+            shutil.rmtree(replaced, ignore_errors=True)
+
+    def _stage_entry(self, key, entry, directory, mode):
+        methods = {}
+        for filename in entry["files"]:
+            method, _ = stage_file(os.path.join(self.directory, key, filename), directory, mode=mode)
+            methods[filename] = method
+        return methods
+
+    def materialize(self, key, entry, directory, mode="auto"):
+        """
+        Stage the files of a cached entry into `directory`, under the cache
+        lock
+        """
+        with self._index():
+            return self._stage_entry(key, entry, directory, mode)
+
+    def _evict(self, index, keep=None):
+        entries = index["entries"]
+        total = sum(entry["bytes"] for entry in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]["bytes"]
+            shutil.rmtree(os.path.join(self.directory, key), ignore_errors=True)
+            del entries[key]
@@ -0,0 +1,146 @@
+"""
+Setup steps of the paraprobe tools as plain functions, so that an
+ExecutionContext can run them in a worker process. The paraprobe modules are
+imported on call, a worker only loads what it runs.
+"""
+import importlib.util
+import os
+import numpy as np
+
+from paraprobe_results import SURFACER_VERTICES, SURFACER_FACES, DISTANCER_DISTANCES
+
+PARAPROBE_IMPORT_MESSAGE = (
+    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
+    "requirements. Please install it and try again."
+)
+
+
+def require_modules(*names):
+    """
+    Raise an ImportError if one of the modules is not installed, without
+    importing it, for an ImportAlarm of the job modules
+    """
+    missing = [name for name in names if importlib.util.find_spec(name) is None]
+    if len(missing) > 0:
+        raise ImportError(f"No module named {', '.join(missing)}")
+
+
+def configure_transcoder(working_directory, pos_file, rrng_file, jobid):
+    from paraprobe_parmsetup.transcoder_guru import ParmsetupTranscoder
+    transcoder = ParmsetupTranscoder()
+    return transcoder.load_reconstruction_and_ranging(
+        working_directory=working_directory,
+        reconstructed_dataset=pos_file,
+        ranging_definitions=rrng_file,
+        jobid=jobid)
+
+
+def execute_transcoder(transcoder_config):
+    from paraprobe_transcoder.paraprobe_transcoder import ParaprobeTranscoder
+    transcoder = ParaprobeTranscoder(transcoder_config)
+    return transcoder.execute()
+
+
+def configure_ranger(working_directory, jobid):
+    from paraprobe_parmsetup.ranger_guru import ParmsetupRanger
+    ranger = ParmsetupRanger()
+    return ranger.apply_existent_ranging(working_directory,
+                                         transcoder_config_sim_id=jobid,
+                                         transcoder_results_sim_id=jobid,
+                                         ranger_results_sim_id=jobid)
+
+
+def report_ranger(ranger_results, jobid):
+    from paraprobe_autoreporter.wizard.ranger_report import AutoReporterRanger
+    ranger_report = AutoReporterRanger(ranger_results, jobid)
+    ranger_report.get_summary()
+
+
+def configure_surfacer(working_directory, jobid):
+    from paraprobe_parmsetup.surfacer_guru import ParmsetupSurfacer
+    surfacer = ParmsetupSurfacer()
+    return surfacer.compute_convex_hull_edge_model(working_directory,
+                                                   transcoder_config_sim_id=jobid,
+                                                   transcoder_results_sim_id=jobid,
+                                                   ranger_results_sim_id=jobid,
+                                                   surfacer_results_sim_id=jobid)
+
+
+def configure_distancer(working_directory, jobid):
+    from paraprobe_parmsetup.distancer_guru import ParmsetupDistancer
+    distancer = ParmsetupDistancer()
+    return distancer.compute_ion_to_edge_model_distances(working_directory,
+                                                         transcoder_config_sim_id=jobid,
+                                                         transcoder_results_sim_id=jobid,
+                                                         ranger_results_sim_id=jobid,
+                                                         distancer_results_sim_id=jobid)
+
+
+def configure_tessellator(working_directory, jobid):
+    from paraprobe_parmsetup.tessellator_guru import ParmsetupTessellator
+    tessellator = ParmsetupTessellator()
+    return tessellator.compute_complete_voronoi_tessellation(working_directory,
+                                                             transcoder_config_sim_id=jobid,
+                                                             transcoder_results_sim_id=jobid,
+                                                             ranger_results_sim_id=jobid,
+                                                             distancer_results_sim_id=jobid,
+                                                             tessellator_results_sim_id=jobid)
+
+
+def nanochem_tasks(element_sets, grid_resolutions, kernel_sigmas):
+    """
+    One delocalization task per element set, grid resolution and kernel
+    sigma, element sets vary slowest
+    """
+    return [(list(elements), float(grid), float(sigma))
+            for elements in element_sets for grid in grid_resolutions for sigma in kernel_sigmas]
+
+
+def configure_nanochem(working_directory, jobid, tasks, kernel_size, isovalues, normalization="composition"):
+    """
+    Configure all delocalization tasks of a sweep for a single run, which
+    reads the reconstruction, the edge model and the distances once
+    """
+    from paraprobe_parmsetup.nanochem_guru import ParmsetupNanochem, NanochemTask, Delocalization
+    from paraprobe_parmsetup.utils.numerics import EPSILON
+    nanochem = ParmsetupNanochem()
+    dataset = NanochemTask()
+    dataset.load_reconstruction_and_ranging(
+        ranging_applied=True,
+        working_directory=working_directory,
+        transcoder_config_sim_id=jobid,
+        transcoder_results_sim_id=jobid,
+        ranger_results_sim_id=jobid)
+    dataset.load_edge_model(
+            file_name=os.path.join(working_directory, f'PARAPROBE.Surfacer.Results.SimID.{jobid}.h5'),
+            dataset_name_vertices=SURFACER_VERTICES,
+            dataset_name_facet_indices=SURFACER_FACES)
+    dataset.load_ion_to_edge_distances(
+            file_name=os.path.join(working_directory, f'PARAPROBE.Distancer.Results.SimID.{jobid}.h5'),
+            dataset_name=DISTANCER_DISTANCES)
+
+    for elements, grid, sigma in tasks:
+        task = Delocalization()
+        task.set_delocalization_input(source='default')
+        task.set_delocalization_normalization(method=normalization)
+        task.set_delocalization_elements(elements)
+        task.set_delocalization_gridresolutions(length=[grid])
+        task.set_delocalization_kernel(sigma=[sigma], size=kernel_size)
+        task.set_delocalization_isosurfaces(phi=np.asarray(isovalues))
+        task.set_delocalization_edge_handling(method='default')
+        task.set_delocalization_edge_threshold(EPSILON)
+        task.report_fields_and_gradients(True)
+        task.report_triangle_soup(True)
+        task.report_objects(True)
+        task.report_objects_properties(True)
+        task.report_objects_geometry(True)
+        task.report_objects_optimal_bounding_box(True)
+        task.report_objects_ions(True)
+        task.report_objects_edge_contact(True)
+        task.report_proxies(False)
+        task.report_proxies_properties(False)
+        task.report_proxies_geometry(False)
+        task.report_proxies_optimal_bounding_box(False)
+        task.report_proxies_ions(False)
+        nanochem.add_task(dataset, task)
+    return nanochem.configure(jobid)
@@ -0,0 +1,136 @@
+import contextlib
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+class _ThreadLocalStream:
+    """
+    Stand-in for sys.stdout which writes to a target set per thread and to
+    the original stream everywhere else
+    """
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    @property
+    def target(self):
+        return getattr(self._local, "target", None) or self._stream
+
+    @target.setter
+    def target(self, stream):
+        self._local.target = stream
+
+    def write(self, text):
+        return self.target.write(text)
+
+    def flush(self):
+        return self.target.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+
+_install_lock = threading.Lock()
+_executor_lock = threading.Lock()
+# the working directory is process wide, in-process calls which need it
+# take turns
+_directory_lock = threading.Lock()
+_executor = None
+_executor_workers = 0
+
+
+def _thread_local_stdout():
+    """
+    Replace sys.stdout once by a stream which can be redirected per thread
+    """
+    with _install_lock:
+        if not isinstance(sys.stdout, _ThreadLocalStream):
+            sys.stdout = _ThreadLocalStream(sys.stdout)
+        return sys.stdout
+
+
+def _submit(workers, function, *args):
+    """
+    Submit to the worker pool of this process, which has as many workers as
+    the largest request so far, at most one per core. A pool which is too
+    small is replaced, the calls it runs still finish.
+    """
+    global _executor, _executor_workers
+    workers = max(min(workers, os.cpu_count() or 1), 1)
+    with _executor_lock:
+        if _executor is None or workers > _executor_workers:
+            if _executor is not None:
+                _executor.shutdown(wait=False)
+            # spawn, forking a process with running threads is unsafe
+            _executor = ProcessPoolExecutor(max_workers=workers,
+                                            mp_context=multiprocessing.get_context("spawn"))
+            _executor_workers = workers
+        # under the lock, the pool cannot be shut down in between
+        return _executor.submit(function, *args)
+
+
+def _call_in_directory(function, working_directory, logfile, args, kwargs):
+    """
+    Run in a worker process, which owns its working directory and stdout
+    """
+    cwd = os.getcwd()
+    with open(os.path.join(working_directory, logfile), "w") as log:
+        os.chdir(working_directory)
+        try:
+            with contextlib.redirect_stdout(log):
+                return function(*args, **kwargs)
+        finally:
+            os.chdir(cwd)
+
+
+class ExecutionContext:
+    """
+    Run the paraprobe setup and reporting functions of one job and capture
+    what they print in a log file in its working directory.
+
+    Functions which rely on the current working directory run in a worker
+    process when `isolate` is True, so that many jobs can be configured in
+    parallel from threads or processes. Otherwise they run in this process,
+    one at a time. Output of in-process calls is captured per thread, the
+    global sys.stdout is never swapped during a call.
+
+    Functions and arguments have to be picklable to run isolated. The
+    worker pool is shared by the jobs of this process and sized by the
+    largest `workers` requested, typically the cores of the job, so that the
+    workers of a batch do not start a pool of every core each.
+    """
+    def __init__(self, working_directory, isolate=True, workers=1):
+        self.working_directory = working_directory
+        self.isolate = isolate
+        self.workers = workers
+
+    @contextlib.contextmanager
+    def capture(self, logfile):
+        stream = _thread_local_stdout()
+        previous = getattr(stream._local, "target", None)
+        with open(os.path.join(self.working_directory, logfile), "w") as log:
+            stream.target = log
+            try:
+                yield log
+            finally:
+                stream.target = previous
+
+    def call(self, function, logfile, *args, change_directory=True, **kwargs):
+        if not change_directory:
+            with self.capture(logfile):
+                return function(*args, **kwargs)
+        if self.isolate:
+            future = _submit(self.workers, _call_in_directory, function, self.working_directory,
+                             logfile, args, kwargs)
+            return future.result()
+        with _directory_lock:
+            cwd = os.getcwd()
+            os.chdir(self.working_directory)
+            try:
+                with self.capture(logfile):
+                    return function(*args, **kwargs)
+            finally:
+                os.chdir(cwd)
@@ -0,0 +1,244 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from paraprobe_reader import read_pos
+from paraprobe_results import SURFACER_VERTICES, SURFACER_FACES, DISTANCER_DISTANCES
+
+
+def point_triangle_distance(points, a, b, c):
+    """
+    Euclidean distance between points and triangles (a, b, c), all arrays
+    broadcast against each other with the coordinates in the last axis.
+
+    The closest point is found by the Voronoi region test of Ericson, Real-Time
+    Collision Detection, 5.1.5, evaluated for all regions and selected with
+    the same precedence.
+    """
+    ab, ac = b - a, c - a
+    ap, bp, cp = points - a, points - b, points - c
+    d1, d2 = (ab * ap).sum(-1), (ac * ap).sum(-1)
+    d3, d4 = (ab * bp).sum(-1), (ac * bp).sum(-1)
+    d5, d6 = (ab * cp).sum(-1), (ac * cp).sum(-1)
+    va, vb, vc = d3 * d6 - d5 * d4, d5 * d2 - d1 * d6, d1 * d4 - d3 * d2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        denominator = 1. / (va + vb + vc)
+        v, w = vb * denominator, vc * denominator
+        v_ab = d1 / (d1 - d3)
+        w_ac = d2 / (d2 - d6)
+        w_bc = (d4 - d3) / ((d4 - d3) + (d5 - d6))
+    # closest point a + v ab + w ac, lowest precedence first, every later
+    # region overrides
+    zero, one = np.zeros_like(v), np.ones_like(v)
+    regions = [
+        ((va <= 0) & (d4 - d3 >= 0) & (d5 - d6 >= 0), 1. - w_bc, w_bc),
+        ((vb <= 0) & (d2 >= 0) & (d6 <= 0), zero, w_ac),
+        ((d6 >= 0) & (d5 <= d6), zero, one),
+        ((vc <= 0) & (d1 >= 0) & (d3 <= 0), v_ab, zero),
+        ((d3 >= 0) & (d4 <= d3), one, zero),
+        ((d1 <= 0) & (d2 <= 0), zero, zero),
+    ]
+    for condition, region_v, region_w in regions:
+        v = np.where(condition, region_v, v)
+        w = np.where(condition, region_w, w)
+    return np.sqrt(((ap - ab * v[..., None] - ac * w[..., None])**2).sum(-1))
+
+
+def _dilate(mask):
+    """
+    One step of a 26-neighbourhood dilation, separable along the axes
+    """
+    for axis in range(3):
+        shifted = mask.copy()
+        lower = [slice(None)] * 3
+        upper = [slice(None)] * 3
+        lower[axis], upper[axis] = slice(None, -1), slice(1, None)
+        shifted[tuple(lower)] |= mask[tuple(upper)]
+        shifted[tuple(upper)] |= mask[tuple(lower)]
+        mask = shifted
+    return mask
+
+
+class TriangleGrid:
+    """
+    Uniform grid over the bounding box of a triangle set. Every cell lists
+    the triangles whose bounding box overlaps it, and knows its Chebyshev
+    distance in cells to the nearest non-empty cell, so that the search
+    around a point starts at the first ring of cells which holds triangles.
+
+    A cell k cells away from the cell of a point is at least (k - 1) *
+    cell_size away from the point, clamping points outside the grid to it
+    keeps this bound. Points farther from the surface than their first ring
+    guarantees are resolved against all triangles whose bounding box is close
+    enough, pruned per point by the distance to the nearest centroid.
+    """
+    def __init__(self, vertices, faces, cell_size=None, max_cells=2**18):
+        triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces, dtype=np.int64)]
+        area = np.linalg.norm(np.cross(triangles[:, 1] - triangles[:, 0], triangles[:, 2] - triangles[:, 0]), axis=1)
+        # the edges of zero-area triangles are edges of their neighbours
+        self.triangles = triangles[area > 0]
+        if len(self.triangles) == 0:
+            raise ValueError("Empty triangle set")
+        self.box_min = self.triangles.min(axis=1)
+        self.box_max = self.triangles.max(axis=1)
+        self.centroids = self.triangles.mean(axis=1)
+        lower = self.box_min.min(axis=0)
+        extent = np.maximum(self.box_max.max(axis=0) - lower, 1e-9)
+        if cell_size is None:
+            # a few triangles per cell of a closed surface, ~6 n^2 cells for n per axis
+            cell_size = extent.max() / np.clip(np.sqrt(len(self.triangles) / 24.), 1., 128.)
+        self.cell_size = max(cell_size, (np.prod(extent) / max_cells)**(1. / 3.))
+        self.lower = lower
+        self.shape = np.maximum(np.ceil(extent / self.cell_size).astype(np.int64), 1)
+
+        # cell ranges of the triangle bounding boxes, compressed cell lists
+        self.box_lower = self._cell(self.box_min)
+        self.box_upper = self._cell(self.box_max)
+        cells, triangles = [], []
+        for index, (low, high) in enumerate(zip(self.box_lower, self.box_upper)):
+            ranges = [np.arange(low[i], high[i] + 1) for i in range(3)]
+            block = np.ravel_multi_index(np.meshgrid(*ranges, indexing="ij"), self.shape).ravel()
+            cells.append(block)
+            triangles.append(np.full(len(block), index))
+        cells, triangles = np.concatenate(cells), np.concatenate(triangles)
+        order = np.argsort(cells, kind="stable")
+        self.cell_triangles = triangles[order]
+        self.cell_start = np.searchsorted(cells[order], np.arange(np.prod(self.shape) + 1))
+
+        occupied = (np.diff(self.cell_start) > 0).reshape(self.shape)
+        self.ring = np.full(self.shape, -1, dtype=np.int64)
+        radius = 0
+        while (self.ring < 0).any():
+            self.ring[(self.ring < 0) & occupied] = radius
+            occupied = _dilate(occupied)
+            radius += 1
+        self.ring = self.ring.ravel()
+
+    def _cell(self, points):
+        cell = np.floor((points - self.lower) / self.cell_size).astype(np.int64)
+        return np.clip(cell, 0, self.shape - 1)
+
+    def _candidates(self, cell, radius):
+        """
+        Triangles listed in the cells at most radius away from cell
+        """
+        low = np.maximum(cell - radius, 0)
+        high = np.minimum(cell + radius, self.shape - 1)
+        if np.prod(high - low + 1) > len(self.triangles):
+            inside = ((self.box_upper >= low) & (self.box_lower <= high)).all(axis=1)
+            return np.flatnonzero(inside)
+        ranges = [np.arange(low[i], high[i] + 1) for i in range(3)]
+        cells = np.ravel_multi_index(np.meshgrid(*ranges, indexing="ij"), self.shape).ravel()
+        start, stop = self.cell_start[cells], self.cell_start[cells + 1]
+        lengths = stop - start
+        offsets = np.repeat(start - np.cumsum(lengths) + lengths, lengths)
+        return np.unique(self.cell_triangles[offsets + np.arange(lengths.sum())])
+
+    def _candidates_within(self, points, distance):
+        """
+        Triangles whose bounding box is at most distance away from the
+        bounding box of the points
+        """
+        gap = np.maximum(np.maximum(self.box_min - points.max(axis=0), points.min(axis=0) - self.box_max), 0.)
+        return np.flatnonzero((gap**2).sum(axis=1) <= distance**2)
+
+    def _nearest(self, points, candidates, upper=None, batch_size=2**20):
+        """
+        Distance of every point to the nearest candidate triangle, only
+        evaluated for the triangles whose bounding box is closer than the
+        nearest centroid and the upper bound. Points without any such
+        triangle keep the upper bound.
+        """
+        result = np.full(len(points), np.inf) if upper is None else np.array(upper, dtype=np.float64)
+        if len(candidates) == 0:
+            return result
+        step = max(batch_size // len(candidates), 1)
+        for i in range(0, len(points), step):
+            block = points[i:i + step, None, :]
+            bound = np.sqrt(((block - self.centroids[candidates])**2).sum(-1)).min(axis=1)
+            bound = np.minimum(bound, result[i:i + step])
+            gap = np.maximum(np.maximum(self.box_min[candidates] - block, block - self.box_max[candidates]), 0.)
+            rows, columns = np.nonzero((gap**2).sum(-1) <= bound[:, None]**2)
+            if len(rows) == 0:
+                continue
+            triangles = self.triangles[candidates[columns]]
+            pairs = point_triangle_distance(block[rows, 0], triangles[:, 0], triangles[:, 1], triangles[:, 2])
+            starts = np.flatnonzero(np.diff(rows, prepend=-1))
+            index = i + rows[starts]
+            result[index] = np.minimum(result[index], np.minimum.reduceat(pairs, starts))
+        return result
+
+    def distances(self, points, cutoff=None):
+        """
+        Distance of every point to the nearest triangle. With a cutoff, points
+        farther away are not resolved and get the cutoff distance.
+        """
+        points = np.asarray(points, dtype=np.float64)
+        cells = self._cell(points)
+        flat = np.ravel_multi_index(cells.T, self.shape)
+        result = np.full(len(points), np.inf if cutoff is None else float(cutoff))
+        active = np.arange(len(points))
+        if cutoff is not None:
+            # deep-interior cells, no triangle within the cutoff
+            active = active[np.maximum(self.ring[flat] - 1, 0) * self.cell_size < cutoff]
+        order = active[np.argsort(flat[active], kind="stable")]
+        bounds = np.flatnonzero(np.diff(flat[order])) + 1
+        for group in np.split(order, bounds):
+            if len(group) == 0:
+                continue
+            # cells beyond reach are at least (reach - 1) cell sizes away
+            reach = self.ring[flat[group[0]]] + 1
+            nearest = self._nearest(points[group], self._candidates(cells[group[0]], reach))
+            unresolved = nearest > (reach - 1) * self.cell_size
+            if cutoff is not None:
+                nearest = np.minimum(nearest, cutoff)
+                unresolved &= (reach - 1) * self.cell_size < cutoff
+            if unresolved.any():
+                candidates = self._candidates_within(points[group[unresolved]], nearest[unresolved].max())
+                nearest[unresolved] = self._nearest(points[group[unresolved]], candidates, upper=nearest[unresolved])
+            result[group] = nearest
+        return result
+
+
+_GRID = None
+
+
+def _initialize_worker(grid):
+    global _GRID
+    _GRID = grid
+
+
+def _chunk_distances(pos_file, start, stop, cutoff):
+    positions = read_pos(pos_file)
+    return _GRID.distances(np.asarray(positions[start:stop, :3], dtype=np.float64), cutoff=cutoff)
+
+
+def compute_distances(pos_file, surfacer_results, output_file, cutoff=None, cell_size=None,
+                      workers=1, chunk_size=2**18):
+    """
+    Distances of the ions of a .pos file to the triangle set of the surfacer
+    results, written to DISTANCER_DISTANCES of output_file in ion order as the
+    paraprobe-distancer does. The ions are processed in chunks by a process
+    pool of the given number of workers.
+
+    Returns the number of ions and the number of ions beyond the cutoff.
+    """
+    import h5py
+    with h5py.File(surfacer_results, "r") as h5r:
+        grid = TriangleGrid(h5r[SURFACER_VERTICES][()], h5r[SURFACER_FACES][()], cell_size=cell_size)
+    n_ions = len(read_pos(pos_file))
+    ranges = [(start, min(start + chunk_size, n_ions)) for start in range(0, n_ions, chunk_size)]
+    beyond_cutoff = 0
+    with h5py.File(output_file, "w") as h5w:
+        dataset = h5w.create_dataset(DISTANCER_DISTANCES, shape=(n_ions,), dtype=np.float32,
+                                     chunks=(min(chunk_size, max(n_ions, 1)),))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_initialize_worker, initargs=(grid,)) as executor:
+            futures = [executor.submit(_chunk_distances, pos_file, start, stop, cutoff) for start, stop in ranges]
+            for (start, stop), future in zip(ranges, futures):
+                distances = future.result()
+                dataset[start:stop] = distances
+                if cutoff is not None:
+                    beyond_cutoff += int(np.count_nonzero(distances >= cutoff))
+    return n_ions, beyond_cutoff
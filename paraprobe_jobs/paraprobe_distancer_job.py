@@ -1,26 +1,90 @@
+import contextlib
 import os
 import numpy as np
 import shutil
 import sys
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
+from paraprobe_base_job import ParaprobeBase, _record_performance
+from paraprobe_configure import configure_distancer, PARAPROBE_IMPORT_MESSAGE, require_modules
+from paraprobe_results import (DISTANCER_DISTANCES, RANGER_ION_LABELS, RANGER_LAYOUT, iterate_dataset,
+                               missing_paths, read_ranger_results)
+from paraprobe_statistics import StreamingStatistics, FixedHistogram
+
+
+with ImportAlarm(PARAPROBE_IMPORT_MESSAGE) as paraprobe_alarm:
+    # the paraprobe modules are imported on first use, possibly in a worker
+    # process, only check here that they are installed
+    require_modules("paraprobe_parmsetup")
+
+
+def get_distance_statistics(results_file, ranger_results_file=None, relative_accuracy=0.01,
+                            histogram_max=50., histogram_bins=256):
+    """
+    Moments, quantile sketch and a fixed-size histogram of the ion-to-edge
+    distances, overall and per iontype when the ranger results are given.
+    The distances and iontype labels are read in slices of whole HDF5 chunks.
+
+    Returns the overall statistics, the histogram and a dict of statistics
+    per iontype id.
+    """
+    import h5py
+    statistics = StreamingStatistics(relative_accuracy=relative_accuracy)
+    histogram = FixedHistogram(0., histogram_max, bins=histogram_bins)
+    per_iontype = {}
+    with contextlib.ExitStack() as stack:
+        h5r = stack.enter_context(h5py.File(results_file, "r"))
+        labels = None
+        if ranger_results_file is not None:
+            labels = stack.enter_context(h5py.File(ranger_results_file, "r"))[RANGER_ION_LABELS]
+        for start, distance in iterate_dataset(h5r[DISTANCER_DISTANCES]):
+            distance = np.asarray(distance, dtype=np.float64).ravel()
+            statistics.update(distance)
+            histogram.update(distance)
+            if labels is None:
+                continue
+            label = np.asarray(labels[start:start + len(distance)]).ravel()
+            order = np.argsort(label, kind="stable")
+            for group in np.split(order, np.flatnonzero(np.diff(label[order])) + 1):
+                if len(group) == 0:
+                    continue
+                iontype = int(label[group[0]])
+                if iontype not in per_iontype:
+                    per_iontype[iontype] = StreamingStatistics(relative_accuracy=relative_accuracy)
+                per_iontype[iontype].update(distance[group])
+    return statistics, histogram, per_iontype
 
-with ImportAlarm(
-    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
-    "requirements. Please install it and try again."
-) as paraprobe_alarm:
-    from paraprobe_parmsetup.distancer_guru import ParmsetupDistancer
-    from paraprobe_autoreporter.wizard.distancer_report import AutoReporterDistancer
 
 class ParaprobeDistancer(ParaprobeBase):
+    """
+    Distances of all ions to the edge model of the surfacer.
+
+    With input.engine = "python" the distances are computed in process
+    instead of by paraprobe-distancer, over a grid index of the triangles
+    with server.cores worker processes, and written in the same layout. Ions
+    farther away than input.cutoff are not resolved and get the cutoff
+    distance, which skips the deep interior of large specimens.
+    """
+    _stored_attributes = ParaprobeBase._stored_attributes + ("_distancer_config", "_distancer_results")
+    _result_groups = {"_distancer_results": [DISTANCER_DISTANCES]}
+
+    @paraprobe_alarm
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self.ranger_job = None
         self.surfacer_job = None
         self._distancer_config = None
         self._skip_copy_results = False
+        self.input.relative_accuracy = 0.01
+        self.input.cdf_points = 256
+        # nm, distances beyond end up in output["distancer/histogram/overflow"]
+        self.input.histogram_max = 50.
+        self.input.histogram_bins = 256
+        # paraprobe: paraprobe-distancer, python: in-process engine
+        self.input.engine = "paraprobe"
+        # nm, python engine only, None resolves every ion
+        self.input.cutoff = None
+        self.input.cell_size = None
         
     def _copy_results(self):
         if self._skip_copy_results:
@@ -29,23 +93,16 @@ class ParaprobeDistancer(ParaprobeBase):
         if self.ranger_job is None:
             raise ValueError("Needs a ranger job!")
         
-        a = self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_results))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_results))
+        for filename in self.ranger_job.result_files:
+            self._copy_file(filename)
         self._copy_file(os.path.join(self.surfacer_job.working_directory, self.surfacer_job._surfacer_config))
         self._copy_file(os.path.join(self.surfacer_job.working_directory, self.surfacer_job._surfacer_results))
         
     
-    @_change_directory
-    @_pipe_output_to_file("config_distancer.log")
+    @_record_performance("configure/distancer")
     def _configure_distancer(self):
-        distancer = ParmsetupDistancer()
-        self._distancer_config = distancer.compute_ion_to_edge_model_distances(self.working_directory, 
-                                    transcoder_config_sim_id=self.jobid,
-                                    transcoder_results_sim_id=self.jobid,
-                                    ranger_results_sim_id=self.jobid,
-                                    distancer_results_sim_id=self.jobid)
+        self._distancer_config = self.execution_context.call(
+            configure_distancer, "config_distancer.log", self.working_directory, jobid=self.jobid)
         
     def _executable_activate(self, enforce = False):
         if self._executable is None or enforce:
@@ -62,20 +119,72 @@ class ParaprobeDistancer(ParaprobeBase):
         self.pos_file = self._copy_file(self.pos_file)
         self.rrng_file = self._copy_file(self.rrng_file)
         self._copy_results()
+        if self.input.engine == "python":
+            self._skip_execution = True
+            return
         self._configure_distancer()
+
+    def _compute_distances(self):
+        from paraprobe_distance import compute_distances
+        n_ions, beyond_cutoff = compute_distances(
+            os.path.join(self.working_directory, self.pos_file),
+            os.path.join(self.working_directory, f"PARAPROBE.Surfacer.Results.SimID.{self.jobid}.h5"),
+            os.path.join(self.working_directory, f"PARAPROBE.Distancer.Results.SimID.{self.jobid}.h5"),
+            cutoff=self.input.cutoff,
+            cell_size=self.input.cell_size,
+            workers=self.server.cores)
+        self.output["distancer/engine/beyond_cutoff"] = beyond_cutoff
+
+    def run_static(self):
+        if self.input.engine == "python":
+            with self._measure(f"execute/{self.stage_name}"):
+                self._compute_distances()
+        super().run_static()
     
+    @_record_performance("collect/distancer")
     def collect_output(self):
         self._collect_distancer_results()
-        self._collect_logs()
+        if self.input.engine != "python":
+            self._collect_logs()
     
     def _collect_distancer_results(self):
         self._distancer_results = os.path.join(self.working_directory, f"PARAPROBE.Distancer.Results.SimID.{self.jobid}.h5")
-        #distancer_report = AutoReporterDistancer(self._distancer_results, self.jobid)
-        #distancer_plot = distancer_report.get_ion2mesh_distance_cdf(distancing_task_id=0)
-        
+        ranger_results = os.path.join(self.working_directory, f"PARAPROBE.Ranger.Results.SimID.{self.jobid}.h5")
+        if not os.path.exists(ranger_results) or len(missing_paths(ranger_results, RANGER_LAYOUT)) > 0:
+            # no statistics per iontype
+            ranger_results = None
+        statistics, histogram, per_iontype = get_distance_statistics(
+            self._distancer_results, ranger_results,
+            relative_accuracy=self.input.relative_accuracy,
+            histogram_max=self.input.histogram_max,
+            histogram_bins=self.input.histogram_bins)
+        for key, value in statistics.summary(n_points=self.input.cdf_points).items():
+            # replaced by the fixed-size histogram
+            if not key.startswith("histogram/"):
+                self.output[f"distancer/{key}"] = value
+        self.output["distancer/histogram/edges"] = histogram.edges
+        self.output["distancer/histogram/counts"] = histogram.counts
+        self.output["distancer/histogram/underflow"] = histogram.underflow
+        self.output["distancer/histogram/overflow"] = histogram.overflow
+        if ranger_results is not None:
+            self._collect_iontype_statistics(ranger_results, per_iontype)
+
+    def _collect_iontype_statistics(self, ranger_results, per_iontype):
+        ranger = read_ranger_results(ranger_results)
+        ids = sorted(per_iontype)
+        names = dict(zip(ranger["iontype_ids"].tolist(), ranger["iontype_names"]))
+        self.output["distancer/iontypes/ids"] = np.array(ids)
+        self.output["distancer/iontypes/names"] = [names.get(i) or "unranged" for i in ids]
+        self.output["distancer/iontypes/count"] = np.array([per_iontype[i].moments.count for i in ids])
+        self.output["distancer/iontypes/mean"] = np.array([per_iontype[i].moments.mean for i in ids])
+        self.output["distancer/iontypes/quantiles/levels"] = np.array(StreamingStatistics.quantile_levels)
+        # one row per iontype
+        self.output["distancer/iontypes/quantiles/values"] = np.array(
+            [per_iontype[i].sketch.quantiles(StreamingStatistics.quantile_levels) for i in ids])
         
+    @_record_performance("logs/distancer")
     def _collect_logs(self):
-        config_distancer_log = self._read_temporary_output_file("config_distancer.log", clean=False)
-        execute_distancer_log = self._read_temporary_output_file("log.out", clean=False)
-        self.output["log/configure/distancer"] = config_distancer_log
-        self.output["log/execute/distancer"] = execute_distancer_log
\ No newline at end of file
+        self._ingest_logs({
+            "configure/distancer": "config_distancer.log",
+            "execute/distancer": "log.out",
+        })
@@ -0,0 +1,281 @@
+import glob
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from paraprobe_cache import hash_file
+from paraprobe_results import iterate_dataset
+from paraprobe_staging import stage_file
+
+# files of the stage working directories which are deduplicated
+ARTIFACT_PATTERNS = ("PARAPROBE.*", "*.pos", "*.rrng")
+# the compressions tried by choose_compression, None keeps the files as they
+# are. Only gzip, the paraprobe tools and readers without hdf5plugin have to
+# read the repacked files: lzf is h5py only, lz4 and zstd need hdf5plugin.
+COMPRESSION_CANDIDATES = ((None, None), ("gzip", 1), ("gzip", 4))
+
+
+def _artifacts(directories):
+    files = []
+    for directory in directories:
+        for pattern in ARTIFACT_PATTERNS:
+            for path in sorted(glob.glob(os.path.join(directory, pattern))):
+                # symlinks share their data already
+                if os.path.isfile(path) and not os.path.islink(path):
+                    files.append(path)
+    return files
+
+
+def _duplicate_groups(files):
+    """
+    Files grouped by name and content, the first file of a group, from the
+    first directory, is kept
+    """
+    by_size = defaultdict(list)
+    for path in files:
+        by_size[(os.path.basename(path), os.path.getsize(path))].append(path)
+    groups = []
+    for paths in by_size.values():
+        if len(paths) == 1:
+            groups.append(paths)
+            continue
+        by_hash = defaultdict(list)
+        for path in paths:
+            by_hash[hash_file(path)].append(path)
+        groups.extend(by_hash.values())
+    return groups
+
+
+def disk_usage(directories):
+    """
+    Allocated bytes of the files in the directories, every inode counted once
+    """
+    inodes = {}
+    for directory in directories:
+        for entry in os.scandir(directory):
+            if entry.is_file(follow_symlinks=False):
+                info = entry.stat(follow_symlinks=False)
+                inodes[(info.st_dev, info.st_ino)] = info.st_blocks * 512
+    return sum(inodes.values())
+
+
+def deduplicate(directories, mode="auto"):
+    """
+    Replace files with the same name and content in several directories by
+    links to the copy in the first directory, see stage_file for the modes.
+
+    Returns the groups of identical files and the number of files and bytes
+    which are no longer stored twice.
+    """
+    groups = _duplicate_groups(_artifacts(directories))
+    linked = saved = 0
+    for canonical, *duplicates in groups:
+        for path in duplicates:
+            if os.path.samefile(canonical, path):
+                continue
+            size = os.path.getsize(path)
+            method, _ = stage_file(canonical, os.path.dirname(path), mode=mode)
+            if method != "copy":
+                linked += 1
+                saved += size
+    return groups, {"files_linked": linked, "bytes_deduplicated": saved}
+
+
+def _filters(compression, level=None):
+    if compression == "gzip":
+        return {"compression": "gzip", "compression_opts": 4 if level is None else level, "shuffle": True}
+    raise ValueError(f"Unknown compression {compression}, only gzip is readable by the paraprobe tools")
+
+
+def _current_filters(dataset):
+    return {"compression": dataset.compression, "compression_opts": dataset.compression_opts,
+            "shuffle": dataset.shuffle}
+
+
+def _chunk_rows(dataset, chunk_bytes):
+    """
+    Rows per chunk, a power of two so that the 2**20-row reads of
+    iterate_dataset cover whole chunks
+    """
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    rows = 2**int(np.log2(max(chunk_bytes // max(row_bytes, 1), 1)))
+    return min(rows, 2**20, dataset.shape[0])
+
+
+def _compressible(dataset, min_bytes):
+    return dataset.dtype.kind in "biuf" and dataset.ndim > 0 and dataset.shape[0] > 0 \
+        and dataset.size * dataset.dtype.itemsize >= min_bytes
+
+
+def _repacked(dataset, filters, chunk_bytes):
+    """
+    Whether a dataset already has the filters and chunks of repack_file
+    """
+    return _current_filters(dataset) == filters \
+        and dataset.chunks == (_chunk_rows(dataset, chunk_bytes),) + dataset.shape[1:]
+
+
+def pending_datasets(filename, compression="gzip", level=None, chunk_bytes=2**20, min_bytes=2**16):
+    """
+    Datasets of a file which repack_file would rewrite
+    """
+    import h5py
+    filters = _filters(compression, level)
+    names = []
+    with h5py.File(filename, "r") as h5r:
+        h5r.visititems(lambda name, item: names.append(name)
+                       if isinstance(item, h5py.Dataset) and _compressible(item, min_bytes)
+                       and not _repacked(item, filters, chunk_bytes) else None)
+    return names
+
+
+def _copy_group(source, target, filters, chunk_bytes, min_bytes):
+    import h5py
+    target.attrs.update(source.attrs)
+    for name in source:
+        link = source.get(name, getlink=True)
+        if isinstance(link, (h5py.SoftLink, h5py.ExternalLink)):
+            target[name] = link
+            continue
+        item = source[name]
+        if isinstance(item, h5py.Group):
+            _copy_group(item, target.create_group(name), filters, chunk_bytes, min_bytes)
+        elif _compressible(item, min_bytes) and not _repacked(item, filters, chunk_bytes):
+            dataset = target.create_dataset(name, shape=item.shape, dtype=item.dtype,
+                                            chunks=(_chunk_rows(item, chunk_bytes),) + item.shape[1:],
+                                            track_times=False, **filters)
+            for start, block in iterate_dataset(item):
+                dataset[start:start + len(block)] = block
+            dataset.attrs.update(item.attrs)
+        else:
+            source.copy(item, target, name=name)
+
+
+def repack_file(filename, compression="gzip", level=None, chunk_bytes=2**20, min_bytes=2**16):
+    """
+    Rewrite an HDF5 file with every numeric dataset of at least min_bytes
+    chunked along its first axis and compressed, links and attributes are
+    kept. The chunks hold about chunk_bytes, the read size of the collectors.
+
+    Datasets which are chunked and compressed like this already are copied
+    without recompressing them, a file without other datasets is left
+    alone. Returns whether the file was rewritten.
+    """
+    import h5py
+    if len(pending_datasets(filename, compression, level, chunk_bytes, min_bytes)) == 0:
+        return False
+    temporary = filename + ".repack"
+    with h5py.File(filename, "r") as h5r, h5py.File(temporary, "w") as h5w:
+        _copy_group(h5r, h5w, _filters(compression, level), chunk_bytes, min_bytes)
+    os.replace(temporary, filename)
+    return True
+
+
+def time_reads(filename):
+    """
+    Seconds to read every numeric dataset of a file slice by slice, the way
+    the job collectors read them
+    """
+    import h5py
+    datasets = []
+    with h5py.File(filename, "r") as h5r:
+        h5r.visititems(lambda name, item: datasets.append(name)
+                       if isinstance(item, h5py.Dataset) and _compressible(item, 0) else None)
+        start = time.perf_counter()
+        for name in datasets:
+            for _ in iterate_dataset(h5r[name]):
+                pass
+        return time.perf_counter() - start
+
+
+def choose_compression(filename, candidates=COMPRESSION_CANDIDATES, sample_bytes=2**26,
+                       storage_bandwidth=2e8, chunk_bytes=2**20):
+    """
+    Benchmark the compressions on a sample of the largest dataset of a file
+    and choose the one with the shortest time to read the sample from storage
+    of the given bandwidth in bytes/s: compressed size / bandwidth plus the
+    decompression time. The candidate (None, None) is the sample stored
+    like the dataset is now, if it wins the file is better not repacked.
+
+    Returns the chosen (compression, level) and a row per candidate.
+    """
+    import h5py
+    with h5py.File(filename, "r") as h5r:
+        datasets = []
+        h5r.visititems(lambda name, item: datasets.append(item)
+                       if isinstance(item, h5py.Dataset) and _compressible(item, 0) else None)
+        if len(datasets) == 0:
+            return (None, None), []
+        largest = max(datasets, key=lambda item: item.size * item.dtype.itemsize)
+        row_bytes = largest.dtype.itemsize * int(np.prod(largest.shape[1:]))
+        sample = largest[:max(sample_bytes // max(row_bytes, 1), 1)]
+        current = {"chunks": None if largest.chunks is None else
+                   (min(largest.chunks[0], len(sample)),) + largest.chunks[1:], **_current_filters(largest)}
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        for compression, level in candidates:
+            if compression is None:
+                layout = current
+            else:
+                chunks = (max(min(chunk_bytes // max(row_bytes, 1), len(sample)), 1),) + sample.shape[1:]
+                layout = {"chunks": chunks, **_filters(compression, level)}
+            path = os.path.join(directory, f"{compression}{level}.h5")
+            with h5py.File(path, "w") as h5w:
+                h5w.create_dataset("sample", data=sample, track_times=False, **layout)
+            read_time = time_reads(path)
+            size = os.path.getsize(path)
+            rows.append({"compression": compression, "level": level, "bytes": size,
+                         "ratio": sample.nbytes / max(size, 1), "read_time": read_time,
+                         "score": size / storage_bandwidth + read_time})
+    best = min(rows, key=lambda row: row["score"])
+    return (best["compression"], best["level"]), rows
+
+
+def finalize(directories, repack=False, compression="auto", level=None, mode="auto", chunk_bytes=2**20):
+    """
+    Deduplicate the artifacts of the stage working directories and
+    optionally repack the HDF5 files among them, see deduplicate and
+    repack_file. With compression="auto" the compression is chosen by
+    choose_compression on the largest file, the files are not repacked if
+    they read faster as they are, as with compression=None.
+
+    Files which are also linked from elsewhere, e.g. the result cache, are
+    not repacked, rewriting them would store them twice. The read times are
+    measured before and after repacking with warm file caches.
+    """
+    import h5py
+    bytes_before = disk_usage(directories)
+    groups, report = deduplicate(directories, mode=mode)
+    report.update({"files_repacked": 0, "read_time_before": 0., "read_time_after": 0., "compression": ""})
+    if repack:
+        groups = [group for group in groups if h5py.is_hdf5(group[0])]
+        shared = [sum(os.path.samefile(group[0], path) for path in group) for group in groups]
+        groups = [group for group, names in zip(groups, shared) if os.stat(group[0]).st_nlink <= names]
+        if compression == "auto":
+            compression = None
+            if len(groups) > 0:
+                largest = max(groups, key=lambda group: os.path.getsize(group[0]))[0]
+                (compression, level), _ = choose_compression(largest, chunk_bytes=chunk_bytes)
+        if compression is None:
+            groups = []
+        # files repacked by an earlier finalize are left alone
+        groups = [group for group in groups
+                  if len(pending_datasets(group[0], compression, level, chunk_bytes=chunk_bytes)) > 0]
+        for canonical, *duplicates in groups:
+            report["read_time_before"] += time_reads(canonical)
+            repack_file(canonical, compression=compression, level=level, chunk_bytes=chunk_bytes)
+            report["read_time_after"] += time_reads(canonical)
+            report["files_repacked"] += 1
+            # hard links and reflinks still hold the old file
+            for path in duplicates:
+                if not os.path.islink(path):
+                    stage_file(canonical, os.path.dirname(path), mode=mode)
+        report["compression"] = ("none" if compression is None else
+                                 compression if level is None else f"{compression}:{level}")
+    report["bytes_before"] = bytes_before
+    report["bytes_after"] = disk_usage(directories)
+    report["bytes_saved"] = bytes_before - report["bytes_after"]
+    return report
@@ -1,19 +1,85 @@
+import functools
+import importlib
+import multiprocessing
 import os
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor
+import threading
 import numpy as np
 import shutil
 import sys
 
-from jupyterlab_h5web import H5Web
-from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
-from paraprobe_ranger_job import ParaprobeRanger
-from paraprobe_surfacer_job import ParaprobeSurfacer
-from paraprobe_distancer_job import ParaprobeDistancer
-from paraprobe_tessellator_job import ParaprobeTessellator
-from paraprobe_nanochem_job import ParaprobeNanochem
+from pyiron_base import Project, ProjectHDFio, GenericJob, DataContainer, state, Executable, ImportAlarm
+from paraprobe_base_job import ParaprobeBase
+from paraprobe_scheduler import Stage, StageScheduler, critical_path
+
+# stage name: (module and class of the job type, stages whose results the
+# job needs), the stage modules are only imported when a stage job is created
+_STAGES = {
+    "ranger": ("paraprobe_ranger_job.ParaprobeRanger", []),
+    "surfacer": ("paraprobe_surfacer_job.ParaprobeSurfacer", ["ranger"]),
+    "distancer": ("paraprobe_distancer_job.ParaprobeDistancer", ["ranger", "surfacer"]),
+    "tessellator": ("paraprobe_tessellator_job.ParaprobeTessellator", ["ranger", "distancer"]),
+    "nanochem": ("paraprobe_nanochem_job.ParaprobeNanochem", ["ranger", "surfacer", "distancer"]),
+}
+
+# output of the stage jobs which is not linked from the pipeline job
+_UNLINKED_OUTPUT = ("log", "perf", "staging", "input_hash")
+
+
+def _stage_job_type(stage):
+    module, name = _STAGES[stage][0].rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)
+
+
+def _stage_settings(job):
+    """
+    Everything a stage job is configured with, see _run_stage_job
+    """
+    return {"input": job.input.to_builtin(), "pos_file": job.pos_file, "rrng_file": job.rrng_file,
+            "cores": job.server.cores}
+
+
+def _run_stage_job(project_path, stage, job_name, settings, upstream, input_hash):
+    """
+    Create and run a stage job with the settings of _stage_settings and the
+    upstream jobs {stage: job name}.
+
+    pyiron installs signal handlers around a run, which only the main thread
+    of a process may do, so the stage jobs run in worker processes while
+    the scheduler threads wait for them.
+    """
+    project = Project(project_path)
+    job = project.create_job(job_type=_stage_job_type(stage), job_name=job_name, delete_existing_job=True)
+    for key, value in settings["input"].items():
+        job.input[key] = value
+    job.pos_file = settings["pos_file"]
+    job.rrng_file = settings["rrng_file"]
+    job.server.cores = settings["cores"]
+    for dependency, name in upstream.items():
+        setattr(job, f"{dependency}_job", project.load(name))
+    job.output["input_hash"] = input_hash
+    job.run()
+    if not job.status.finished:
+        raise RuntimeError(f"Stage job {job_name} ended with status {job.status.string}")
+
+
+def _iterate_phases(perf, prefix=""):
+    for key, value in perf.items():
+        if not isinstance(value, Mapping):
+            continue
+        if "wall_time" in value:
+            yield prefix + key, value
+        else:
+            yield from _iterate_phases(value, prefix=f"{prefix}{key}/")
 
 
 class ParaprobeJob(ParaprobeBase):
+    # _resume is stored, so that a pipeline resumed in a queue resumes on the
+    # compute node as well
+    _stored_attributes = ParaprobeBase._stored_attributes + tuple(f"_analyse_{stage}" for stage in _STAGES) \
+        + ("_resume",)
+
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self._analyse_ranger = False
@@ -26,7 +92,25 @@ class ParaprobeJob(ParaprobeBase):
         self._distancer_job = None
         self._tessellator_job = None
         self._nanochem_job = None
-    
+        # stage name: pending, running, finished or failed, stored in the
+        # job's HDF5 file on every change
+        self._stage_status = {}
+        self._stage_status_lock = threading.Lock()
+        self._resume = False
+        self.input.cache = False
+        self.input.cache_max_bytes = 50 * 2**30
+        # reuse stage jobs whose input hash did not change
+        self.input.reuse = True
+        # the total core budget is self.server.cores, memory is given in GB
+        # and 0 means no limit
+        self.input.max_memory = 0
+        for stage in _STAGES:
+            self.input[f"resources/{stage}/cores"] = 1
+            self.input[f"resources/{stage}/memory"] = 0
+            # copied to the input of the stage job, e.g.
+            # input["parameters/tessellator/relative_accuracy"] = 0.02
+            self.input[f"parameters/{stage}"] = {}
+
     def analyse_ranger(self):
         self._analyse_ranger = True
 
@@ -41,6 +125,7 @@ class ParaprobeJob(ParaprobeBase):
         
     def analyse_tessellator(self):
         self._analyse_ranger = True
+        self._analyse_surfacer = True
         self._analyse_distancer = True
         self._analyse_tessellator = True
 
@@ -51,93 +136,266 @@ class ParaprobeJob(ParaprobeBase):
         self._analyse_nanochem = True
     
     
+    def _selected_stages(self):
+        return [stage for stage in _STAGES if getattr(self, f"_analyse_{stage}")]
+
+    def get_stage_job(self, stage):
+        """
+        The stage job, loaded from the project by its job id on first access
+        if this job was loaded
+        """
+        job = getattr(self, f"_{stage}_job")
+        if job is None:
+            job_id = self.output.get(f"stages/{stage}/job_id")
+            job = self.project.load(job_id if job_id is not None else f"{self.name}_{stage}")
+            setattr(self, f"_{stage}_job", job)
+        return job
+
+    @property
+    def links(self):
+        return list(self.output.get("links", {}).keys())
+
+    def get_output(self, path):
+        """
+        Output of a stage job through the links of this job, e.g.
+        get_output("ranger/ion_count") for output["ranger/ion_count"] of the
+        ranger job. Only the stage job of the link is loaded.
+        """
+        name, _, subpath = path.partition("/")
+        if name not in self.links:
+            raise KeyError(f"No link {name}, choose from {self.links}")
+        stage = self.output[f"links/{name}/stage"]
+        path = self.output[f"links/{name}/path"]
+        if subpath:
+            path = f"{path}/{subpath}"
+        return self.get_stage_job(stage).output[path]
+
+    def materialize(self, names=None):
+        """
+        Copy the linked output of the stage jobs into the output of this job,
+        e.g. before exporting it on its own
+        """
+        for name in self.links if names is None else names:
+            self.output[name] = self.get_output(name)
+        self.to_hdf()
+
+    def finalize(self, repack=False, compression="auto", level=None):
+        """
+        Replace identical files in the working directories of the stage jobs,
+        e.g. the reconstruction and the upstream results staged into every
+        stage, by links and optionally repack the HDF5 files with chunking
+        and compression, see paraprobe_finalize. The space saved and the read
+        times are stored in output["finalize"].
+        """
+        from paraprobe_finalize import finalize
+        directories = [self.get_stage_job(stage).working_directory for stage in self._selected_stages()]
+        report = finalize(directories, repack=repack, compression=compression, level=level,
+                          mode=self.input.staging)
+        for key, value in report.items():
+            self.output[f"finalize/{key}"] = value
+        self.to_hdf()
+        return report
+
+    def _configure_stage_job(self, job, stage):
+        job.input.staging = self.input.staging
+        # the stages run in worker processes, see _run_stage_job, so the
+        # paths are resolved here, when the jobs are created up front
+        job.pos_file = None if self.pos_file is None else os.path.abspath(self.pos_file)
+        job.rrng_file = None if self.rrng_file is None else os.path.abspath(self.rrng_file)
+        job.server.cores = self.input[f"resources/{stage}/cores"]
+        for dependency in _STAGES[stage][1]:
+            setattr(job, f"{dependency}_job", getattr(self, f"_{dependency}_job"))
+        if stage == "ranger":
+            job.input.cache = self.input.cache
+            job.input.cache_max_bytes = self.input.cache_max_bytes
+        parameters = self.input.get("parameters", {}).get(stage)
+        if parameters:
+            for key, value in parameters.to_builtin().items():
+                job.input[key] = value
+
+    def _set_stage_status(self, stage, status):
+        with self._stage_status_lock:
+            self._stage_status[stage] = status
+            self.project_hdf5["pipeline"] = dict(self._stage_status)
+
+    def _create_stage_job(self, stage, upstream_hashes):
+        """
+        Reuse the existing stage job if it finished with the same input hash,
+        or when resuming, if it finished before the pipeline was interrupted.
+        Otherwise it is recreated when the stage runs.
+        """
+        job_type, depends = _stage_job_type(stage), _STAGES[stage][1]
+        job_name = f'{self.name}_{stage}'
+        # the hash is taken from a new job with the current parameters, the
+        # input of the existing job may hold overrides which were removed
+        job = job_type(ProjectHDFio(project=self.project.copy(), file_name=job_name), job_name)
+        self._configure_stage_job(job, stage)
+        input_hash = job.get_input_hash(upstream_hashes)
+        existing = self.project.load(job_name)
+        if existing is None:
+            reuse = False
+        elif self._resume:
+            reuse = (self._stage_status.get(stage) == "finished"
+                     and all(self.output[f"stages/{dependency}/reused"] for dependency in depends))
+        else:
+            reuse = self.input.reuse and existing.output.get("input_hash") == input_hash
+        reuse = reuse and existing.status.finished and existing.validate_results()
+        if reuse:
+            job = existing
+            self._set_stage_status(stage, "finished")
+        else:
+            # the new job is created and run in a worker process, see
+            # _run_stage_job, which replaces the existing job
+            self._set_stage_status(stage, "pending")
+        setattr(self, f"_{stage}_job", job)
+        self.output[f"stages/{stage}/input_hash"] = input_hash
+        self.output[f"stages/{stage}/reused"] = reuse
+        return input_hash
+
+    def _run_stage(self, stage, executor):
+        if self.output[f"stages/{stage}/reused"]:
+            return
+        job = getattr(self, f"_{stage}_job")
+        upstream = {dependency: getattr(self, f"_{dependency}_job").job_name for dependency in _STAGES[stage][1]}
+        self._set_stage_status(stage, "running")
+        try:
+            executor.submit(_run_stage_job, self.project.path, stage, job.job_name, _stage_settings(job),
+                            upstream, self.output[f"stages/{stage}/input_hash"]).result()
+        except Exception:
+            self._set_stage_status(stage, "failed")
+            raise
+        # the job ran in the worker process
+        setattr(self, f"_{stage}_job", self.project.load(job.job_name))
+        self._set_stage_status(stage, "finished")
+
+    def resume(self):
+        """
+        Continue an interrupted pipeline: stages which finished and whose
+        result files are intact are kept, the pipeline continues with the
+        first stage which failed or never ran.
+        """
+        self._resume = True
+        try:
+            self.status.created = True
+            self.to_hdf()
+            self.run()
+        finally:
+            self._resume = False
+
     def run_static(self):
         self.status.running = True
-        if self._analyse_ranger:
-            self._ranger_job = self.project.create_job(job_type=ParaprobeRanger, 
-                                                       job_name=f'{self.name}_ranger', 
-                    delete_existing_job=True)
-            self._ranger_job.pos_file = self.pos_file
-            self._ranger_job.rrng_file = self.rrng_file
-            self._ranger_job.run()
-            
-        if self._analyse_surfacer:
-            self._surfacer_job = self.project.create_job(job_type=ParaprobeSurfacer, 
-                                                       job_name=f'{self.name}_surfacer', 
-                    delete_existing_job=True)
-            self._surfacer_job.pos_file = self.pos_file
-            self._surfacer_job.rrng_file = self.rrng_file
-            self._surfacer_job.ranger_job = self._ranger_job
-            self._surfacer_job.run()
-
-        if self._analyse_distancer:
-            self._distancer_job = self.project.create_job(job_type=ParaprobeDistancer, 
-                                                       job_name=f'{self.name}_distancer', 
-                    delete_existing_job=True)
-            self._distancer_job.pos_file = self.pos_file
-            self._distancer_job.rrng_file = self.rrng_file
-            self._distancer_job.ranger_job = self._ranger_job
-            self._distancer_job.surfacer_job = self._surfacer_job
-            self._distancer_job.run()
-
-        if self._analyse_tessellator:
-            self._tessellator_job = self.project.create_job(job_type=ParaprobeTessellator, 
-                                                       job_name=f'{self.name}_tessellator', 
-                    delete_existing_job=True)
-            self._tessellator_job.pos_file = self.pos_file
-            self._tessellator_job.rrng_file = self.rrng_file
-            self._tessellator_job.ranger_job = self._ranger_job
-            self._tessellator_job.surfacer_job = self._surfacer_job
-            self._tessellator_job.run()
-
-        if self._analyse_nanochem:
-            self._nanochem_job = self.project.create_job(job_type=ParaprobeNanochem, 
-                                                       job_name=f'{self.name}_nanochem', 
-                    delete_existing_job=True)
-            self._nanochem_job.pos_file = self.pos_file
-            self._nanochem_job.rrng_file = self.rrng_file
-            self._nanochem_job.ranger_job = self._ranger_job
-            self._nanochem_job.surfacer_job = self._surfacer_job
-            self._nanochem_job.distancer_job = self._distancer_job
-            self._nanochem_job.run()
-            
+        selected = self._selected_stages()
+        # the scheduler threads only wait for the stage jobs, which run in
+        # worker processes, see _run_stage_job
+        executor = ProcessPoolExecutor(max_workers=max(len(selected), 1),
+                                       mp_context=multiprocessing.get_context("spawn"))
+        stages = [
+            Stage(stage, functools.partial(self._run_stage, stage, executor),
+                  depends=_STAGES[stage][1],
+                  cores=self.input[f"resources/{stage}/cores"],
+                  memory=self.input[f"resources/{stage}/memory"])
+            for stage in selected
+        ]
+        # jobs are created up front, only the runs happen concurrently
+        hashes = {}
+        for stage in stages:
+            hashes[stage.name] = self._create_stage_job(
+                stage.name, [hashes[dependency] for dependency in stage.depends])
+        # the stages to rerun are known, a later run is no resume
+        self._resume = False
+        self.to_hdf()
+        scheduler = StageScheduler(max_cores=self.server.cores, max_memory=self.input.max_memory)
+        with executor:
+            scheduler.run(stages)
+        for stage, timing in scheduler.timings.items():
+            self.output[f"schedule/{stage}/start"] = timing["start"]
+            self.output[f"schedule/{stage}/end"] = timing["end"]
+        self.output["schedule/critical_path"] = critical_path(stages, scheduler.timings)
+
+        # run() collects the output and finishes the job, like for the
+        # stage jobs
         self.status.collect = True
-        self.collect_output()
+        self.run()
+        self.to_hdf()
+
+    def from_hdf(self, hdf=None, group_name=None):
+        super().from_hdf(hdf=hdf, group_name=group_name)
+        if "pipeline" in self.project_hdf5.list_nodes():
+            self._stage_status = self.project_hdf5["pipeline"]
     
     def plot_tessellator_results(self):
         if self._tessellator_job is not None:
             self._tessellator_job.plot()
             
     def _collect_logs(self):
-        if self._analyse_ranger:
-            self.output["log/configure/transcoder"] = self._ranger_job.output["log/configure/transcoder"]
-            self.output["log/execute/transcoder"] = self._ranger_job.output["log/execute/transcoder"]
-            self.output["log/configure/ranger"] = self._ranger_job.output["log/configure/ranger"]
-            self.output["log/execute/ranger"] = self._ranger_job.output["log/execute/ranger"]
-        
-        if self._analyse_distancer:
-            self.output["log/configure/distancer"] = self._distancer_job.output["log/configure/distancer"]
-            self.output["log/execute/distancer"] = self._distancer_job.output["log/execute/distancer"]
-        
-        if self._analyse_surfacer:
-            self.output["log/configure/surfacer"] = self._surfacer_job.output["log/configure/surfacer"]
-            self.output["log/execute/surfacer"] = self._surfacer_job.output["log/execute/surfacer"]
-
-        if self._analyse_tessellator:
-            self.output["log/configure/tessellator"] = self._tessellator_job.output["log/configure/tessellator"]
-            self.output["log/execute/tessellator"] = self._tessellator_job.output["log/execute/tessellator"]
-        
-        if self._analyse_nanochem:
-            self.output["log/configure/nanochem"] = self._nanochem_job.output["log/configure/nanochem"]
-            self.output["log/execute/nanochem"] = self._nanochem_job.output["log/execute/nanochem"]     
+        """
+        Paths of the compressed logs of the stage jobs and their timing
+        lines, the log text stays in the output of the stage jobs
+        """
+        table = {"stage": [], "log": [], "phase": [], "seconds": []}
+        for stage in self._selected_stages():
+            log = getattr(self, f"_{stage}_job").output.get("log", {})
+            for kind, files in log.get("files", {}).items():
+                for name, filename in files.items():
+                    self.output[f"log/files/{kind}/{name}"] = os.path.join(
+                        getattr(self, f"_{stage}_job").working_directory, filename)
+            phases = log.get("phases", {})
+            for key, phase, seconds in zip(phases.get("log", []), phases.get("phase", []),
+                                           phases.get("seconds", [])):
+                table["stage"].append(stage)
+                table["log"].append(key)
+                table["phase"].append(phase)
+                table["seconds"].append(seconds)
+        for column, values in table.items():
+            self.output[f"log/phases/{column}"] = values
     
     def _collect_results(self):
-        if self._analyse_ranger:
-            self.output["ranger"] = self._ranger_job.output["ranger"]
+        """
+        Job ids of the stage jobs and links to their output groups instead of
+        copies, see get_output and materialize
+        """
+        for stage in self._selected_stages():
+            job = getattr(self, f"_{stage}_job")
+            self.output[f"stages/{stage}/job_id"] = job.job_id
+            self.output[f"stages/{stage}/job_name"] = job.job_name
+            for name in job.output.keys():
+                if name not in _UNLINKED_OUTPUT:
+                    self.output[f"links/{name}/stage"] = stage
+                    self.output[f"links/{name}/path"] = name
+        self._collect_staging()
+
+    def _collect_staging(self):
+        jobs = [self._ranger_job, self._surfacer_job, self._distancer_job,
+                self._tessellator_job, self._nanochem_job]
+        for key in ["bytes_avoided", "bytes_copied"]:
+            self.output[f"staging/{key}"] = sum(job.output.get(f"staging/{key}", 0)
+                                                for job in jobs if job is not None)
     
+    def _collect_performance(self):
+        """
+        One row per stage and phase with the measurements of all stage jobs
+        """
+        columns = ["stage", "phase", "wall_time", "peak_rss", "bytes_read", "bytes_written", "bytes_staged"]
+        table = {column: [] for column in columns}
+        for stage in self._selected_stages():
+            perf = getattr(self, f"_{stage}_job").output.get("perf", {})
+            for phase, values in _iterate_phases(perf):
+                table["stage"].append(stage)
+                table["phase"].append(phase)
+                for column in columns[2:]:
+                    table[column].append(values.get(column, 0))
+        for column, values in table.items():
+            self.output[f"perf/table/{column}"] = values
+
+    @property
+    def performance_table(self):
+        import pandas
+        return pandas.DataFrame({column: list(values) for column, values in self.output["perf/table"].items()})
+
     def collect_output(self):
         self._collect_logs()
         self._collect_results()
+        self._collect_performance()
             
             
     
@@ -0,0 +1,125 @@
+import collections
+import gzip
+import os
+import re
+
+# Whole lines only, so that numbers in other output are not mistaken for
+# timings or progress. An MPI rank prefix, "Rank 0:" or "[Rank 0]", is
+# skipped, phase names have no digits, so that "Rank 0: 3 s" is no phase
+# "Rank 0". The formats could not be checked against a log.out of the
+# installed tools, run benchmarks/check_logs.py on one when they change.
+_RANK = r"^\s*(?:\[?Rank\s+\d+\]?:?\s+)?"
+_PHASE = r"(?P<phase>[A-Za-z][A-Za-z ,/_-]*[A-Za-z])"
+_SECONDS = r"(?P<seconds>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)\s*(?:s|sec|secs|seconds)\.?\s*$"
+# phase and seconds of the timing lines of the paraprobe tools, e.g.
+# "Reading the reconstruction took 1.234 s" or "ComputeDistances: 12.5 seconds"
+TIMING_PATTERNS = [
+    re.compile(_RANK + _PHASE + r"\s+(?:took|needed|completed in|finished in)\s+" + _SECONDS),
+    re.compile(_RANK + _PHASE + r"\s*:\s*" + _SECONDS),
+]
+# progress lines, counts of ions, tasks, ... or a percentage at the end of
+# the line, e.g. "Processed 1000000 of 5000000 ions", "3 / 12 tasks" or
+# "Delocalization 42.0 % done", but not "Rank 0 of 4 started"
+_UNITS = r"(?:ions|tasks|points|triangles|facets|objects|cells|isosurfaces|blocks)"
+PROGRESS_PATTERNS = [
+    re.compile(_RANK + r"(?:[A-Za-z][A-Za-z ]*\s+)?(?P<done>\d+)\s*(?:/|\s+of\s+)\s*(?P<total>\d+)\s+"
+               + _UNITS + r"\b[\w .]*$"),
+    re.compile(_RANK + r"(?:[A-Za-z][A-Za-z ]*\s+)?(?P<percent>\d{1,3}(?:\.\d+)?)\s*%"
+               + r"(?:\s+(?:done|complete|completed))?\.?\s*$"),
+]
+
+
+def parse_timing(line):
+    """
+    Phase name and seconds of a timing line, None for other lines
+    """
+    for pattern in TIMING_PATTERNS:
+        match = pattern.search(line)
+        if match is not None:
+            return match.group("phase").strip(), float(match.group("seconds"))
+    return None
+
+
+def parse_progress(line):
+    """
+    Done and total of a progress line, percentages count to 100, None for
+    other lines
+    """
+    for pattern in PROGRESS_PATTERNS:
+        match = pattern.search(line)
+        if match is None:
+            continue
+        if "percent" in match.groupdict():
+            if float(match.group("percent")) > 100.:
+                return None
+            return float(match.group("percent")), 100.
+        if 0 < int(match.group("total")) and int(match.group("done")) <= int(match.group("total")):
+            return float(match.group("done")), float(match.group("total"))
+    return None
+
+
+def _open_log(filename):
+    """
+    The log and whether it still has to be compressed, an already compressed
+    log is read from filename.gz
+    """
+    if os.path.exists(filename):
+        return open(filename, "r", errors="replace"), True
+    if os.path.exists(filename + ".gz"):
+        return gzip.open(filename + ".gz", "rt", errors="replace"), False
+    raise FileNotFoundError(filename)
+
+
+def ingest_log(filename, head_lines=50, tail_lines=200):
+    """
+    Stream a log line by line into filename.gz, which replaces it, and keep
+    only its first head_lines and last tail_lines lines in memory.
+
+    Returns a dict with the bounded text, the number of lines and bytes, the
+    name of the compressed file, the (phase, seconds) timing lines and the
+    last (done, total) progress.
+    """
+    head, tail = [], collections.deque(maxlen=tail_lines)
+    phases = []
+    progress = None
+    n_lines = n_bytes = 0
+    fin, compress = _open_log(filename)
+    with fin, (gzip.open(filename + ".gz.tmp", "wt") if compress else open(os.devnull, "w")) as fout:
+        for line in fin:
+            fout.write(line)
+            n_lines += 1
+            n_bytes += len(line)
+            if len(head) < head_lines:
+                head.append(line)
+            else:
+                tail.append(line)
+            timing = parse_timing(line)
+            if timing is not None:
+                phases.append(timing)
+            line_progress = parse_progress(line)
+            if line_progress is not None:
+                progress = line_progress
+    if compress:
+        os.replace(filename + ".gz.tmp", filename + ".gz")
+        os.remove(filename)
+    omitted = n_lines - len(head) - len(tail)
+    text = "".join(head)
+    if omitted > 0:
+        text += f"[... {omitted} lines omitted, see {os.path.basename(filename)}.gz ...]\n"
+    text += "".join(tail)
+    return {
+        "text": text,
+        "lines": n_lines,
+        "bytes": n_bytes,
+        "file": os.path.basename(filename) + ".gz",
+        "phases": phases,
+        "progress": progress,
+    }
+
+
+def read_log(filename):
+    """
+    Full text of a log compressed by ingest_log
+    """
+    with gzip.open(filename, "rt", errors="replace") as fin:
+        return fin.read()
@@ -0,0 +1,178 @@
+import os
+import threading
+
+_PROC = "/proc"
+# /proc/<pid>/task/<tid>/children lists the children of a thread, it needs
+# a kernel with CONFIG_PROC_CHILDREN
+_CHILDREN_FILES = os.path.exists(os.path.join(_PROC, "self", "task", str(os.getpid()), "children"))
+
+
+def _status_kb(pid, field):
+    """
+    A memory field of /proc/<pid>/status in kB, None if the process is gone
+    """
+    try:
+        with open(os.path.join(_PROC, str(pid), "status"), "r") as fin:
+            for line in fin:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return None
+
+
+def _parents():
+    """
+    Parent pid of every process
+    """
+    parents = {}
+    for name in os.listdir(_PROC):
+        if not name.isdigit():
+            continue
+        try:
+            with open(os.path.join(_PROC, name, "stat"), "r") as fin:
+                # the command name may contain spaces, the fields after it
+                # are state and parent pid
+                parents[int(name)] = int(fin.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+    return parents
+
+
+def _children(pid):
+    children = []
+    try:
+        tasks = os.listdir(os.path.join(_PROC, str(pid), "task"))
+    except OSError:
+        return children
+    for tid in tasks:
+        try:
+            with open(os.path.join(_PROC, str(pid), "task", tid, "children"), "r") as fin:
+                children.extend(int(child) for child in fin.read().split())
+        except (OSError, ValueError):
+            continue
+    return children
+
+
+def _descendants(pid):
+    """
+    Processes below pid, from the children files of its tree where the
+    kernel has them, otherwise from a scan of all processes
+    """
+    if _CHILDREN_FILES:
+        children = _children
+    else:
+        parents = {}
+        for child, parent in _parents().items():
+            parents.setdefault(parent, []).append(child)
+        children = lambda parent: parents.get(parent, [])
+    found, pending = [], [pid]
+    while pending:
+        for child in children(pending.pop()):
+            found.append(child)
+            pending.append(child)
+    return found
+
+
+def _cwd(pid):
+    try:
+        return os.readlink(os.path.join(_PROC, str(pid), "cwd"))
+    except OSError:
+        return None
+
+
+class PeakRssSampler:
+    """
+    Peak resident set size of the processes a job runs in its working
+    directory, e.g. paraprobe started through mpiexec or a worker process
+    configuring the job.
+
+    Every interval seconds the descendants of this process whose current
+    directory is the working directory are looked up and their own high
+    water mark (VmHWM) is read, so stages running concurrently in other
+    directories are not mixed in. Processes which existed before, e.g. the
+    workers of a process pool, contribute their sampled RSS only. If no
+    such process was seen, e.g. for phases running in this process, the
+    peak is the largest sampled RSS of this process. Needs /proc,
+    `available` is False elsewhere.
+
+    All samplers of a process share one thread, which walks the process
+    tree once per interval for all of them, nested or concurrent
+    measurements add no further scans.
+    """
+    available = os.path.isdir(os.path.join(_PROC, "self"))
+    interval = 0.1
+    _active = []
+    _lock = threading.Lock()
+    _thread = None
+    _stop = None
+
+    def __init__(self, working_directory):
+        self.working_directory = os.path.realpath(working_directory)
+        self._children = {}
+        self._existing = set()
+        self._own = 0
+
+    def _update(self, own, processes):
+        """
+        Take a sample, {pid: (cwd, VmRSS, VmHWM)} of the descendants
+        """
+        self._own = max(self._own, own)
+        for pid, (cwd, rss, hwm) in processes.items():
+            if cwd != self.working_directory:
+                continue
+            peak = rss if pid in self._existing else hwm
+            if peak is not None:
+                self._children[pid] = max(self._children.get(pid, 0), peak)
+
+    @staticmethod
+    def _sample(samplers, descendants=None):
+        pid = os.getpid()
+        directories = {sampler.working_directory for sampler in samplers}
+        processes = {}
+        for child in _descendants(pid) if descendants is None else descendants:
+            cwd = _cwd(child)
+            if cwd in directories:
+                processes[child] = (cwd, _status_kb(child, "VmRSS"), _status_kb(child, "VmHWM"))
+        own = _status_kb(pid, "VmRSS") or 0
+        for sampler in samplers:
+            sampler._update(own, processes)
+
+    @classmethod
+    def _run(cls, stop):
+        while not stop.wait(cls.interval):
+            with cls._lock:
+                samplers = list(cls._active)
+            cls._sample(samplers)
+
+    def __enter__(self):
+        descendants = _descendants(os.getpid())
+        self._existing = set(descendants)
+        self._sample([self], descendants)
+        cls = type(self)
+        with cls._lock:
+            cls._active.append(self)
+            if cls._thread is None:
+                cls._stop = threading.Event()
+                cls._thread = threading.Thread(target=cls._run, args=(cls._stop,), daemon=True)
+                cls._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        cls = type(self)
+        with cls._lock:
+            cls._active.remove(self)
+            if len(cls._active) == 0:
+                # the thread ends after its current sample
+                cls._stop.set()
+                cls._thread = None
+        self._sample([self])
+
+    @property
+    def peak_rss(self):
+        """
+        Bytes, of the largest child process or else of this process
+        """
+        if len(self._children) > 0:
+            return max(self._children.values()) * 1024
+        return self._own * 1024
@@ -0,0 +1,316 @@
+import asyncio
+import collections
+import os
+import time
+
+from paraprobe_logs import parse_progress, parse_timing
+from paraprobe_reader import POS_RECORD_SIZE
+
+
+class LogTail:
+    """
+    New complete lines of a growing log file. The file is only opened when
+    its size changed, reading continues at the last offset.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.offset = 0
+        self._partial = b""
+
+    def read(self):
+        try:
+            size = os.stat(self.filename).st_size
+        except FileNotFoundError:
+            return []
+        if size < self.offset:
+            # truncated or replaced, start over
+            self.offset, self._partial = 0, b""
+        if size == self.offset:
+            return []
+        with open(self.filename, "rb") as fin:
+            fin.seek(self.offset)
+            data = self._partial + fin.read(size - self.offset)
+        self.offset = size
+        lines = data.split(b"\n")
+        self._partial = lines.pop()
+        return [line.decode(errors="replace") for line in lines]
+
+
+# pyiron job status of stage jobs which ended, and of those which run
+_FAILED = ("aborted", "not_converged")
+_FINISHED = ("finished", "warning")
+_RUNNING = ("running", "collect", "busy", "refresh")
+# stages which do not change any more
+ENDED = ("finished", "failed", "skipped")
+
+
+class StageProgress:
+    """
+    Progress of one stage job from its log.out: the last progress line, the
+    last finished phase and the rate over the recent progress lines.
+
+    The status is waiting until the job runs, then running, finished or
+    failed by the job status, and skipped if it never ran since an upstream
+    stage failed or was skipped or its pipeline job ended without it.
+    """
+    def __init__(self, label, stage, project, job_name, n_ions=None, upstream=(), parent=None,
+                 logfile="log.out", window=20):
+        self.label = label
+        self.stage = stage
+        self.project = project
+        self.job_name = job_name
+        self.n_ions = n_ions
+        self.upstream = tuple(upstream)
+        self.parent = parent
+        self._logfile = logfile
+        self._tail = None
+        self._log = None
+        self._samples = collections.deque(maxlen=window)
+        self.job_status = None
+        self.parent_status = None
+        self.status = "waiting"
+        self.phase = None
+        self.done = None
+        self.total = None
+
+    @property
+    def working_directory(self):
+        return None if self._tail is None else os.path.dirname(self._tail.filename)
+
+    def update(self, statuses):
+        """
+        Take the job status from a {job name: status} table of its project,
+        the job is looked up once it shows up. Returns whether it changed.
+        """
+        job_status = statuses.get(self.job_name)
+        parent_status = statuses.get(self.parent)
+        if self._tail is None and job_status is not None:
+            job = self.project.inspect(self.job_name)
+            if job is not None:
+                self._tail = LogTail(os.path.join(job.working_directory, self._logfile))
+        changed = (job_status, parent_status) != (self.job_status, self.parent_status)
+        self.job_status, self.parent_status = job_status, parent_status
+        return changed
+
+    def poll(self, now=None):
+        """
+        Read the new log lines, returns whether the log appeared or was
+        compressed, i.e. the job status is about to change
+        """
+        now = time.monotonic() if now is None else now
+        log = None
+        if self._tail is not None:
+            for line in self._tail.read():
+                timing = parse_timing(line)
+                if timing is not None:
+                    self.phase = timing[0]
+                progress = parse_progress(line)
+                if progress is not None:
+                    self.done, self.total = progress
+                    self._samples.append((now, self.fraction))
+            if os.path.exists(self._tail.filename):
+                log = "running"
+            elif os.path.exists(self._tail.filename + ".gz"):
+                # the log is compressed when the job collects its output
+                log = "collected"
+        if self.job_status in _FAILED:
+            self.status = "failed"
+        elif self.job_status in _FINISHED:
+            self.status = "finished"
+        elif self.job_status in _RUNNING or log is not None:
+            self.status = "running"
+        changed, self._log = log != self._log, log
+        return changed
+
+    @property
+    def fraction(self):
+        if self.status == "finished":
+            return 1.
+        if self.done is None:
+            return None
+        return min(self.done / self.total, 1.)
+
+    @property
+    def _fraction_rate(self):
+        if len(self._samples) < 2:
+            return None
+        (start, first), (stop, last) = self._samples[0], self._samples[-1]
+        if stop <= start or last <= first:
+            return None
+        return (last - first) / (stop - start)
+
+    @property
+    def rate(self):
+        """
+        Ions per second, or progress units per second if the number of ions
+        is unknown
+        """
+        fraction_rate = self._fraction_rate
+        if fraction_rate is None:
+            return None
+        return fraction_rate * (self.n_ions if self.n_ions is not None else self.total)
+
+    @property
+    def eta(self):
+        """
+        Seconds until the stage is done at the recent rate
+        """
+        fraction_rate = self._fraction_rate
+        if fraction_rate is None or self.status == "finished":
+            return None
+        return (1. - self.fraction) / fraction_rate
+
+    def to_dict(self):
+        return {"job": self.label, "stage": self.stage, "status": self.status, "phase": self.phase,
+                "fraction": self.fraction, "rate": self.rate, "eta": self.eta}
+
+
+def _count_ions(pos_file):
+    if pos_file is None or not os.path.exists(pos_file):
+        return None
+    return os.path.getsize(pos_file) // POS_RECORD_SIZE
+
+
+class ProgressMonitor:
+    """
+    Watch the log.out of many running stage jobs from one asyncio task.
+
+    Every poll costs one stat per running stage, a log is only read when it
+    grew and only the new part is parsed, with the progress and timing
+    patterns of paraprobe_logs. Job status comes from one job table query
+    per project, which is repeated at growing intervals, up to
+    max_query_interval seconds, while no job status changes. Polls run in a
+    thread, off the event loop.
+    """
+    def __init__(self, max_query_interval=60.):
+        self.stages = []
+        self.max_query_interval = max_query_interval
+        self._query_interval = 0.
+        self._next_query = None
+
+    def add(self, label, stage, project, job_name, n_ions=None, upstream=(), parent=None):
+        self.stages.append(StageProgress(label, stage, project, job_name, n_ions=n_ions, upstream=upstream,
+                                         parent=parent))
+
+    def add_job(self, job):
+        """
+        Add a stage job, the stage jobs of a ParaprobeJob or those of all
+        members of a ParaprobeBatch
+        """
+        if hasattr(job, "specimens"):
+            from paraprobe_job import _STAGES
+            for name in job.specimens:
+                entry = job.input.manifest[name]
+                member = job._member_name(name)
+                for stage in entry["stages"]:
+                    self.add(name, stage, job.project, f"{member}_{stage}", n_ions=_count_ions(entry["pos"]),
+                             upstream=_STAGES[stage][1], parent=member)
+        elif hasattr(job, "_selected_stages"):
+            from paraprobe_job import _STAGES
+            n_ions = _count_ions(job.pos_file)
+            for stage in job._selected_stages():
+                self.add(job.job_name, stage, job.project, f"{job.job_name}_{stage}", n_ions=n_ions,
+                         upstream=_STAGES[stage][1], parent=job.job_name)
+        else:
+            pos_file = None if job.pos_file is None else os.path.join(job.working_directory, job.pos_file)
+            self.add(job.job_name, job.stage_name, job.project, job.job_name, n_ions=_count_ions(pos_file))
+        return self
+
+    @classmethod
+    def for_job(cls, job):
+        return cls().add_job(job)
+
+    def _query(self):
+        """
+        Update the job status of the stages, one job table per project.
+        Returns whether any changed.
+        """
+        projects = {}
+        for stage in self.stages:
+            if stage.status not in ENDED:
+                projects.setdefault(stage.project.path, (stage.project, []))[1].append(stage)
+        changed = False
+        for project, stages in projects.values():
+            table = project.job_table(recursive=False)
+            statuses = dict(zip(table["job"], table["status"]))
+            for stage in stages:
+                changed = stage.update(statuses) or changed
+        return changed
+
+    def _skip(self):
+        """
+        Stages which will not run since an upstream stage did not finish or
+        their pipeline job ended
+        """
+        stages = {(stage.label, stage.stage): stage for stage in self.stages}
+        for stage in self.stages:
+            if stage.status != "waiting":
+                continue
+            upstream = [stages.get((stage.label, name)) for name in stage.upstream]
+            if (any(other is not None and other.status in ("failed", "skipped") for other in upstream)
+                    or stage.parent_status in _FAILED + _FINISHED):
+                stage.status = "skipped"
+
+    def poll(self):
+        now = time.monotonic()
+        if self._next_query is None or now >= self._next_query:
+            if self._query():
+                self._query_interval = 0.
+            else:
+                self._query_interval = min(max(2. * self._query_interval, 1.), self.max_query_interval)
+            self._next_query = now + self._query_interval
+        for stage in self.stages:
+            if stage.status not in ENDED and stage.poll(now):
+                # look up the job status on the next poll
+                self._next_query = None
+        # stages are added in the order of _STAGES, upstream stages first
+        self._skip()
+        return self.snapshot()
+
+    def snapshot(self):
+        return [stage.to_dict() for stage in self.stages]
+
+    @property
+    def finished(self):
+        """
+        Whether every stage finished, failed or was skipped
+        """
+        return all(stage.status in ENDED for stage in self.stages)
+
+    async def run(self, interval=2., callback=None, timeout=None):
+        """
+        Poll every interval seconds until all stages ended or the timeout
+        passed, callback gets every snapshot
+        """
+        start = time.monotonic()
+        while True:
+            snapshot = await asyncio.to_thread(self.poll)
+            if callback is not None:
+                callback(snapshot)
+            if self.finished or (timeout is not None and time.monotonic() - start > timeout):
+                return snapshot
+            await asyncio.sleep(interval)
+
+    def watch(self, interval=2., callback=None, timeout=None):
+        """
+        Run the monitor, as a task of the running event loop (e.g. in a
+        notebook) or else until it ends
+        """
+        callback = print_progress if callback is None else callback
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(self.run(interval=interval, callback=callback, timeout=timeout))
+        return loop.create_task(self.run(interval=interval, callback=callback, timeout=timeout))
+
+
+def _format(value, unit="", digits=1):
+    return "-" if value is None else f"{value:.{digits}f}{unit}"
+
+
+def print_progress(snapshot):
+    for row in snapshot:
+        fraction = None if row["fraction"] is None else 100. * row["fraction"]
+        print(f"{row['job']:<30s} {row['stage']:<12s} {row['status']:<9s} {_format(fraction, ' %'):>8s} "
+              f"{_format(row['rate'], ' ions/s', 0):>16s} ETA {_format(row['eta'], ' s', 0):>8s}  "
+              f"{row['phase'] or ''}")
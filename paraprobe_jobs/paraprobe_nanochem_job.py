@@ -1,23 +1,71 @@
+import json
 import os
 import numpy as np
 import shutil
 import sys
-import h5py
-import matplotlib.pyplot as plt
+import time
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
+from paraprobe_base_job import ParaprobeBase, _record_performance
+from paraprobe_configure import configure_nanochem, nanochem_tasks, PARAPROBE_IMPORT_MESSAGE, require_modules
+from paraprobe_results import read_nanochem_objects
 
-with ImportAlarm(
-    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
-    "requirements. Please install it and try again."
-) as paraprobe_alarm:
-    from paraprobe_parmsetup.nanochem_guru import ParmsetupNanochem, NanochemTask, Delocalization
+
+with ImportAlarm(PARAPROBE_IMPORT_MESSAGE) as paraprobe_alarm:
+    # the paraprobe modules are imported on first use, possibly in a worker
+    # process, only check here that they are installed
+    require_modules("paraprobe_parmsetup", "paraprobe_autoreporter")
+
+# arrays indexed by (element set, grid resolution, kernel sigma, isovalue),
+# evaluated is False where the results file has no isosurface group
+_SUMMARY = ["object_count", "object_volume", "edge_contact_count", "object_ion_count", "evaluated"]
+
+
+def _builtin(value):
+    return value.to_builtin() if hasattr(value, "to_builtin") else value
+
+
+def _report_nanochem(nanochem_results, n_tasks):
     from paraprobe_autoreporter.wizard.nanochem_report import AutoReporterNanochem
-    from paraprobe_parmsetup.utils.numerics import EPSILON
-    
+    nanochem_report = AutoReporterNanochem(nanochem_results, dataset_id=0)
+    for task in range(n_tasks):
+        nanochem_report.get_delocalization(delocalization_task_id=task)
+        nanochem_report.get_isosurface_objects_volume_and_number_over_isovalue(delocalization_task_id=task)
+
+
 class ParaprobeNanochem(ParaprobeBase):
+    """
+    Delocalization and isosurface object analysis. Every combination of
+    element set, grid resolution and kernel sigma is a delocalization task of
+    the same run, evaluated at all isovalues, so a parameter sweep is a
+    single job. Results are arrays indexed by (element set, grid resolution,
+    kernel sigma, isovalue). Isosurfaces whose groups the results file does
+    not have are not evaluated, their paths are in
+    output["nanochem/layout_missing"].
+
+    With input.isovalue_search = "adaptive" the isovalues are chosen in
+    rounds of child jobs instead: a coarse grid over the range of
+    input.isovalues first, then the midpoints of the intervals where the
+    object count or volume of any task changes by more than the tolerance,
+    relative to its maximum, until no interval qualifies or the budget of
+    isovalues or rounds is used up.
+
+    Every round is a full paraprobe-nanochem run, which computes the
+    delocalization again before extracting the isosurfaces of its
+    isovalues. R rounds cost R delocalizations against one for the fixed
+    grid, so the search only pays off when the extraction of the isovalues
+    it saves outweighs the extra delocalizations. Before every round after
+    the first the cost of a delocalization and of an isovalue is estimated
+    from the wall times of the rounds so far, and the search stops before a
+    round which would make it more expensive than the fixed grid of
+    adaptive/max_isovalues isovalues. A single round does not tell the two
+    apart, adaptive/delocalization_share of its wall time is taken as the
+    delocalization then; once rounds of different sizes ran they are fitted.
+    """
+    _stored_attributes = ParaprobeBase._stored_attributes + ("_nanochem_config", "_nanochem_results")
+    _result_groups = {"_nanochem_results": ["/entry"]}
+
+    @paraprobe_alarm
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self.surfacer_job = None
@@ -25,7 +73,39 @@ class ParaprobeNanochem(ParaprobeBase):
         self.ranger_job = None
         self._nanochem_config = None
         self._skip_copy_results = False
+        self.input.element_sets = [["Y", "Ti", "O"]]
+        # nm
+        self.input.grid_resolutions = [1.]
+        self.input.kernel_sigmas = [1.]
+        self.input.kernel_size = 3
+        self.input.isovalues = np.linspace(start=0.01, stop=0.21, num=21, endpoint=True)
+        self.input.normalization = "composition"
+        # one entry per isosurface object in output["nanochem/objects"], up
+        # to this number of objects, task and isosurface index into tasks
+        # and input.isovalues
+        self.input.max_stored_objects = 10**6
+        # fixed: evaluate input.isovalues, adaptive: refine within their range
+        self.input.isovalue_search = "fixed"
+        self.input["adaptive/initial_isovalues"] = 6
+        self.input["adaptive/tolerance"] = 0.05
+        self.input["adaptive/min_spacing"] = 1e-3
+        self.input["adaptive/max_isovalues"] = 21
+        self.input["adaptive/max_rounds"] = 2
+        # fraction of the wall time of the first round assumed to be the
+        # delocalization, until the rounds give a fit
+        self.input["adaptive/delocalization_share"] = 0.5
         
+    def _sweep_parameters(self):
+        return (_builtin(self.input.element_sets),
+                np.asarray(_builtin(self.input.grid_resolutions), dtype=np.float64),
+                np.asarray(_builtin(self.input.kernel_sigmas), dtype=np.float64),
+                np.asarray(_builtin(self.input.isovalues), dtype=np.float64))
+
+    @property
+    def tasks(self):
+        element_sets, grid_resolutions, kernel_sigmas, _ = self._sweep_parameters()
+        return nanochem_tasks(element_sets, grid_resolutions, kernel_sigmas)
+
     def _copy_results(self):
         if self._skip_copy_results:
             return
@@ -37,58 +117,25 @@ class ParaprobeNanochem(ParaprobeBase):
         if self.distancer_job is None:
             raise ValueError("Needs a distancer job!")
         
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_results))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_results))
+        for filename in self.ranger_job.result_files:
+            self._copy_file(filename)
         
         self._copy_file(os.path.join(self.surfacer_job.working_directory, self.surfacer_job._surfacer_results))
         self._copy_file(os.path.join(self.distancer_job.working_directory, self.distancer_job._distancer_results))
     
-    @_change_directory
-    @_pipe_output_to_file("config_nanochem.log")
+    @_record_performance("configure/nanochem")
     def _configure_nanochem(self):
-        nanochem = ParmsetupNanochem()
-        dataset = NanochemTask()
-        dataset.load_reconstruction_and_ranging(
-            ranging_applied=True,
-            working_directory=self.working_directory,
-            transcoder_config_sim_id=self.jobid,
-            transcoder_results_sim_id=self.jobid,
-            ranger_results_sim_id=self.jobid)
-        dataset.load_edge_model(
-                file_name=os.path.join(self.working_directory, 'PARAPROBE.Surfacer.Results.SimID.636502001.h5'),
-                dataset_name_vertices='/entry/process0/point_set_wrapping0/alpha_complex/triangle_set/triangles/vertices',
-                dataset_name_facet_indices='/entry/process0/point_set_wrapping0/alpha_complex/triangle_set/triangles/faces')    
-        dataset.load_ion_to_edge_distances(
-                file_name=os.path.join(self.working_directory, 'PARAPROBE.Distancer.Results.SimID.636502001.h5'),
-                dataset_name='/entry/process0/point_to_triangle_set/distance')        
-        
-        task = Delocalization()
-        task.set_delocalization_input(source='default')
-        task.set_delocalization_normalization(method='composition')
-        task.set_delocalization_elements(['Y', 'Ti', 'O'])
-        task.set_delocalization_gridresolutions(length=[1.])
-        task.set_delocalization_kernel(sigma=[1.0], size=3)
-        task.set_delocalization_isosurfaces(phi=np.linspace(start=0.01, stop=0.21, num=21, endpoint=True))
-        task.set_delocalization_edge_handling(method='default')
-        task.set_delocalization_edge_threshold(EPSILON)
-        task.report_fields_and_gradients(True)
-        task.report_triangle_soup(True)
-        task.report_objects(True)
-        task.report_objects_properties(True)
-        task.report_objects_geometry(True)
-        task.report_objects_optimal_bounding_box(True)
-        task.report_objects_ions(True)
-        task.report_objects_edge_contact(True)
-        task.report_proxies(False)
-        task.report_proxies_properties(False)
-        task.report_proxies_geometry(False)
-        task.report_proxies_optimal_bounding_box(False)
-        task.report_proxies_ions(False)
-
-        nanochem.add_task(dataset, task)
-        self._nanochem_config = nanochem.configure(self.jobid)
+        tasks = self.tasks
+        isovalues = self._sweep_parameters()[3]
+        # parameters of every task id, for reading the results file by hand
+        with open(os.path.join(self.working_directory, "nanochem_tasks.json"), "w") as fout:
+            json.dump({"tasks": [{"elements": elements, "grid_resolution": grid, "kernel_sigma": sigma}
+                                 for elements, grid, sigma in tasks],
+                       "isovalues": isovalues.tolist()}, fout, indent=1)
+        self._nanochem_config = self.execution_context.call(
+            configure_nanochem, "config_nanochem.log", self.working_directory, jobid=self.jobid,
+            tasks=tasks, kernel_size=self.input.kernel_size, isovalues=isovalues,
+            normalization=self.input.normalization)
 
     def _executable_activate(self, enforce = False):
         if self._executable is None or enforce:
@@ -104,22 +151,177 @@ class ParaprobeNanochem(ParaprobeBase):
 
         self.pos_file = self._copy_file(self.pos_file)
         self.rrng_file = self._copy_file(self.rrng_file)
+        if self._adaptive:
+            # the rounds run as child jobs
+            self._skip_execution = True
+            return
         self._copy_results()
         self._configure_nanochem()
 
+    @property
+    def _adaptive(self):
+        return self.input.isovalue_search == "adaptive"
+
+    def _run_round(self, round_id, isovalues):
+        job = self.project.create_job(job_type=ParaprobeNanochem, job_name=self._round_name(round_id),
+                                      delete_existing_job=True)
+        for key in ["element_sets", "grid_resolutions", "kernel_sigmas", "kernel_size", "normalization",
+                    "max_stored_objects", "staging", "isolation"]:
+            job.input[key] = _builtin(self.input[key])
+        job.input.isovalues = np.asarray(isovalues)
+        job.pos_file = os.path.join(self.working_directory, self.pos_file)
+        job.rrng_file = os.path.join(self.working_directory, self.rrng_file)
+        job.ranger_job = self.ranger_job
+        job.surfacer_job = self.surfacer_job
+        job.distancer_job = self.distancer_job
+        job.server.cores = self.server.cores
+        job.run()
+        return job
+
+    def _refine(self, isovalues, counts, volumes, evaluated):
+        """
+        Midpoints of the intervals with the largest changes, at most as many
+        as the budget allows, intervals ending at an isovalue which was not
+        evaluated for every task do not qualify
+        """
+        counts = counts.reshape(-1, len(isovalues))
+        volumes = volumes.reshape(-1, len(isovalues))
+        evaluated = evaluated.reshape(-1, len(isovalues)).all(axis=0)
+        change = np.maximum(
+            np.abs(np.diff(counts, axis=1)) / np.maximum(counts.max(axis=1, keepdims=True), 1),
+            np.abs(np.diff(volumes, axis=1)) / np.maximum(volumes.max(axis=1, keepdims=True), 1e-300),
+        ).max(axis=0)
+        candidates = (change > self.input["adaptive/tolerance"]) \
+            & (np.diff(isovalues) > 2 * self.input["adaptive/min_spacing"]) \
+            & evaluated[:-1] & evaluated[1:]
+        order = np.argsort(-change[candidates], kind="stable")
+        budget = self.input["adaptive/max_isovalues"] - len(isovalues)
+        index = np.flatnonzero(candidates)[order][:max(budget, 0)]
+        return np.sort(0.5 * (isovalues[index] + isovalues[index + 1]))
+
+    def _round_name(self, round_id):
+        return f"{self.job_name}_round{round_id}"
+
+    @staticmethod
+    def _merge_rounds(jobs):
+        """
+        Isovalues of all rounds in ascending order, the round of every
+        isovalue and the summary arrays along the isovalues
+        """
+        isovalues = np.concatenate([np.asarray(job.output["nanochem/parameters/isovalues"]) for job in jobs])
+        rounds = np.concatenate([np.full(len(job.output["nanochem/parameters/isovalues"]), round_id)
+                                 for round_id, job in enumerate(jobs)])
+        order = np.argsort(isovalues, kind="stable")
+        summary = {key: np.concatenate([job.output[f"nanochem/{key}"] for job in jobs], axis=-1)[..., order]
+                   for key in _SUMMARY}
+        return isovalues[order], rounds[order], summary
+
+    @staticmethod
+    def _round_costs(wall_times, n_isovalues, delocalization_share):
+        """
+        Seconds of a delocalization and of one isovalue, fitted to the wall
+        times of the rounds, or split by delocalization_share while the
+        rounds do not tell them apart, None before the first round
+        """
+        if len(wall_times) == 0:
+            return None
+        if len(set(n_isovalues)) < 2:
+            delocalization = delocalization_share * np.mean(wall_times)
+            return delocalization, (np.mean(wall_times) - delocalization) / n_isovalues[0]
+        design = np.column_stack([np.ones(len(n_isovalues)), n_isovalues])
+        (delocalization, isovalue), *_ = np.linalg.lstsq(design, np.asarray(wall_times), rcond=None)
+        return max(delocalization, 0.), max(isovalue, 0.)
+
+    def _run_adaptive_search(self):
+        """
+        Run the rounds, their number, wall times and isovalues go to the
+        output, the results are collected from the round jobs
+        """
+        bounds = self._sweep_parameters()[3]
+        new = np.linspace(bounds.min(), bounds.max(), self.input["adaptive/initial_isovalues"])
+        jobs, wall_times, n_isovalues = [], [], []
+        stopped = "converged"
+        for round_id in range(self.input["adaptive/max_rounds"]):
+            if len(new) == 0:
+                break
+            costs = self._round_costs(wall_times, n_isovalues, self.input["adaptive/delocalization_share"])
+            if costs is not None:
+                delocalization, isovalue = costs
+                grid = delocalization + self.input["adaptive/max_isovalues"] * isovalue
+                if sum(wall_times) + delocalization + len(new) * isovalue > grid:
+                    stopped = "cost"
+                    break
+            start = time.perf_counter()
+            jobs.append(self._run_round(round_id, new))
+            wall_times.append(time.perf_counter() - start)
+            n_isovalues.append(len(new))
+            isovalues, _, summary = self._merge_rounds(jobs)
+            new = self._refine(isovalues, summary["object_count"], summary["object_volume"], summary["evaluated"])
+        else:
+            if len(new) > 0:
+                stopped = "max_rounds"
+        self.output["nanochem/adaptive/rounds"] = len(jobs)
+        self.output["nanochem/adaptive/wall_times"] = np.array(wall_times)
+        self.output["nanochem/adaptive/isovalues_per_round"] = np.array(n_isovalues)
+        self.output["nanochem/adaptive/stopped"] = stopped
+
+    def run_static(self):
+        if self._adaptive:
+            with self._measure(f"execute/{self.stage_name}"):
+                self._run_adaptive_search()
+        super().run_static()
+
+    @_record_performance("collect/nanochem")
     def collect_output(self):
+        if self._adaptive:
+            self._collect_adaptive_results()
+            return
         self._collect_nanochem_results()
         self._collect_logs()
+
+    def _store_parameters(self, isovalues):
+        element_sets, grid_resolutions, kernel_sigmas, _ = self._sweep_parameters()
+        self.output["nanochem/parameters/element_sets"] = [",".join(elements) for elements in element_sets]
+        self.output["nanochem/parameters/grid_resolutions"] = grid_resolutions
+        self.output["nanochem/parameters/kernel_sigmas"] = kernel_sigmas
+        self.output["nanochem/parameters/isovalues"] = isovalues
+        return len(element_sets), len(grid_resolutions), len(kernel_sigmas), len(isovalues)
+
+    def _collect_adaptive_results(self):
+        jobs = [self.project.load(self._round_name(round_id))
+                for round_id in range(self.output["nanochem/adaptive/rounds"])]
+        isovalues, rounds, summary = self._merge_rounds(jobs)
+        self._nanochem_results = jobs[-1]._nanochem_results
+        self._store_parameters(isovalues)
+        for key, values in summary.items():
+            self.output[f"nanochem/{key}"] = values
+        missing = [path for job in jobs for path in job.output.get("nanochem/layout_missing", [])]
+        if len(missing) > 0:
+            self.output["nanochem/layout_missing"] = list(dict.fromkeys(missing))
+        # round in which every isovalue was evaluated, the objects are in the
+        # output of the jobs <job name>_round<round>
+        self.output["nanochem/adaptive/round"] = rounds
         
-    @_pipe_output_to_file("result_nanochem.log")
     def _collect_nanochem_results(self):
         self._nanochem_results = os.path.join(self.working_directory, f"PARAPROBE.Nanochem.Results.SimID.{self.jobid}.h5")
-        nanochem_report = AutoReporterNanochem(self._nanochem_results, dataset_id=0)
-        nanochem_report.get_delocalization(delocalization_task_id=0)
-        nanochem_report.get_isosurface_objects_volume_and_number_over_isovalue(delocalization_task_id=0)
+        shape = self._store_parameters(self._sweep_parameters()[3])
+        self.execution_context.call(_report_nanochem, "result_nanochem.log", self._nanochem_results,
+                                    len(self.tasks), change_directory=False)
+        results = read_nanochem_objects(self._nanochem_results, len(self.tasks), shape[-1],
+                                        max_objects=self.input.max_stored_objects)
+        for key in _SUMMARY:
+            self.output[f"nanochem/{key}"] = results[key].reshape(shape)
+        if len(results["missing"]) > 0:
+            # the layout of paraprobe_results is not confirmed for the
+            # installed paraprobe, see benchmarks/check_layout.py
+            self.output["nanochem/layout_missing"] = results["missing"]
+        if results["objects"] is not None:
+            for key, values in results["objects"].items():
+                self.output[f"nanochem/objects/{key}"] = values
 
+    @_record_performance("logs/nanochem")
     def _collect_logs(self):
-        config_nanochem_log = self._read_temporary_output_file("config_nanochem.log", clean=False)
-        execute_nanochem_log = self._read_temporary_output_file("log.out", clean=False)
-        self.output["log/configure/nanochem"] = config_nanochem_log
-        self.output["log/execute/nanochem"] = execute_nanochem_log
\ No newline at end of file
+        self._ingest_logs({
+            "configure/nanochem": "config_nanochem.log",
+            "execute/nanochem": "log.out",
+        })
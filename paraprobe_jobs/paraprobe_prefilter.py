@@ -0,0 +1,75 @@
+import numpy as np
+
+from paraprobe_reader import read_pos, iterate_pos, POS_DTYPE
+
+
+def _bounding_box(positions, chunk_size):
+    lower = np.full(3, np.inf)
+    upper = np.full(3, -np.inf)
+    for _, block in iterate_pos(positions, chunk_size=chunk_size):
+        lower = np.minimum(lower, block[:, :3].min(axis=0))
+        upper = np.maximum(upper, block[:, :3].max(axis=0))
+    return lower, upper
+
+
+def _interior_voxels(occupied):
+    """
+    Voxels which are occupied together with all of their 26 neighbours
+    """
+    padded = np.pad(occupied, 1, constant_values=False)
+    interior = occupied.copy()
+    nx, ny, nz = occupied.shape
+    for dx in range(3):
+        for dy in range(3):
+            for dz in range(3):
+                interior &= padded[dx:dx + nx, dy:dy + ny, dz:dz + nz]
+    return interior
+
+
+def boundary_filter(pos_file, output_file, voxel_size=1., max_per_voxel=None, chunk_size=2**20):
+    """
+    Write the ions of pos_file which can lie on the convex hull to
+    output_file, dropping the ions of interior voxels.
+
+    An ion p in a voxel whose 26 neighbours all hold ions is never on the
+    convex hull: for any direction u the neighbour voxel offset by sign(u)
+    holds an ion q with u.q > u.p. The hull of the kept ions therefore
+    equals the hull of all ions. With max_per_voxel only the first ions of
+    every boundary voxel are kept, which moves the hull by at most one voxel
+    diagonal (Hausdorff distance).
+
+    Returns the number of ions read and written and the Hausdorff bound.
+    """
+    positions = read_pos(pos_file)
+    lower, upper = _bounding_box(positions, chunk_size)
+    shape = np.maximum(np.floor((upper - lower) / voxel_size).astype(np.int64) + 1, 1)
+
+    def voxel_index(block):
+        voxel = np.minimum(((block[:, :3] - lower) / voxel_size).astype(np.int64), shape - 1)
+        return np.ravel_multi_index(voxel.T, shape)
+
+    occupied = np.zeros(int(np.prod(shape)), dtype=bool)
+    for _, block in iterate_pos(positions, chunk_size=chunk_size):
+        occupied[voxel_index(block)] = True
+    interior = _interior_voxels(occupied.reshape(shape)).ravel()
+    del occupied
+
+    seen = np.zeros(len(interior), dtype=np.int64) if max_per_voxel is not None else None
+    kept = 0
+    with open(output_file, "wb") as fout:
+        for _, block in iterate_pos(positions, chunk_size=chunk_size):
+            voxel = voxel_index(block)
+            keep = ~interior[voxel]
+            if seen is not None:
+                # rank of every ion among the ions of its voxel in this chunk
+                order = np.argsort(voxel, kind="stable")
+                sorted_voxel = voxel[order]
+                first = np.searchsorted(sorted_voxel, sorted_voxel, side="left")
+                rank = np.empty(len(voxel), dtype=np.int64)
+                rank[order] = np.arange(len(voxel)) - first
+                keep &= seen[voxel] + rank < max_per_voxel
+                seen += np.bincount(voxel, minlength=len(seen))
+            fout.write(block[keep].astype(POS_DTYPE).tobytes())
+            kept += int(np.count_nonzero(keep))
+    hausdorff_bound = 0. if max_per_voxel is None else float(np.sqrt(3.) * voxel_size)
+    return len(positions), kept, hausdorff_bound
@@ -0,0 +1,52 @@
+import numpy as np
+
+from paraprobe_reader import read_pos, read_rrng, iterate_pos
+
+
+def quick_range(pos_file, rrng_file, chunk_size=2**20):
+    """
+    Range the ions of a .pos file in process, without transcoder and
+    paraprobe-ranger: every ion is labelled by a binary search over the
+    sorted mass-to-charge ranges, the .pos file is processed in chunks.
+
+    The composition is given in at.-%, each molecular ion contributes its
+    multiplicity of every element.
+    """
+    positions = read_pos(pos_file)
+    table = read_rrng(rrng_file)
+    # index 0 counts the unranged ions
+    counts = np.zeros(len(table) + 1, dtype=np.int64)
+    for _, block in iterate_pos(positions, chunk_size=chunk_size):
+        counts += np.bincount(table.label(block[:, 3]) + 1, minlength=len(table) + 1)
+
+    iontypes = sorted(set(table.names))
+    iontype_counts = np.zeros(len(iontypes), dtype=np.int64)
+    for name, count in zip(table.names, counts[1:]):
+        iontype_counts[iontypes.index(name)] += count
+
+    elements = table.elements
+    multiplicity = np.array([[composition.get(element, 0) for element in elements]
+                             for composition in table.compositions], dtype=np.int64).reshape(len(table), len(elements))
+    atoms = counts[1:] @ multiplicity
+    composition = 100. * atoms / max(atoms.sum(), 1)
+    return {
+        "ion_count": int(counts.sum()),
+        "unranged_count": int(counts[0]),
+        "iontypes": iontypes,
+        "iontype_counts": iontype_counts,
+        "elements": elements,
+        "composition": composition,
+    }
+
+
+def compare_composition(reference, elements, composition, tolerance=0.1):
+    """
+    Absolute difference in at.-% between a reference composition
+    {element: value} and a quick-look composition
+    """
+    differences = {}
+    for element, value in zip(elements, composition):
+        if element in reference:
+            differences[element] = float(value) - float(reference[element])
+    passed = len(differences) > 0 and all(abs(d) <= tolerance for d in differences.values())
+    return differences, passed
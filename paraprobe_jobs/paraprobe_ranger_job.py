@@ -3,41 +3,77 @@ import numpy as np
 import shutil
 import sys
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
-
-with ImportAlarm(
-    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
-    "requirements. Please install it and try again."
-) as paraprobe_alarm:
-    from paraprobe_parmsetup.transcoder_guru import ParmsetupTranscoder
-    from paraprobe_parmsetup.ranger_guru import ParmsetupRanger
-    from paraprobe_transcoder.paraprobe_transcoder import ParaprobeTranscoder
-    from paraprobe_autoreporter.wizard.ranger_report import AutoReporterRanger
-    
+from paraprobe_base_job import ParaprobeBase, _record_performance, _h5web
+from paraprobe_configure import configure_transcoder, execute_transcoder, configure_ranger, report_ranger, PARAPROBE_IMPORT_MESSAGE, require_modules
+from paraprobe_cache import ResultCache, hash_file, hash_configuration, paraprobe_version
+from paraprobe_reader import preflight_check
+from paraprobe_quicklook import quick_range, compare_composition
+from paraprobe_results import RANGER_LAYOUT, missing_paths, read_ranger_results
+
+
+with ImportAlarm(PARAPROBE_IMPORT_MESSAGE) as paraprobe_alarm:
+    # the paraprobe modules are imported on first use, possibly in a worker
+    # process, only check here that they are installed
+    require_modules("paraprobe_parmsetup", "paraprobe_transcoder")
+
+
 class ParaprobeRanger(ParaprobeBase):
+    _stored_attributes = ParaprobeBase._stored_attributes + ("_transcoder_config", "_transcoder_results", "_ranger_config", "_ranger_results")
+    _result_groups = {
+        "_transcoder_results": ["/entry"],
+        "_ranger_results": ["/entry"],
+    }
+
+    @paraprobe_alarm
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self._transcoder_config = None
         self._transcoder_results = None
         self._ranger_config = None
-                
+        self._ranger_results = None
+        self._cache_key = None
+        self.input.cache = False
+        self.input.cache_max_bytes = 50 * 2**30
+        self.input.preflight = True
+        # paraprobe: transcoder and paraprobe-ranger, quicklook: in-process
+        # ranging only, crosscheck: both, compared within the tolerance in at.-%
+        self.input.ranging = "paraprobe"
+        self.input.crosscheck_tolerance = 0.1
+
+    @property
+    def result_files(self):
+        """
+        The transcoder and ranger configuration and result files, which the
+        downstream stages stage into their working directories
+        """
+        if self.input.ranging == "quicklook":
+            raise ValueError(f"Ranger job {self.job_name} uses ranging=\"quicklook\" and writes no paraprobe "
+                             "result files, use ranging=\"paraprobe\" or \"crosscheck\" for downstream stages")
+        return [os.path.join(self.working_directory, filename) for filename in
+                [self._transcoder_config, self._transcoder_results, self._ranger_config, self._ranger_results]]
+
+    def validate_results(self):
+        if self.input.ranging == "quicklook":
+            # the results are the job output, there are no result files
+            return self.output.get("ranger/ion_count") is not None
+        return super().validate_results()
+
     @property
     def transcoder_config(self):
-        return H5Web(self._transcoder_config)
+        return _h5web(self._transcoder_config)
 
     @property
     def transcoder_results(self):
-        return H5Web(self._transcoder_results)
+        return _h5web(self._transcoder_results)
 
     @property
     def ranger_config(self):
-        return H5Web(self._ranger_config)
+        return _h5web(self._ranger_config)
 
     @property
     def ranger_results(self):
-        return H5Web(self._ranger_results)
+        return _h5web(self._ranger_results)
             
     def _executable_activate(self, enforce = False):
         if self._executable is None or enforce:
@@ -47,69 +83,170 @@ class ParaprobeRanger(ParaprobeBase):
                 path_binary_codes=state.settings.resource_paths
             )
     
-    @_change_directory
-    @_pipe_output_to_file("config_transcoder.log")
+    @_record_performance("configure/transcoder")
     def _configure_transcoder(self):
-        transcoder = ParmsetupTranscoder()
-        self._transcoder_config = transcoder.load_reconstruction_and_ranging(
-        working_directory=self.working_directory,
-        reconstructed_dataset=self.pos_file,
-        ranging_definitions=self.rrng_file,
-        jobid=self.jobid)
+        self._transcoder_config = self.execution_context.call(
+            configure_transcoder, "config_transcoder.log",
+            working_directory=self.working_directory,
+            pos_file=self.pos_file,
+            rrng_file=self.rrng_file,
+            jobid=self.jobid)
     
-    @_change_directory
-    @_pipe_output_to_file("execute_transcoder.log")
+    @_record_performance("execute/transcoder")
     def _execute_transcoder(self):
-        transcoder = ParaprobeTranscoder(self._transcoder_config)
-        self._transcoder_results = transcoder.execute()
+        self._transcoder_results = self.execution_context.call(
+            execute_transcoder, "execute_transcoder.log", self._transcoder_config)
     
-    @_change_directory
-    @_pipe_output_to_file("config_ranger.log")
+    @_record_performance("configure/ranger")
     def _configure_ranger(self):
-        ranger = ParmsetupRanger()
-        self._ranger_config = ranger.apply_existent_ranging(self.working_directory, 
-                                    transcoder_config_sim_id=self.jobid,
-                                    transcoder_results_sim_id=self.jobid,
-                                    ranger_results_sim_id=self.jobid)
+        self._ranger_config = self.execution_context.call(
+            configure_ranger, "config_ranger.log", self.working_directory, jobid=self.jobid)
         
     def write_input(self):
         if ((self.pos_file is None) or (self.rrng_file is None)):
             raise ValueError("Set files")
 
+        if self.input.preflight:
+            self._preflight()
         self.pos_file = self._copy_file(self.pos_file)
         self.rrng_file = self._copy_file(self.rrng_file)
+        if self.input.ranging == "quicklook":
+            self._skip_execution = True
+            return
+        if self.input.cache and self._load_from_cache():
+            return
         self._configure_transcoder()
         self._execute_transcoder()
         self._configure_ranger()
-    
+
+    def _preflight(self):
+        """
+        Fail before the transcoder is configured if the .pos/.rrng pair is broken
+        """
+        report, problems = preflight_check(self.pos_file, self.rrng_file)
+        for key, value in report.items():
+            self.output[f"preflight/{key}"] = value
+        if len(problems) > 0:
+            raise ValueError("Preflight check failed: " + "; ".join(problems))
+
+    @property
+    def result_cache(self):
+        return ResultCache(os.path.join(self.project.path, "paraprobe_cache"),
+                           max_bytes=self.input.cache_max_bytes)
+
+    def _get_cache_key(self):
+        return hash_configuration({
+            "stage": "ranger",
+            "paraprobe": paraprobe_version(),
+            "jobid": self.jobid,
+            "pos": hash_file(os.path.join(self.working_directory, self.pos_file)),
+            "rrng": hash_file(os.path.join(self.working_directory, self.rrng_file)),
+        })
+
+    def _update_cache_statistics(self, hit):
+        statistics = self.result_cache.statistics
+        self.output["cache/key"] = self._cache_key
+        self.output["cache/hit"] = hit
+        self.output["cache/hits"] = statistics["hits"]
+        self.output["cache/misses"] = statistics["misses"]
+
+    def _load_from_cache(self):
+        self._cache_key = self._get_cache_key()
+        cache = self.result_cache
+        entry = cache.fetch(self._cache_key, self.working_directory, mode=self.input.staging)
+        if entry is not None:
+            for attribute, filename in entry["artifacts"].items():
+                setattr(self, attribute, filename)
+            self._skip_execution = True
+        self._update_cache_statistics(hit=entry is not None)
+        return entry is not None
+
+    def _store_in_cache(self):
+        artifacts = {
+            "_transcoder_config": os.path.basename(self._transcoder_config),
+            "_transcoder_results": os.path.basename(self._transcoder_results),
+            "_ranger_config": os.path.basename(self._ranger_config),
+        }
+        filenames = list(artifacts.values()) + [
+            os.path.basename(self._ranger_results),
+            "config_transcoder.log.gz", "execute_transcoder.log.gz", "config_ranger.log.gz", "log.out.gz"
+        ]
+        self.result_cache.store(self._cache_key,
+                                [os.path.join(self.working_directory, f) for f in filenames],
+                                artifacts=artifacts)
+
+    @_record_performance("logs/ranger")
     def _collect_logs(self):
-        config_transcoder_log = self._read_temporary_output_file("config_transcoder.log", clean=False)
-        execute_transcoder_log = self._read_temporary_output_file("execute_transcoder.log", clean=False)
-        config_ranger_log = self._read_temporary_output_file("config_ranger.log", clean=False)
-        execute_ranger_log = self._read_temporary_output_file("log.out", clean=False)
-        self.output["log/configure/transcoder"] = config_transcoder_log
-        self.output["log/execute/transcoder"] = execute_transcoder_log
-        self.output["log/configure/ranger"] = config_ranger_log
-        self.output["log/execute/ranger"] = execute_ranger_log
+        self._ingest_logs({
+            "configure/transcoder": "config_transcoder.log",
+            "execute/transcoder": "execute_transcoder.log",
+            "configure/ranger": "config_ranger.log",
+            "execute/ranger": "log.out",
+        })
         
-    @_pipe_output_to_file("result_ranger.log")
     def _collect_ranger_results(self):
         self._ranger_results = os.path.join(self.working_directory, f"PARAPROBE.Ranger.Results.SimID.{self.jobid}.h5")
-        ranger_report = AutoReporterRanger(self._ranger_results, self.jobid)
-        ranger_report.get_summary()
-    
-    def _parse_ranger_results(self):
+        missing = missing_paths(self._ranger_results, RANGER_LAYOUT)
+        if len(missing) > 0:
+            self._collect_ranger_report(missing)
+            return
+        results = read_ranger_results(self._ranger_results)
+        self.output["ranger/ion_count"] = results["ion_count"]
+        self.output["ranger/unit"] = "at. wt%"
+        for element, value in zip(results["elements"], results["composition"]):
+            self.output[f"ranger/{element}"] = float(value)
+        self.output["ranger/iontypes/names"] = results["iontype_names"]
+        self.output["ranger/iontypes/counts"] = results["iontype_counts"]
+        self.output["ranger/iontypes/multiplicities"] = results["multiplicities"]
+        self.output["ranger/iontypes/elements"] = results["elements"]
+
+    def _collect_ranger_report(self, missing):
+        """
+        Ion count and composition from the autoreporter summary, for results
+        files without the layout of paraprobe_results, whose missing paths
+        are stored in output["ranger/layout_missing"]
+        """
+        self.execution_context.call(report_ranger, "result_ranger.log", self._ranger_results, self.jobid,
+                                    change_directory=False)
         lines = self._read_temporary_output_file("result_ranger.log")
         self.output["ranger/ion_count"] = int(lines[0][2].strip(','))
         self.output["ranger/unit"] = "at. wt%"
         for line in lines[1:]:
-            key = line[3].strip(',')  
-            self.output[f'ranger/{key}'] = float(line[1].strip(','))        
-        
+            self.output[f"ranger/{line[3].strip(',')}"] = float(line[1].strip(','))
+        self.output["ranger/layout_missing"] = missing
+
+    def _collect_quicklook_results(self, group):
+        results = quick_range(os.path.join(self.working_directory, self.pos_file),
+                              os.path.join(self.working_directory, self.rrng_file))
+        self.output[f"{group}/ion_count"] = results["ion_count"]
+        self.output[f"{group}/unit"] = "at. wt%"
+        for element, value in zip(results["elements"], results["composition"]):
+            self.output[f"{group}/{element}"] = float(value)
+        self.output[f"{group}/iontypes/names"] = results["iontypes"]
+        self.output[f"{group}/iontypes/counts"] = results["iontype_counts"]
+        return results
+
+    def _crosscheck(self, results):
+        reference = {key: value for key, value in self.output["ranger"].items()
+                     if key not in ["ion_count", "unit"] and isinstance(value, float)}
+        differences, passed = compare_composition(reference, results["elements"], results["composition"],
+                                                  tolerance=self.input.crosscheck_tolerance)
+        for element, difference in differences.items():
+            self.output[f"crosscheck/difference/{element}"] = difference
+        self.output["crosscheck/ion_count_difference"] = results["ion_count"] - self.output["ranger/ion_count"]
+        self.output["crosscheck/passed"] = passed
+
+    @_record_performance("collect/ranger")
     def collect_output(self):
+        if self.input.ranging == "quicklook":
+            self._collect_quicklook_results("ranger")
+            return
         self._collect_ranger_results()
-        self._parse_ranger_results()
         self._collect_logs()
+        if self.input.ranging == "crosscheck":
+            self._crosscheck(self._collect_quicklook_results("quicklook"))
+        if self.input.cache and not self._skip_execution:
+            self._store_in_cache()
         
     
 
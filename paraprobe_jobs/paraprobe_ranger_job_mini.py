@@ -3,20 +3,46 @@ import numpy as np
 import shutil
 import sys
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
+from paraprobe_base_job import ParaprobeBase, _h5web
+from paraprobe_configure import PARAPROBE_IMPORT_MESSAGE, require_modules
 
-with ImportAlarm(
-    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
-    "requirements. Please install it and try again."
-) as paraprobe_alarm:
+with ImportAlarm(PARAPROBE_IMPORT_MESSAGE) as paraprobe_alarm:
+    # the paraprobe modules are imported on first use, possibly in a worker
+    # process, only check here that they are installed
+    require_modules("paraprobe_parmsetup", "paraprobe_transcoder", "paraprobe_autoreporter")
+
+# same steps as paraprobe_configure, for the paraprobe_parmsetup.tools layout,
+# at module level so that they can run in a worker process
+def _configure_transcoder(working_directory, pos_file, rrng_file, jobid):
     from paraprobe_parmsetup.tools.transcoder_guru import ParmsetupTranscoder
-    from paraprobe_parmsetup.tools.ranger_guru import ParmsetupRanger
+    transcoder = ParmsetupTranscoder()
+    return transcoder.load_reconstruction_and_ranging(
+        working_directory=working_directory,
+        reconstructed_dataset=pos_file,
+        ranging_definitions=rrng_file,
+        jobid=jobid)
+
+def _execute_transcoder(transcoder_config):
     from paraprobe_transcoder.paraprobe_transcoder import ParaprobeTranscoder
+    transcoder = ParaprobeTranscoder(transcoder_config)
+    return transcoder.execute()
+
+def _configure_ranger(working_directory, jobid):
+    from paraprobe_parmsetup.tools.ranger_guru import ParmsetupRanger
+    ranger = ParmsetupRanger()
+    return ranger.apply_existent_ranging(working_directory,
+                                         transcoder_config_sim_id=jobid,
+                                         transcoder_results_sim_id=jobid,
+                                         ranger_results_sim_id=jobid)
+
+def _report_ranger(ranger_results, jobid):
     from paraprobe_autoreporter.wizard.ranger_report import AutoReporterRanger
+    ranger_report = AutoReporterRanger(ranger_results, jobid)
+    ranger_report.get_summary()
     
 class ParaprobeRanger(ParaprobeBase):
+    @paraprobe_alarm
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self._transcoder_config = None
@@ -25,19 +51,19 @@ class ParaprobeRanger(ParaprobeBase):
                 
     @property
     def transcoder_config(self):
-        return H5Web(self._transcoder_config)
+        return _h5web(self._transcoder_config)
 
     @property
     def transcoder_results(self):
-        return H5Web(self._transcoder_results)
+        return _h5web(self._transcoder_results)
 
     @property
     def ranger_config(self):
-        return H5Web(self._ranger_config)
+        return _h5web(self._ranger_config)
 
     @property
     def ranger_results(self):
-        return H5Web(self._ranger_results)
+        return _h5web(self._ranger_results)
             
     def _executable_activate(self, enforce = False):
         if self._executable is None or enforce:
@@ -47,30 +73,21 @@ class ParaprobeRanger(ParaprobeBase):
                 path_binary_codes=state.settings.resource_paths
             )
     
-    @_change_directory
-    @_pipe_output_to_file("config_transcoder.log")
     def _configure_transcoder(self):
-        transcoder = ParmsetupTranscoder()
-        self._transcoder_config = transcoder.load_reconstruction_and_ranging(
-        working_directory=self.working_directory,
-        reconstructed_dataset=self.pos_file,
-        ranging_definitions=self.rrng_file,
-        jobid=self.jobid)
+        self._transcoder_config = self.execution_context.call(
+            _configure_transcoder, "config_transcoder.log",
+            working_directory=self.working_directory,
+            pos_file=self.pos_file,
+            rrng_file=self.rrng_file,
+            jobid=self.jobid)
     
-    @_change_directory
-    @_pipe_output_to_file("execute_transcoder.log")
     def _execute_transcoder(self):
-        transcoder = ParaprobeTranscoder(self._transcoder_config)
-        self._transcoder_results = transcoder.execute()
+        self._transcoder_results = self.execution_context.call(
+            _execute_transcoder, "execute_transcoder.log", self._transcoder_config)
     
-    @_change_directory
-    @_pipe_output_to_file("config_ranger.log")
     def _configure_ranger(self):
-        ranger = ParmsetupRanger()
-        self._ranger_config = ranger.apply_existent_ranging(self.working_directory, 
-                                    transcoder_config_sim_id=self.jobid,
-                                    transcoder_results_sim_id=self.jobid,
-                                    ranger_results_sim_id=self.jobid)
+        self._ranger_config = self.execution_context.call(
+            _configure_ranger, "config_ranger.log", self.working_directory, jobid=self.jobid)
         
     def write_input(self):
         if ((self.pos_file is None) or (self.rrng_file is None)):
@@ -83,20 +100,17 @@ class ParaprobeRanger(ParaprobeBase):
         self._configure_ranger()
     
     def _collect_logs(self):
-        config_transcoder_log = self._read_temporary_output_file("config_transcoder.log", clean=False)
-        execute_transcoder_log = self._read_temporary_output_file("execute_transcoder.log", clean=False)
-        config_ranger_log = self._read_temporary_output_file("config_ranger.log", clean=False)
-        execute_ranger_log = self._read_temporary_output_file("log.out", clean=False)
-        self.output["log/configure/transcoder"] = config_transcoder_log
-        self.output["log/execute/transcoder"] = execute_transcoder_log
-        self.output["log/configure/ranger"] = config_ranger_log
-        self.output["log/execute/ranger"] = execute_ranger_log
+        self._ingest_logs({
+            "configure/transcoder": "config_transcoder.log",
+            "execute/transcoder": "execute_transcoder.log",
+            "configure/ranger": "config_ranger.log",
+            "execute/ranger": "log.out",
+        })
         
-    @_pipe_output_to_file("result_ranger.log")
     def _collect_ranger_results(self):
         self._ranger_results = os.path.join(self.working_directory, f"PARAPROBE.Ranger.Results.SimID.{self.jobid}.h5")
-        ranger_report = AutoReporterRanger(self._ranger_results, self.jobid)
-        ranger_report.get_summary()
+        self.execution_context.call(_report_ranger, "result_ranger.log", self._ranger_results, self.jobid,
+                                    change_directory=False)
     
     def _parse_ranger_results(self):
         lines = self._read_temporary_output_file("result_ranger.log")
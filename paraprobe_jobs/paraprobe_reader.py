@@ -0,0 +1,149 @@
+import os
+import numpy as np
+
+# every ion of a .pos file is stored as big-endian float32 x, y, z, m/q
+POS_DTYPE = np.dtype(">f4")
+POS_COLUMNS = 4
+POS_RECORD_SIZE = POS_COLUMNS * POS_DTYPE.itemsize
+
+
+def read_pos(filename):
+    """
+    Memory map the x, y, z, m/q columns of a .pos file without reading it
+    """
+    size = os.path.getsize(filename)
+    if size % POS_RECORD_SIZE != 0:
+        raise ValueError(f"{filename}: size of {size} bytes is not a multiple of {POS_RECORD_SIZE}")
+    if size == 0:
+        return np.zeros((0, POS_COLUMNS), dtype=POS_DTYPE)
+    return np.memmap(filename, dtype=POS_DTYPE, mode="r", shape=(size // POS_RECORD_SIZE, POS_COLUMNS))
+
+
+def iterate_pos(positions, chunk_size=2**20):
+    """
+    Yield start index and a native float32 copy of consecutive chunks of ions
+    """
+    for start in range(0, len(positions), chunk_size):
+        yield start, np.asarray(positions[start:start + chunk_size], dtype=np.float32)
+
+
+class RangeTable:
+    """
+    Mass-to-charge ranges of a .rrng file, sorted by their lower bound
+    """
+    def __init__(self, ions, low, high, compositions):
+        order = np.argsort(low, kind="stable")
+        self.ions = ions
+        self.low = np.asarray(low, dtype=np.float64)[order]
+        self.high = np.asarray(high, dtype=np.float64)[order]
+        self.compositions = [compositions[i] for i in order]
+
+    def __len__(self):
+        return len(self.low)
+
+    @property
+    def names(self):
+        return ["".join(f"{element}{count if count > 1 else ''}" for element, count in composition.items())
+                for composition in self.compositions]
+
+    @property
+    def elements(self):
+        return sorted({element for composition in self.compositions for element in composition})
+
+    def overlaps(self):
+        """
+        Index pairs of neighbouring ranges which overlap
+        """
+        index = np.nonzero(self.low[1:] < self.high[:-1])[0]
+        return [(int(i), int(i + 1)) for i in index]
+
+    def label(self, mass_to_charge):
+        """
+        Index of the range every mass-to-charge value falls into, -1 if it is
+        unranged
+        """
+        index = np.searchsorted(self.low, mass_to_charge, side="right") - 1
+        inside = index >= 0
+        inside[inside] = mass_to_charge[inside] <= self.high[index[inside]]
+        return np.where(inside, index, -1)
+
+
+def read_rrng(filename):
+    ions = []
+    low, high, compositions = [], [], []
+    section = None
+    with open(filename, "r") as fin:
+        for line in fin:
+            line = line.strip()
+            if len(line) == 0 or line.startswith("#"):
+                continue
+            if line.startswith("["):
+                section = line.strip("[]").lower()
+                continue
+            key, _, value = line.partition("=")
+            key = key.strip().lower()
+            if section == "ions" and key.startswith("ion"):
+                ions.append(value.strip())
+            elif section == "ranges" and key.startswith("range"):
+                tokens = value.split()
+                low.append(float(tokens[0]))
+                high.append(float(tokens[1]))
+                composition = {}
+                for token in tokens[2:]:
+                    name, _, count = token.partition(":")
+                    if name.lower() in ["vol", "color", "name"]:
+                        continue
+                    composition[name] = int(float(count))
+                compositions.append(composition)
+    return RangeTable(ions, low, high, compositions)
+
+
+def preflight_check(pos_file, rrng_file, chunk_size=2**20):
+    """
+    Validate a .pos/.rrng pair in one streaming pass over the memory mapped
+    ions: record count, non-finite values, bounding box, overlapping ranges
+    and the fraction of ions covered by the ranges.
+
+    Returns the report and a list of problems which make the input unusable.
+    """
+    positions = read_pos(pos_file)
+    table = read_rrng(rrng_file)
+    problems = []
+    if len(positions) == 0:
+        problems.append(f"{pos_file} contains no ions")
+    if len(table) == 0:
+        problems.append(f"{rrng_file} contains no ranges")
+    if np.any(table.low >= table.high):
+        problems.append(f"{rrng_file} contains ranges with lower bound >= upper bound")
+    overlaps = table.overlaps()
+    if len(overlaps) > 0:
+        problems.append(f"{rrng_file} contains {len(overlaps)} overlapping ranges")
+
+    lower = np.full(POS_COLUMNS, np.inf)
+    upper = np.full(POS_COLUMNS, -np.inf)
+    nonfinite = 0
+    ranged = 0
+    for _, block in iterate_pos(positions, chunk_size=chunk_size):
+        finite = np.isfinite(block).all(axis=1)
+        nonfinite += len(block) - np.count_nonzero(finite)
+        block = block[finite]
+        if len(block) == 0:
+            continue
+        lower = np.minimum(lower, block.min(axis=0))
+        upper = np.maximum(upper, block.max(axis=0))
+        if len(table) > 0:
+            ranged += np.count_nonzero(table.label(block[:, 3]) >= 0)
+    if nonfinite > 0:
+        problems.append(f"{pos_file} contains {nonfinite} ions with NaN or inf values")
+
+    report = {
+        "ion_count": len(positions),
+        "nonfinite_count": int(nonfinite),
+        "bounding_box": np.array([lower[:3], upper[:3]]),
+        "mass_to_charge_interval": np.array([lower[3], upper[3]]),
+        "range_count": len(table),
+        "overlapping_ranges": len(overlaps),
+        "ranged_fraction": float(ranged) / max(len(positions) - nonfinite, 1),
+        "ranges_outside_spectrum": int(np.count_nonzero((table.high < lower[3]) | (table.low > upper[3]))),
+    }
+    return report, problems
@@ -0,0 +1,213 @@
+import numpy as np
+
+# layout of PARAPROBE.Ranger.Results.SimID.*.h5. The paraprobe tools are
+# configured with the file names only, so unlike the surfacer and distancer
+# paths below these are not confirmed by the configuration. Files without
+# them are collected through the autoreporter, see ParaprobeRanger, check
+# them with benchmarks/check_layout.py on results of the pinned version.
+RANGER_IONTYPES = "/entry/process0/iontypes"
+# iontype id of every ion, 0 is the unranged type
+RANGER_ION_LABELS = f"{RANGER_IONTYPES}/iontypes"
+RANGER_ISOTOPE_VECTOR = "isotope_vector"
+# paths read_ranger_results needs
+RANGER_LAYOUT = [RANGER_ION_LABELS, f"{RANGER_IONTYPES}/ion0/{RANGER_ISOTOPE_VECTOR}"]
+
+# layout of PARAPROBE.Surfacer.Results.SimID.*.h5
+SURFACER_TRIANGLES = "/entry/process0/point_set_wrapping0/alpha_complex/triangle_set/triangles"
+SURFACER_VERTICES = f"{SURFACER_TRIANGLES}/vertices"
+SURFACER_FACES = f"{SURFACER_TRIANGLES}/faces"
+
+# layout of PARAPROBE.Distancer.Results.SimID.*.h5
+DISTANCER_DISTANCES = "/entry/process0/point_to_triangle_set/distance"
+
+# layout of PARAPROBE.Nanochem.Results.SimID.*.h5, delocalization tasks and
+# isosurfaces are numbered from 0 in the order of the configuration. Unlike
+# the tessellator layout these names do not come from the autoreporter
+# metadata, check them on a results file of the installed paraprobe version
+# with missing_paths or benchmarks/check_layout.py
+NANOCHEM_DELOCALIZATION = "/entry/process0/delocalization{task}"
+NANOCHEM_ISOSURFACE = NANOCHEM_DELOCALIZATION + "/iso_surface{isosurface}"
+NANOCHEM_ISOVALUE = NANOCHEM_ISOSURFACE + "/isovalue"
+NANOCHEM_OBJECTS = NANOCHEM_ISOSURFACE + "/objects"
+NANOCHEM_OBJECT_VOLUME = NANOCHEM_OBJECTS + "/volume"
+NANOCHEM_OBJECT_EDGE_CONTACT = NANOCHEM_OBJECTS + "/edge_contact"
+NANOCHEM_OBJECT_ION_COUNT = NANOCHEM_OBJECTS + "/ion_count"
+
+# index of the ion of every cell in tessellations merged from slabs, see
+# ParaprobeTessellator
+TESSELLATOR_ION_IDS = "/entry/decomposition/ion_ids"
+
+ELEMENT_SYMBOLS = (
+    "", "H", "He", "Li", "Be", "B", "C", "N", "O", "F", "Ne", "Na", "Mg", "Al", "Si", "P", "S",
+    "Cl", "Ar", "K", "Ca", "Sc", "Ti", "V", "Cr", "Mn", "Fe", "Co", "Ni", "Cu", "Zn", "Ga", "Ge",
+    "As", "Se", "Br", "Kr", "Rb", "Sr", "Y", "Zr", "Nb", "Mo", "Tc", "Ru", "Rh", "Pd", "Ag", "Cd",
+    "In", "Sn", "Sb", "Te", "I", "Xe", "Cs", "Ba", "La", "Ce", "Pr", "Nd", "Pm", "Sm", "Eu", "Gd",
+    "Tb", "Dy", "Ho", "Er", "Tm", "Yb", "Lu", "Hf", "Ta", "W", "Re", "Os", "Ir", "Pt", "Au", "Hg",
+    "Tl", "Pb", "Bi", "Po", "At", "Rn", "Fr", "Ra", "Ac", "Th", "Pa", "U", "Np", "Pu", "Am", "Cm",
+    "Bk", "Cf", "Es", "Fm", "Md", "No", "Lr", "Rf", "Db", "Sg", "Bh", "Hs", "Mt", "Ds", "Rg", "Cn",
+    "Nh", "Fl", "Mc", "Lv", "Ts", "Og",
+)
+
+
+def missing_paths(filename, paths):
+    """
+    Paths which a results file does not contain
+    """
+    import h5py
+    with h5py.File(filename, "r") as h5r:
+        return [path for path in paths if path not in h5r]
+
+
+def iterate_dataset(dataset, chunk_size=None):
+    """
+    Yield start index and consecutive slices of a dataset along its first
+    axis, aligned to the HDF5 chunks where the dataset is chunked
+    """
+    n = dataset.shape[0]
+    if chunk_size is None:
+        chunk_size = 2**20
+        if dataset.chunks is not None:
+            chunk_size = max(chunk_size // dataset.chunks[0], 1) * dataset.chunks[0]
+    for start in range(0, n, chunk_size):
+        yield start, dataset[start:start + chunk_size]
+
+
+def write_ion_subset(source, destination, mask):
+    """
+    Copy a results file, keeping only the ions selected by the boolean mask
+    in every dataset with one entry per ion, i.e. with as many rows as the
+    mask. Everything else is copied as is.
+    """
+    import h5py
+    n_ions = len(mask)
+
+    def copy(group, target):
+        target.attrs.update(group.attrs)
+        for name, item in group.items():
+            if isinstance(item, h5py.Group):
+                copy(item, target.create_group(name))
+            elif item.ndim > 0 and item.shape[0] == n_ions:
+                subset = target.create_dataset(name, shape=(int(np.count_nonzero(mask)),) + item.shape[1:],
+                                               dtype=item.dtype)
+                offset = 0
+                for start, block in iterate_dataset(item):
+                    block = block[mask[start:start + len(block)]]
+                    subset[offset:offset + len(block)] = block
+                    offset += len(block)
+                subset.attrs.update(item.attrs)
+            else:
+                group.copy(item, target, name=name)
+
+    with h5py.File(source, "r") as h5r, h5py.File(destination, "w") as h5w:
+        copy(h5r, h5w)
+
+
+def read_ranger_results(filename):
+    """
+    Read the ion count, the per-iontype counts and element multiplicities and
+    the composition in at.-% from a ranger results file in one pass
+
+    Isotopes are encoded as Z + 256 * N in the isotope vector of an iontype,
+    0 marks unused entries.
+    """
+    import h5py
+    with h5py.File(filename, "r") as h5r:
+        group = h5r[RANGER_IONTYPES]
+        ids = sorted(int(key[3:]) for key in group if key.startswith("ion") and key[3:].isdigit())
+        isotopes = [np.asarray(group[f"ion{i}/{RANGER_ISOTOPE_VECTOR}"][()], dtype=np.int64).ravel()
+                    for i in ids]
+        counts = np.zeros(max(ids, default=0) + 1, dtype=np.int64)
+        for _, labels in iterate_dataset(h5r[RANGER_ION_LABELS]):
+            counts += np.bincount(np.asarray(labels, dtype=np.int64).ravel(), minlength=len(counts))[:len(counts)]
+
+    protons = [vector[vector > 0] % 256 for vector in isotopes]
+    elements = sorted({int(z) for z in np.concatenate(protons + [np.zeros(0, dtype=np.int64)])})
+    multiplicities = np.array([[np.count_nonzero(z == element) for element in elements] for z in protons],
+                              dtype=np.int64).reshape(len(ids), len(elements))
+    iontype_counts = counts[ids]
+    atoms = iontype_counts @ multiplicities
+    names = ["".join(f"{ELEMENT_SYMBOLS[element]}{m if m > 1 else ''}"
+                     for element, m in zip(elements, row) if m > 0) for row in multiplicities]
+    return {
+        "ion_count": int(counts.sum()),
+        "iontype_ids": np.array(ids, dtype=np.int64),
+        "iontype_names": names,
+        "iontype_counts": iontype_counts,
+        "multiplicities": multiplicities,
+        "elements": [ELEMENT_SYMBOLS[element] for element in elements],
+        "composition": 100. * atoms / max(atoms.sum(), 1),
+    }
+
+
+def read_nanochem_objects(filename, n_tasks, n_isovalues, max_objects=None):
+    """
+    Read the isosurface objects of every delocalization task and isovalue in
+    one pass, chunk by chunk.
+
+    Returns arrays of shape (n_tasks, n_isovalues): object_count,
+    object_volume (total), edge_contact_count and object_ion_count (total).
+    Unless there are more than max_objects objects, "objects" holds one
+    column per property with one entry per object: task, isosurface,
+    volume, edge_contact and ion_count. Isosurfaces without objects have no
+    objects group. A missing delocalization or isosurface group means that
+    the file does not match the layout, see benchmarks/check_layout.py: its
+    paths are listed in "missing" and "evaluated" is False for the task and
+    isovalue, whose summary entries stay 0.
+    """
+    shape = (n_tasks, n_isovalues)
+    summary = {
+        "object_count": np.zeros(shape, dtype=np.int64),
+        "object_volume": np.zeros(shape, dtype=np.float64),
+        "edge_contact_count": np.zeros(shape, dtype=np.int64),
+        "object_ion_count": np.zeros(shape, dtype=np.int64),
+    }
+    import h5py
+    with h5py.File(filename, "r") as h5r:
+        evaluated = np.ones(shape, dtype=bool)
+        missing = []
+        for task in range(n_tasks):
+            for isosurface in range(n_isovalues):
+                for path in [NANOCHEM_DELOCALIZATION, NANOCHEM_ISOSURFACE]:
+                    path = path.format(task=task, isosurface=isosurface)
+                    if path not in h5r:
+                        evaluated[task, isosurface] = False
+                        if path not in missing:
+                            missing.append(path)
+        groups = [(task, isosurface, {"task": task, "isosurface": isosurface})
+                  for task in range(n_tasks) for isosurface in range(n_isovalues)
+                  if NANOCHEM_OBJECTS.format(task=task, isosurface=isosurface) in h5r]
+        total = sum(h5r[NANOCHEM_OBJECT_VOLUME.format(**names)].shape[0] for _, _, names in groups)
+        objects = None
+        if max_objects is None or total <= max_objects:
+            objects = {
+                "task": np.zeros(total, dtype=np.int32),
+                "isosurface": np.zeros(total, dtype=np.int32),
+                "volume": np.zeros(total, dtype=np.float64),
+                "edge_contact": np.zeros(total, dtype=bool),
+                "ion_count": np.zeros(total, dtype=np.int64),
+            }
+        offset = 0
+        for task, isosurface, names in groups:
+            edge_contact = h5r[NANOCHEM_OBJECT_EDGE_CONTACT.format(**names)]
+            ion_count = h5r[NANOCHEM_OBJECT_ION_COUNT.format(**names)]
+            for start, volume in iterate_dataset(h5r[NANOCHEM_OBJECT_VOLUME.format(**names)]):
+                stop = start + len(volume)
+                edge = np.asarray(edge_contact[start:stop]).ravel() != 0
+                ions = np.asarray(ion_count[start:stop], dtype=np.int64).ravel()
+                volume = np.asarray(volume, dtype=np.float64).ravel()
+                summary["object_count"][task, isosurface] += len(volume)
+                summary["object_volume"][task, isosurface] += volume.sum()
+                summary["edge_contact_count"][task, isosurface] += np.count_nonzero(edge)
+                summary["object_ion_count"][task, isosurface] += ions.sum()
+                if objects is not None:
+                    rows = slice(offset + start, offset + stop)
+                    objects["task"][rows] = task
+                    objects["isosurface"][rows] = isosurface
+                    objects["volume"][rows] = volume
+                    objects["edge_contact"][rows] = edge
+                    objects["ion_count"][rows] = ions
+            offset += h5r[NANOCHEM_OBJECT_VOLUME.format(**names)].shape[0]
+    summary["objects"] = objects
+    summary["evaluated"] = evaluated
+    summary["missing"] = missing
+    return summary
@@ -0,0 +1,82 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class Stage:
+    def __init__(self, name, function, depends=(), cores=1, memory=0):
+        self.name = name
+        self.function = function
+        self.depends = list(depends)
+        self.cores = cores
+        self.memory = memory
+
+
+class StageScheduler:
+    """
+    Run a dependency graph of stages, launching every stage whose dependencies
+    are finished as soon as it fits into the core and memory budget. A stage
+    which is larger than the whole budget is started once nothing else runs.
+
+    Start and end time of every stage, in seconds since the scheduler started,
+    are recorded in `timings`.
+    """
+    def __init__(self, max_cores=1, max_memory=0):
+        self.max_cores = max_cores
+        self.max_memory = max_memory
+        self.timings = {}
+
+    def _fits(self, stage, running):
+        if len(running) == 0:
+            return True
+        cores = sum(s.cores for s in running) + stage.cores
+        memory = sum(s.memory for s in running) + stage.memory
+        if self.max_cores and cores > self.max_cores:
+            return False
+        if self.max_memory and memory > self.max_memory:
+            return False
+        return True
+
+    def run(self, stages):
+        names = [stage.name for stage in stages]
+        for stage in stages:
+            missing = set(stage.depends) - set(names)
+            if len(missing) > 0:
+                raise ValueError(f"stage {stage.name} depends on unknown stages {missing}")
+        pending = list(stages)
+        running = {}
+        done = set()
+        self.timings = {}
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for stage in list(pending):
+                    if set(stage.depends) <= done and self._fits(stage, running.values()):
+                        pending.remove(stage)
+                        self.timings[stage.name] = {"start": time.time() - start}
+                        running[executor.submit(stage.function)] = stage
+                if len(running) == 0:
+                    raise RuntimeError(f"stages {[s.name for s in pending]} can not be scheduled")
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    self.timings[stage.name]["end"] = time.time() - start
+                    # re-raises the exception of a failed stage, the executor
+                    # waits for the stages which are still running
+                    future.result()
+                    done.add(stage.name)
+        return self.timings
+
+
+def critical_path(stages, timings):
+    """
+    Chain of stages ending with the last finished stage, following the
+    dependency which finished last at every step
+    """
+    depends = {stage.name: stage.depends for stage in stages}
+    finished = [name for name in depends if "end" in timings.get(name, {})]
+    if len(finished) == 0:
+        return []
+    path = [max(finished, key=lambda name: timings[name]["end"])]
+    while len(depends[path[-1]]) > 0:
+        path.append(max(depends[path[-1]], key=lambda name: timings[name]["end"]))
+    return path[::-1]
@@ -0,0 +1,72 @@
+import os
+import shutil
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# ioctl request number of FICLONE on Linux (btrfs, xfs, ...)
+_FICLONE = 0x40049409
+
+STAGING_MODES = ("auto", "reflink", "hardlink", "symlink", "copy")
+_AUTO_ORDER = ("reflink", "hardlink", "symlink", "copy")
+
+
+def _reflink(source, destination):
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    with open(source, "rb") as fsrc, open(destination, "wb") as fdst:
+        fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+
+
+def _hardlink(source, destination):
+    os.link(source, destination)
+
+
+def _symlink(source, destination):
+    os.symlink(os.path.abspath(source), destination)
+
+
+def _copy(source, destination):
+    shutil.copy(source, destination)
+
+
+_STAGING_FUNCTIONS = {
+    "reflink": _reflink,
+    "hardlink": _hardlink,
+    "symlink": _symlink,
+    "copy": _copy,
+}
+
+
+def stage_file(source, directory, mode="auto"):
+    """
+    Make `source` available in `directory` without copying it if possible.
+
+    Hard- and symlinked files share their inode with the source, writing to
+    them changes the source. Their permissions are left alone, a chmod would
+    change those of the user's input or the upstream results as well. With
+    mode="auto" reflinks, hardlinks, symlinks and a plain copy are tried in
+    this order.
+
+    Returns the method which was used and the number of bytes staged.
+    """
+    if mode not in STAGING_MODES:
+        raise ValueError(f"staging mode {mode} not in {STAGING_MODES}")
+    destination = os.path.join(directory, os.path.basename(source))
+    nbytes = os.path.getsize(source)
+    if os.path.lexists(destination):
+        if os.path.exists(destination) and os.path.samefile(source, destination):
+            return "existing", nbytes
+        os.remove(destination)
+    methods = _AUTO_ORDER if mode == "auto" else (mode,)
+    for method in methods:
+        try:
+            _STAGING_FUNCTIONS[method](source, destination)
+            return method, nbytes
+        except OSError:
+            if os.path.lexists(destination):
+                os.remove(destination)
+            if method == methods[-1]:
+                raise
@@ -0,0 +1,187 @@
+import numpy as np
+
+
+class _Buckets:
+    """
+    Dense counts over a growing range of integer bucket indices
+    """
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def add(self, indices):
+        if len(indices) == 0:
+            return
+        low, high = int(indices.min()), int(indices.max())
+        if len(self.counts) == 0:
+            self.offset = low
+        new_offset = min(self.offset, low)
+        new_length = max(self.offset + len(self.counts), high + 1) - new_offset
+        if new_offset != self.offset or new_length != len(self.counts):
+            counts = np.zeros(new_length, dtype=np.int64)
+            counts[self.offset - new_offset:self.offset - new_offset + len(self.counts)] = self.counts
+            self.counts, self.offset = counts, new_offset
+        self.counts += np.bincount(indices - self.offset, minlength=len(self.counts))
+
+    @property
+    def indices(self):
+        return np.arange(self.offset, self.offset + len(self.counts))
+
+
+class QuantileSketch:
+    """
+    Log-bucketed quantile sketch (DDSketch, Masson et al., VLDB 2019).
+
+    Values are counted in buckets whose bounds grow geometrically by
+    gamma = (1 + a) / (1 - a), a being the relative accuracy. Every quantile
+    estimate x' of a true quantile x satisfies |x' - x| <= a * |x|. The
+    memory only depends on the dynamic range of the values, log(max / min) /
+    log(gamma) buckets, not on their number.
+    """
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self._gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = np.log(self._gamma)
+        self._positive = _Buckets()
+        self._negative = _Buckets()
+        self._zero = 0
+        self.count = 0
+
+    def _index(self, values):
+        return np.ceil(np.log(values) / self._log_gamma).astype(np.int64)
+
+    def _value(self, indices):
+        return 2 * self._gamma**indices / (self._gamma + 1)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        tiny = np.finfo(np.float64).tiny
+        positive = values > tiny
+        negative = values < -tiny
+        self._positive.add(self._index(values[positive]))
+        self._negative.add(self._index(-values[negative]))
+        self._zero += len(values) - np.count_nonzero(positive) - np.count_nonzero(negative)
+        self.count += len(values)
+
+    def _sorted_buckets(self):
+        values = np.concatenate([-self._value(self._negative.indices[::-1]), [0.],
+                                 self._value(self._positive.indices)])
+        counts = np.concatenate([self._negative.counts[::-1], [self._zero], self._positive.counts])
+        return values, counts
+
+    def quantiles(self, q):
+        q = np.atleast_1d(np.asarray(q, dtype=np.float64))
+        if self.count == 0:
+            return np.full(len(q), np.nan)
+        values, counts = self._sorted_buckets()
+        ranks = q * (self.count - 1)
+        position = np.searchsorted(np.cumsum(counts), ranks, side="right")
+        return values[np.minimum(position, len(values) - 1)]
+
+    def cdf(self, n_points=256):
+        """
+        Fixed-size CDF: values at n_points equally spaced cumulated fractions
+        """
+        fractions = np.linspace(1. / n_points, 1., n_points)
+        return self.quantiles(fractions), fractions
+
+    def histogram(self):
+        """
+        Counts of the positive values in the sketch buckets and the bucket edges
+        """
+        indices = self._positive.indices
+        edges = self._gamma**np.append(indices - 1, indices[-1:]) if len(indices) > 0 else np.zeros(0)
+        return edges, self._positive.counts.copy()
+
+
+class FixedHistogram:
+    """
+    Histogram with a fixed number of equal bins between low and high, values
+    outside are counted as underflow and overflow
+    """
+    def __init__(self, low, high, bins=256):
+        self.edges = np.linspace(low, high, bins + 1)
+        self.counts = np.zeros(bins, dtype=np.int64)
+        self.underflow = 0
+        self.overflow = 0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        index = np.floor((values - self.edges[0]) / (self.edges[1] - self.edges[0])).astype(np.int64)
+        # the upper edge belongs to the last bin
+        index[values == self.edges[-1]] = len(self.counts) - 1
+        inside = (index >= 0) & (index < len(self.counts))
+        self.counts += np.bincount(index[inside], minlength=len(self.counts))
+        self.underflow += np.count_nonzero(index < 0)
+        self.overflow += np.count_nonzero(index >= len(self.counts))
+
+
+class StreamingMoments:
+    """
+    Count, mean, variance, minimum and maximum, updated chunk by chunk
+    (Chan et al. pairwise update)
+    """
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.
+        self._m2 = 0.
+        self.minimum = np.inf
+        self.maximum = -np.inf
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        mean = values.mean()
+        delta = mean - self.mean
+        self._m2 += ((values - mean)**2).sum() + delta**2 * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+
+    @property
+    def variance(self):
+        return self._m2 / self.count if self.count > 0 else np.nan
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+class StreamingStatistics:
+    """
+    Summary moments and a quantile sketch of a stream of values
+    """
+    quantile_levels = (0.01, 0.05, 0.25, 0.5, 0.75, 0.95, 0.99)
+
+    def __init__(self, relative_accuracy=0.01):
+        self.moments = StreamingMoments()
+        self.sketch = QuantileSketch(relative_accuracy=relative_accuracy)
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[np.isfinite(values)]
+        self.moments.update(values)
+        self.sketch.update(values)
+
+    def summary(self, n_points=256):
+        values, fractions = self.sketch.cdf(n_points=n_points)
+        edges, counts = self.sketch.histogram()
+        return {
+            "count": self.moments.count,
+            "mean": self.moments.mean,
+            "std": self.moments.std,
+            "min": self.moments.minimum,
+            "max": self.moments.maximum,
+            "relative_accuracy": self.sketch.relative_accuracy,
+            "quantiles/levels": np.array(self.quantile_levels),
+            "quantiles/values": self.sketch.quantiles(self.quantile_levels),
+            "cdf/values": values,
+            "cdf/fractions": fractions,
+            "histogram/edges": edges,
+            "histogram/counts": counts,
+        }
@@ -3,23 +3,44 @@ import numpy as np
 import shutil
 import sys
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
+from paraprobe_base_job import ParaprobeBase, _record_performance
+from paraprobe_configure import configure_surfacer, PARAPROBE_IMPORT_MESSAGE, require_modules
+from paraprobe_prefilter import boundary_filter
+from paraprobe_results import SURFACER_VERTICES, SURFACER_FACES
+
+
+with ImportAlarm(PARAPROBE_IMPORT_MESSAGE) as paraprobe_alarm:
+    # the paraprobe modules are imported on first use, possibly in a worker
+    # process, only check here that they are installed
+    require_modules("paraprobe_parmsetup")
 
-with ImportAlarm(
-    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
-    "requirements. Please install it and try again."
-) as paraprobe_alarm:
-    from paraprobe_parmsetup.surfacer_guru import ParmsetupSurfacer
-    
 
 class ParaprobeSurfacer(ParaprobeBase):
+    """
+    Convex hull edge model of the reconstruction.
+
+    With input["prefilter/enabled"] the reconstruction is voxelized first
+    and only the ions of voxels at the specimen boundary are ranged, by a
+    child ranger job <job name>_prefilter, and passed to the surfacer. The
+    edge model is unchanged; with input["prefilter/max_per_voxel"] it moves
+    by at most output["prefilter/hausdorff_bound"].
+    """
+    _stored_attributes = ParaprobeBase._stored_attributes + ("_surfacer_config", "_surfacer_results")
+    _result_groups = {"_surfacer_results": [SURFACER_VERTICES, SURFACER_FACES]}
+
+    @paraprobe_alarm
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self.ranger_job = None
         self._surfacer_config = None
         self._skip_copy_results = False
+        self._prefilter_job = None
+        self.input["prefilter/enabled"] = False
+        # nm
+        self.input["prefilter/voxel_size"] = 1.
+        # None keeps every ion of a boundary voxel
+        self.input["prefilter/max_per_voxel"] = None
         
     def _copy_results(self):
         if self._skip_copy_results:
@@ -28,20 +49,42 @@ class ParaprobeSurfacer(ParaprobeBase):
         if self.ranger_job is None:
             raise ValueError("Needs a ranger job!")
         
-        a = self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_results))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_results))
+        ranger_job = self.ranger_job if self._prefilter_job is None else self._prefilter_job
+        for filename in ranger_job.result_files:
+            self._copy_file(filename)
+
+    @_record_performance("prefilter")
+    def _prefilter(self):
+        """
+        Range the boundary ions in a child job, whose results replace those
+        of the ranger job as surfacer input
+        """
+        from paraprobe_ranger_job import ParaprobeRanger
+        filtered_file = os.path.join(self.working_directory, "prefilter.pos")
+        total, kept, hausdorff_bound = boundary_filter(
+            os.path.join(self.working_directory, self.pos_file), filtered_file,
+            voxel_size=self.input["prefilter/voxel_size"],
+            max_per_voxel=self.input["prefilter/max_per_voxel"])
+        self.output["prefilter/ions_total"] = total
+        self.output["prefilter/ions_kept"] = kept
+        self.output["prefilter/fraction_kept"] = kept / total if total > 0 else 0.
+        self.output["prefilter/hausdorff_bound"] = hausdorff_bound
+
+        job = self.project.create_job(job_type=ParaprobeRanger, job_name=f"{self.job_name}_prefilter",
+                                      delete_existing_job=True)
+        job.pos_file = filtered_file
+        job.rrng_file = os.path.join(self.working_directory, self.rrng_file)
+        job.input.preflight = False
+        job.input.staging = self.input.staging
+        job.input.isolation = self.input.isolation
+        job.server.cores = self.server.cores
+        job.run()
+        self._prefilter_job = job
     
-    @_change_directory
-    @_pipe_output_to_file("config_surfacer.log")
+    @_record_performance("configure/surfacer")
     def _configure_surfacer(self):
-        surfacer = ParmsetupSurfacer()
-        self._surfacer_config = surfacer.compute_convex_hull_edge_model(self.working_directory, 
-                                    transcoder_config_sim_id=self.jobid,
-                                    transcoder_results_sim_id=self.jobid,
-                                    ranger_results_sim_id=self.jobid,
-                                    surfacer_results_sim_id=self.jobid)
+        self._surfacer_config = self.execution_context.call(
+            configure_surfacer, "config_surfacer.log", self.working_directory, jobid=self.jobid)
         
     def _executable_activate(self, enforce = False):
         if self._executable is None or enforce:
@@ -57,9 +100,12 @@ class ParaprobeSurfacer(ParaprobeBase):
 
         self.pos_file = self._copy_file(self.pos_file)
         self.rrng_file = self._copy_file(self.rrng_file)
+        if self.input["prefilter/enabled"]:
+            self._prefilter()
         self._copy_results()
         self._configure_surfacer()
     
+    @_record_performance("collect/surfacer")
     def collect_output(self):
         self._collect_surfacer_results()
         self._collect_logs()
@@ -67,8 +113,9 @@ class ParaprobeSurfacer(ParaprobeBase):
     def _collect_surfacer_results(self):
         self._surfacer_results = os.path.join(self.working_directory, f"PARAPROBE.Surfacer.Results.SimID.{self.jobid}.h5")
         
+    @_record_performance("logs/surfacer")
     def _collect_logs(self):
-        config_surfacer_log = self._read_temporary_output_file("config_surfacer.log", clean=False)
-        execute_surfacer_log = self._read_temporary_output_file("log.out", clean=False)
-        self.output["log/configure/surfacer"] = config_surfacer_log
-        self.output["log/execute/surfacer"] = execute_surfacer_log
\ No newline at end of file
+        self._ingest_logs({
+            "configure/surfacer": "config_surfacer.log",
+            "execute/surfacer": "log.out",
+        })
@@ -1,67 +1,99 @@
+import contextlib
 import os
 import numpy as np
 import shutil
 import sys
-import h5py
-import matplotlib.pyplot as plt
 
-from jupyterlab_h5web import H5Web
 from pyiron_base import Project, GenericJob, DataContainer, state, Executable, ImportAlarm
-from paraprobe_base_job import ParaprobeBase, _pipe_output_to_file, _change_directory
-import paraprobe_autoreporter.metadata.h5tessellator as nx
+from paraprobe_base_job import ParaprobeBase, _record_performance
+from paraprobe_staging import stage_file
+from paraprobe_configure import configure_tessellator, PARAPROBE_IMPORT_MESSAGE, require_modules
+from paraprobe_reader import read_pos, iterate_pos, POS_DTYPE
+from paraprobe_results import iterate_dataset, write_ion_subset, TESSELLATOR_ION_IDS
+from paraprobe_statistics import StreamingStatistics
 
-def get_cell_volume(results_file, dataset_id, tessellation_task_id=None):
-    h5r = h5py.File(results_file, 'r')
+
+with ImportAlarm(PARAPROBE_IMPORT_MESSAGE) as paraprobe_alarm:
+    # the paraprobe modules are imported on first use, possibly in a worker
+    # process, only check here that they are installed
+    require_modules("paraprobe_parmsetup")
+
+def get_cell_volume_statistics(results_file, dataset_id, tessellation_task_id=0,
+                               exclude_wall_contact=True, relative_accuracy=0.01):
+    """
+    Summary moments, quantile sketch and histogram of the cell volumes, read
+    chunk by chunk. Cells in contact with the tessellation wall are edge
+    affected and left out unless exclude_wall_contact is False.
+    """
+    import h5py
+    import paraprobe_autoreporter.metadata.h5tessellator as nx
+    statistics = StreamingStatistics(relative_accuracy=relative_accuracy)
+    excluded = 0
     grpnm = nx.MYTESS + str(dataset_id) \
         + nx.MYTESS_DATA_VORO_TSKS + '/' + str(tessellation_task_id)
     dsnm = grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_CVOL
     dsnm_con = grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_WALLCONTACT
-    V = np.sort(np.asarray(h5r[dsnm][:, 0], np.float32), kind='mergesort')
-    Wall = np.asarray(h5r[dsnm_con][:, 0], np.uint8)
-    n = np.shape(V)[0]
-    cdf = np.asarray(np.linspace(1./n, 1., n, endpoint=True), np.float32)
-    return [V], [cdf]
-
-with ImportAlarm(
-    "paraprobe functionality requires the `paraprobe` module (and its dependencies) specified as extra"
-    "requirements. Please install it and try again."
-) as paraprobe_alarm:
-    from paraprobe_parmsetup.tessellator_guru import ParmsetupTessellator
-    from paraprobe_autoreporter.wizard.tessellator_report import AutoReporterTessellator
+    with h5py.File(results_file, 'r') as h5r:
+        wall = h5r[dsnm_con]
+        for start, volume in iterate_dataset(h5r[dsnm]):
+            volume = volume[:, 0]
+            if exclude_wall_contact:
+                inside = wall[start:start + len(volume), 0] == 0
+                excluded += len(volume) - np.count_nonzero(inside)
+                volume = volume[inside]
+            statistics.update(volume)
+    return statistics, excluded
 
 class ParaprobeTessellator(ParaprobeBase):
+    _stored_attributes = ParaprobeBase._stored_attributes + ("_tessellator_config", "_tessellator_results")
+    _result_groups = {"_tessellator_results": ["/entry"]}
+
+    @paraprobe_alarm
     def __init__(self, project, job_name):
         super().__init__(project, job_name)
         self.ranger_job = None
         self.distancer_job = None
         self._tessellator_config = None
         self._skip_copy_results = False
+        self.input.exclude_wall_contact = True
+        self.input.relative_accuracy = 0.01
+        self.input.cdf_points = 256
+        # slabs > 1 tessellates that many z slabs of equal ion count in
+        # separate tessellator jobs, each with a halo of the given thickness
+        # in nm, and merges the cells of the slab cores
+        self.input["decomposition/slabs"] = 1
+        self.input["decomposition/halo"] = 2.0
+        # directory with the upstream results of a slab, which replace those
+        # of the ranger and distancer job
+        self.input["decomposition/upstream"] = None
+        # how the slab jobs run, see run_jobs
+        self.input["decomposition/mode"] = "pool"
+        self.input["decomposition/queue"] = None
+        self.input["decomposition/concurrency"] = 1
+        self.input["decomposition/cores_per_slab"] = 1
         
     def _copy_results(self):
         if self._skip_copy_results:
             return
 
+        upstream = self.input["decomposition/upstream"]
+        if upstream is not None:
+            for filename in sorted(os.listdir(upstream)):
+                self._copy_file(os.path.join(upstream, filename))
+            return
         if self.ranger_job is None:
             raise ValueError("Needs a ranger job!")
         if self.distancer_job is None:
             raise ValueError("Needs a distancer job!")
         
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._transcoder_results))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_config))
-        self._copy_file(os.path.join(self.ranger_job.working_directory, self.ranger_job._ranger_results))
+        for filename in self.ranger_job.result_files:
+            self._copy_file(filename)
         self._copy_file(os.path.join(self.distancer_job.working_directory, self.distancer_job._distancer_results))
     
-    @_change_directory
-    @_pipe_output_to_file("config_tessellator.log")
+    @_record_performance("configure/tessellator")
     def _configure_tessellator(self):
-        tessellator = ParmsetupTessellator()
-        self._tessellator_config = tessellator.compute_complete_voronoi_tessellation(self.working_directory, 
-                                    transcoder_config_sim_id=self.jobid,
-                                    transcoder_results_sim_id=self.jobid,
-                                    ranger_results_sim_id=self.jobid,
-                                    distancer_results_sim_id=self.jobid,
-                                    tessellator_results_sim_id=self.jobid)
+        self._tessellator_config = self.execution_context.call(
+            configure_tessellator, "config_tessellator.log", self.working_directory, jobid=self.jobid)
         
     def _executable_activate(self, enforce = False):
         if self._executable is None or enforce:
@@ -77,27 +109,270 @@ class ParaprobeTessellator(ParaprobeBase):
 
         self.pos_file = self._copy_file(self.pos_file)
         self.rrng_file = self._copy_file(self.rrng_file)
+        if self._decomposed:
+            self._write_slabs()
+            self._write_slab_upstream()
+            self._skip_execution = True
+            return
         self._copy_results()
         self._configure_tessellator()
-    
+
+    @property
+    def _decomposed(self):
+        return self.input["decomposition/slabs"] > 1
+
+    def _slab_files(self, slab):
+        return (os.path.join(self.working_directory, f"slab{slab}.pos"),
+                os.path.join(self.working_directory, f"slab{slab}.ids"))
+
+    def _slab_job_name(self, slab):
+        return f"{self.job_name}_slab{slab}"
+
+    def _write_slabs(self):
+        """
+        Split the dataset along z into slabs of equal ion count. Every slab
+        file holds the ions of its core and of the halo on both sides, in
+        the original order, next to it the indices of these ions.
+        """
+        n_slabs = self.input["decomposition/slabs"]
+        halo = self.input["decomposition/halo"]
+        positions = read_pos(os.path.join(self.working_directory, self.pos_file))
+        # quantiles of about a million ions are precise enough for balancing
+        step = max(len(positions) // 2**20, 1)
+        edges = np.quantile(np.asarray(positions[::step, 2], dtype=np.float64), np.linspace(0., 1., n_slabs + 1))
+        edges[0], edges[-1] = -np.inf, np.inf
+        counts = np.zeros((n_slabs, 2), dtype=np.int64)
+        with contextlib.ExitStack() as stack:
+            files = [[stack.enter_context(open(filename, "wb")) for filename in self._slab_files(slab)]
+                     for slab in range(n_slabs)]
+            for start, block in iterate_pos(positions):
+                z = block[:, 2]
+                for slab, (pos_out, ids_out) in enumerate(files):
+                    inside = (z >= edges[slab] - halo) & (z < edges[slab + 1] + halo)
+                    core = (z >= edges[slab]) & (z < edges[slab + 1])
+                    pos_out.write(block[inside].astype(POS_DTYPE).tobytes())
+                    ids_out.write((start + np.flatnonzero(inside)).astype(np.int64).tobytes())
+                    counts[slab] += np.count_nonzero(core), np.count_nonzero(inside & ~core)
+        self.output["decomposition/edges"] = edges
+        self.output["decomposition/core_ions"] = counts[:, 0]
+        self.output["decomposition/halo_ions"] = counts[:, 1]
+
+    def _write_slab_upstream(self):
+        """
+        Write the upstream results of the whole dataset, restricted to the
+        ions of each slab, to slab<n>/ in the working directory. The slabs
+        are tessellated only, with the edge model and the distances of the
+        whole dataset rather than of the slab. Configuration files are
+        staged as they are.
+        """
+        if self.ranger_job is None:
+            raise ValueError("Needs a ranger job!")
+        if self.distancer_job is None:
+            raise ValueError("Needs a distancer job!")
+        upstream = self.ranger_job.result_files + [
+            os.path.join(self.distancer_job.working_directory, self.distancer_job._distancer_results)]
+        n_ions = int(self.output["decomposition/core_ions"].sum())
+        for slab in range(self.input["decomposition/slabs"]):
+            directory = os.path.join(self.working_directory, f"slab{slab}")
+            os.makedirs(directory, exist_ok=True)
+            mask = np.zeros(n_ions, dtype=bool)
+            mask[np.fromfile(self._slab_files(slab)[1], dtype=np.int64)] = True
+            for filename in upstream:
+                if ".Results." in os.path.basename(filename):
+                    write_ion_subset(filename, os.path.join(directory, os.path.basename(filename)), mask)
+                else:
+                    stage_file(filename, directory, mode=self.input.staging)
+
+    def _run_slabs(self):
+        """
+        Tessellate every slab in a tessellator job of its own
+        """
+        # imported here, paraprobe_batch imports this module through paraprobe_job
+        from paraprobe_batch import run_jobs
+        job_names = []
+        for slab in range(self.input["decomposition/slabs"]):
+            job = self.project.create_job(job_type=ParaprobeTessellator, job_name=self._slab_job_name(slab),
+                                          delete_existing_job=True)
+            job.pos_file = self._slab_files(slab)[0]
+            job.rrng_file = os.path.join(self.working_directory, self.rrng_file)
+            job.input.staging = self.input.staging
+            job.input.isolation = self.input.isolation
+            job.input.exclude_wall_contact = self.input.exclude_wall_contact
+            job.input.relative_accuracy = self.input.relative_accuracy
+            job.input.cdf_points = self.input.cdf_points
+            job.input["decomposition/upstream"] = os.path.join(self.working_directory, f"slab{slab}")
+            job.server.cores = self.input["decomposition/cores_per_slab"]
+            if self.input["decomposition/mode"] == "queue":
+                job.server.queue = self.input["decomposition/queue"]
+            job.save()
+            job_names.append(job.job_name)
+        _, errors = run_jobs(self.project.path, job_names, mode=self.input["decomposition/mode"],
+                             concurrency=self.input["decomposition/concurrency"])
+        failed = [job_name for job_name in job_names
+                  if job_name in errors or not self.project.load(job_name).status.finished]
+        if len(failed) > 0:
+            raise RuntimeError(f"Tessellation of {len(failed)} slabs failed, see {', '.join(failed)}")
+
+    def run_static(self):
+        if self._decomposed:
+            with self._measure(f"execute/{self.stage_name}"):
+                self._run_slabs()
+        super().run_static()
+
+    def _merge_slabs(self, filename):
+        """
+        Write the cells of the slab cores to one results file with the layout
+        of a monolithic run, halo cells are dropped, and the index of the ion
+        of every cell to TESSELLATOR_ION_IDS.
+
+        The cells of a slab are taken to be in the order of its ions, as
+        paraprobe writes them for the monolithic run. Every slab has to have
+        one cell per ion and every ion has to end up in exactly one core,
+        otherwise the merge fails. Whether cells and ions match one by one is
+        checked against a monolithic run with compare_cell_volumes.
+
+        Cells in a slab core are the cells of the monolithic tessellation as
+        long as the halo is wider than the cells next to the slab boundary,
+        a few nearest neighbour distances.
+        """
+        import h5py
+        import paraprobe_autoreporter.metadata.h5tessellator as nx
+        edges = self.output["decomposition/edges"]
+        covered = np.zeros(int(self.output["decomposition/core_ions"].sum()), dtype=np.int8)
+        grpnm = nx.MYTESS + str(self.jobid) + nx.MYTESS_DATA_VORO_TSKS + '/0'
+        dsnm = grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_CVOL
+        dsnm_con = grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_WALLCONTACT
+        with h5py.File(filename, "w") as h5w:
+            merged = {}
+            for slab in range(self.input["decomposition/slabs"]):
+                tessellator = self.project.load(self._slab_job_name(slab))
+                pos_file, ids_file = self._slab_files(slab)
+                positions = read_pos(pos_file)
+                ids = np.fromfile(ids_file, dtype=np.int64)
+                slab_grpnm = nx.MYTESS + str(tessellator.jobid) + nx.MYTESS_DATA_VORO_TSKS + '/0'
+                results = os.path.join(tessellator.working_directory, tessellator._tessellator_results)
+                with h5py.File(results, "r") as h5r:
+                    volumes = h5r[slab_grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_CVOL]
+                    if volumes.shape[0] != len(ids):
+                        raise ValueError(f"Slab {slab} has {volumes.shape[0]} cells for {len(ids)} ions")
+                    wall = h5r[slab_grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_WALLCONTACT]
+                    for start, volume in iterate_dataset(volumes):
+                        stop = start + len(volume)
+                        z = np.asarray(positions[start:stop, 2])
+                        core = (z >= edges[slab]) & (z < edges[slab + 1])
+                        covered[ids[start:stop][core]] += 1
+                        blocks = {dsnm: volume[core], dsnm_con: wall[start:stop][core], TESSELLATOR_ION_IDS: ids[start:stop][core]}
+                        for name, block in blocks.items():
+                            if name not in merged:
+                                merged[name] = h5w.create_dataset(name, shape=(0,) + block.shape[1:], dtype=block.dtype,
+                                                                  maxshape=(None,) + block.shape[1:],
+                                                                  chunks=(2**16,) + block.shape[1:])
+                            if len(block) == 0:
+                                continue
+                            dataset = merged[name]
+                            dataset.resize(dataset.shape[0] + len(block), axis=0)
+                            dataset[-len(block):] = block
+        if np.any(covered != 1):
+            raise ValueError(f"{np.count_nonzero(covered == 0)} ions have no cell and "
+                             f"{np.count_nonzero(covered > 1)} more than one after merging the slabs")
+
+    def compare_cell_volumes(self, reference, cell_tolerance=1e-4):
+        """
+        Compare the cells to those of another tessellator job, e.g. a
+        monolithic run of the same dataset. Both need the same number of
+        cells, the largest relative difference of the volume quantiles has
+        to stay below the sum of the accuracies of both quantile sketches.
+
+        For a tessellation merged from slabs every cell is also compared to
+        the cell of the same ion in the reference, through the ion ids. Cells
+        touching the wall in either run are left out, all others have to
+        agree within cell_tolerance.
+        """
+        ours = np.asarray(self.output["cell_volume/quantiles/values"])
+        theirs = np.asarray(reference.output["cell_volume/quantiles/values"])
+        deviation = float(np.max(np.abs(ours - theirs) / np.abs(theirs)))
+        tolerance = self.input.relative_accuracy + reference.input.relative_accuracy
+        count_difference = int(self.output["cell_volume/count"] - reference.output["cell_volume/count"])
+        comparison = {
+            "count_difference": count_difference,
+            "max_quantile_deviation": deviation,
+            "tolerance": tolerance,
+        }
+        passed = count_difference == 0 and deviation <= tolerance
+        if self._decomposed:
+            mismatched, compared = self._compare_cells(reference, cell_tolerance)
+            comparison["cells_compared"] = compared
+            comparison["cells_mismatched"] = mismatched
+            passed = passed and mismatched == 0
+        comparison["passed"] = passed
+        return comparison
+
+    def _compare_cells(self, reference, cell_tolerance):
+        """
+        Number of cells whose volume differs from the cell of the same ion
+        in the reference and number of cells compared
+        """
+        import h5py
+        import paraprobe_autoreporter.metadata.h5tessellator as nx
+
+        def cells(job):
+            grpnm = nx.MYTESS + str(job.jobid) + nx.MYTESS_DATA_VORO_TSKS + '/0'
+            return (grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_CVOL,
+                    grpnm + '/' + nx.MYTESS_DATA_VORO_TSKS_WALLCONTACT)
+
+        # volume of the merged cell of every ion, NaN at the wall
+        n_ions = int(self.output["decomposition/core_ions"].sum())
+        volumes = np.full(n_ions, np.nan)
+        dsnm, dsnm_con = cells(self)
+        with h5py.File(os.path.join(self.working_directory, self._tessellator_results), "r") as h5r:
+            ids, wall = h5r[TESSELLATOR_ION_IDS], h5r[dsnm_con]
+            for start, volume in iterate_dataset(h5r[dsnm]):
+                stop = start + len(volume)
+                volume = np.where(wall[start:stop, 0] == 0, volume[:, 0], np.nan)
+                volumes[ids[start:stop]] = volume
+        mismatched = compared = 0
+        dsnm, dsnm_con = cells(reference)
+        with h5py.File(os.path.join(reference.working_directory, reference._tessellator_results), "r") as h5r:
+            wall = h5r[dsnm_con]
+            for start, volume in iterate_dataset(h5r[dsnm]):
+                stop = start + len(volume)
+                ours = volumes[start:stop]
+                inside = (wall[start:stop, 0] == 0) & ~np.isnan(ours)
+                theirs = volume[:, 0][inside]
+                compared += int(np.count_nonzero(inside))
+                mismatched += int(np.count_nonzero(np.abs(ours[inside] - theirs) > cell_tolerance * np.abs(theirs)))
+        return mismatched, compared
+
+    @_record_performance("collect/tessellator")
     def collect_output(self):
         self._collect_tessellator_results()
-        self._collect_logs()
+        if not self._decomposed:
+            self._collect_logs()
     
-    @_pipe_output_to_file("result_tessellator.log")
     def _collect_tessellator_results(self):
         self._tessellator_results = os.path.join(self.working_directory, f"PARAPROBE.Tessellator.Results.SimID.{self.jobid}.h5")
-        v, cdf = get_cell_volume(self._tessellator_results, self.jobid, tessellation_task_id=0)
-        self.output.v = v[0]
-        self.output.cdf = cdf[0]
+        if self._decomposed:
+            self._merge_slabs(self._tessellator_results)
+        statistics, excluded = get_cell_volume_statistics(
+            self._tessellator_results, self.jobid, tessellation_task_id=0,
+            exclude_wall_contact=self.input.exclude_wall_contact,
+            relative_accuracy=self.input.relative_accuracy)
+        for key, value in statistics.summary(n_points=self.input.cdf_points).items():
+            self.output[f"cell_volume/{key}"] = value
+        self.output["cell_volume/excluded_wall_contact"] = excluded
+        # fixed-size CDF, used by plot
+        self.output.v = self.output["cell_volume/cdf/values"]
+        self.output.cdf = self.output["cell_volume/cdf/fractions"]
         
+    @_record_performance("logs/tessellator")
     def _collect_logs(self):
-        config_tessellator_log = self._read_temporary_output_file("config_tessellator.log", clean=False)
-        execute_tessellator_log = self._read_temporary_output_file("log.out", clean=False)
-        self.output["log/configure/tessellator"] = config_tessellator_log
-        self.output["log/execute/tessellator"] = execute_tessellator_log
+        self._ingest_logs({
+            "configure/tessellator": "config_tessellator.log",
+            "execute/tessellator": "log.out",
+        })
     
     def plot(self):
+        import matplotlib.pyplot as plt
         plt.plot(self.output.v, self.output.cdf)
         plt.xscale('log')
         plt.xlabel(r'Cell volume $({nm}^3)$')